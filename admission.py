@@ -0,0 +1,126 @@
+import time
+from collections import deque
+from typing import Deque, Dict, NamedTuple, Optional, Tuple
+
+import config
+from .database import SHARED, execute_transaction
+from .formatters import format_file_size
+
+# Size-aware admission control. Downloads are sized up front (see
+# youtube.probe_size) and charged against rolling per-user and per-chat
+# byte quotas before any bandwidth is spent on them. With several
+# processes the charges live in the database, so a user whose chats are
+# spread over shard workers still has one quota.
+
+MB = 1024 * 1024
+
+
+class QuotaExceeded(Exception):
+    pass
+
+
+class Charge(NamedTuple):
+    """What one admitted download was charged, so refund() takes back exactly that"""
+    rows: Tuple[int, ...] = ()  # quota_charges ids, with several processes
+    entries: Tuple = ()  # (key, charge) pairs in _usage otherwise
+
+# ("user" | "chat", id) -> (timestamp, bytes) charged within the window
+_usage: Dict[Tuple[str, int], Deque[Tuple[float, int]]] = {}
+
+
+def _used(key: Tuple[str, int], now: float) -> int:
+    charges = _usage.get(key)
+    if not charges:
+        return 0
+    while charges and now - charges[0][0] > config.QUOTA_WINDOW:
+        charges.popleft()
+    if not charges:
+        del _usage[key]
+        return 0
+    return sum(size for _, size in charges)
+
+
+def _quotas(chat_id: int, user_id: Optional[int]):
+    if user_id is not None and config.USER_QUOTA_MB:
+        yield ("user", user_id), config.USER_QUOTA_MB, "your"
+    if config.CHAT_QUOTA_MB:
+        yield ("chat", chat_id), config.CHAT_QUOTA_MB, "this chat's"
+
+
+def too_large(size: Optional[int]) -> bool:
+    return bool(size and config.MAX_FILE_SIZE_MB and size > config.MAX_FILE_SIZE_MB * MB)
+
+
+def _refusal(whose: str, used: int, quota_mb: int) -> QuotaExceeded:
+    hours = config.QUOTA_WINDOW / 3600
+    return QuotaExceeded(
+        f"This would exceed {whose} download quota "
+        f"({format_file_size(used)} of {quota_mb} MB used in the last {hours:g} h)"
+    )
+
+
+def _db_key(key: Tuple[str, int]) -> str:
+    return f"{key[0]}:{key[1]}"
+
+
+def _admit_shared(conn, quotas: list, size: int, now: float) -> Charge:
+    # Runs in one write transaction, so two processes can't both pass
+    since = now - config.QUOTA_WINDOW
+    conn.execute("DELETE FROM quota_charges WHERE charged_at <= ?", (since,))
+    for key, quota_mb, whose in quotas:
+        used = conn.execute(
+            "SELECT COALESCE(SUM(size), 0) FROM quota_charges WHERE key = ? AND charged_at > ?",
+            (_db_key(key), since),
+        ).fetchone()[0]
+        if used + size > quota_mb * MB:
+            raise _refusal(whose, used, quota_mb)
+    rows = []
+    for key, _, _ in quotas:
+        cursor = conn.execute(
+            "INSERT INTO quota_charges (key, size, charged_at) VALUES (?, ?, ?)", (_db_key(key), size, now)
+        )
+        rows.append(cursor.lastrowid)
+    return Charge(rows=tuple(rows))
+
+
+def _refund_shared(conn, rows: Tuple[int, ...]):
+    conn.executemany("DELETE FROM quota_charges WHERE id = ?", [(row,) for row in rows])
+
+
+async def admit(chat_id: int, user_id: Optional[int], size: Optional[int]) -> Optional[Charge]:
+    """Charge a download of `size` bytes; raises QuotaExceeded if it is refused"""
+    if not size:
+        return None
+    if too_large(size):
+        raise QuotaExceeded(f"File is too large ({format_file_size(size)}, limit {config.MAX_FILE_SIZE_MB} MB)")
+
+    now = time.time()
+    if SHARED:
+        return await execute_transaction(_admit_shared, list(_quotas(chat_id, user_id)), size, now)
+    if len(_usage) > 10000:
+        for key in list(_usage):
+            _used(key, now)
+    for key, quota_mb, whose in _quotas(chat_id, user_id):
+        used = _used(key, now)
+        if used + size > quota_mb * MB:
+            raise _refusal(whose, used, quota_mb)
+    entries = []
+    for key, _, _ in _quotas(chat_id, user_id):
+        charge = (now, size)
+        _usage.setdefault(key, deque()).append(charge)
+        entries.append((key, charge))
+    return Charge(entries=tuple(entries))
+
+
+async def refund(charge: Optional[Charge]):
+    """Give back the charge of a download that didn't happen"""
+    if charge is None:
+        return
+    if charge.rows:
+        await execute_transaction(_refund_shared, charge.rows)
+    for key, entry in charge.entries:
+        charges = _usage.get(key, ())
+        for index, other in enumerate(charges):
+            if other is entry:
+                del charges[index]
+                break
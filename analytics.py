@@ -0,0 +1,227 @@
+import asyncio
+import heapq
+import math
+import time
+from collections import OrderedDict
+from typing import Dict, Any, List, Tuple
+
+import config
+from .database import add_to_history, enqueue_write, execute_read
+from . import search_index
+
+# Incrementally maintained play aggregates. Every play updates a few
+# counters and a bounded top-k set, so reads never scan history. A chat's
+# counters are loaded the first time it is touched, and only the most
+# recently active chats stay in memory.
+
+_TAU = config.TRENDING_HALF_LIFE / math.log(2)
+
+
+class TopK:
+    """Exact top-k over keys whose scores only ever increase"""
+
+    def __init__(self, k: int):
+        self.k = k
+        self.scores: Dict[str, float] = {}
+        self.top: Dict[str, float] = {}
+
+    def add(self, key: str, amount: float = 1.0) -> float:
+        score = self.scores.get(key, 0.0) + amount
+        self.scores[key] = score
+        if key in self.top or len(self.top) < self.k:
+            self.top[key] = score
+            return score
+        # Every key outside the top set scores <= the weakest member
+        weakest = min(self.top, key=self.top.__getitem__)
+        if score > self.top[weakest]:
+            del self.top[weakest]
+            self.top[key] = score
+        return score
+
+    def rescale(self, factor: float):
+        for key in self.scores:
+            self.scores[key] *= factor
+        for key in self.top:
+            self.top[key] *= factor
+
+    def prune(self, keep: int) -> List[str]:
+        """Forget the lowest scoring keys outside the top set; returns them"""
+        if len(self.scores) <= keep:
+            return []
+        survivors = dict(heapq.nlargest(keep, self.scores.items(), key=lambda kv: kv[1]))
+        survivors.update(self.top)
+        dropped = [key for key in self.scores if key not in survivors]
+        self.scores = survivors
+        return dropped
+
+    def items(self, n: int = None) -> List[Tuple[str, float]]:
+        return heapq.nlargest(n or self.k, self.top.items(), key=lambda kv: kv[1])
+
+
+titles: Dict[str, str] = {}
+chat_top: "OrderedDict[int, TopK]" = OrderedDict()
+
+# Trending uses forward decay: each play adds exp((t - landmark) / tau),
+# which keeps scores monotonic so TopK stays exact. The landmark is
+# moved forward before the exponent grows large.
+trending = TopK(config.TOP_TRACKS_SIZE)
+_landmark = time.time()
+
+
+def _decay_weight(now: float) -> float:
+    global _landmark
+    if (now - _landmark) / _TAU > 50:
+        trending.rescale(math.exp(-(now - _landmark) / _TAU))
+        _landmark = now
+    return math.exp((now - _landmark) / _TAU)
+
+
+def _current_score(value: float, now: float) -> float:
+    return value * math.exp(-(now - _landmark) / _TAU)
+
+
+async def _chat_top(chat_id: int) -> TopK:
+    """A chat's play counters, loaded from the database on first use"""
+    top = chat_top.get(chat_id)
+    if top is None:
+        rows = await execute_read(
+            "SELECT video_id, title, plays FROM chat_tracks WHERE chat_id = ? "
+            "ORDER BY plays DESC LIMIT ?",
+            (chat_id, config.CHAT_TOP_MAX_TRACKED),
+            fresh=True,  # plays still queued for a chat evicted moments ago
+        )
+        top = chat_top.get(chat_id)  # loaded by someone else meanwhile
+        if top is None:
+            top = TopK(config.TOP_TRACKS_SIZE)
+            for video_id, title, plays in rows:
+                titles.setdefault(video_id, title)
+                top.add(video_id, plays)
+            chat_top[chat_id] = top
+            while len(chat_top) > config.CHAT_TOP_MAX_CHATS:
+                chat_top.popitem(last=False)
+    chat_top.move_to_end(chat_id)
+    return top
+
+
+def _prune_titles():
+    """Forget titles no top set or trending counter refers to any more"""
+    global titles
+    wanted = set(trending.scores)
+    for top in chat_top.values():
+        wanted.update(top.scores)
+    titles = {video_id: title for video_id, title in titles.items() if video_id in wanted}
+
+
+def _prune_trending(keep: int, now: float):
+    """Bound the trending set, in memory and on disk"""
+    dropped = trending.prune(keep)
+    for i in range(0, len(dropped), 500):
+        chunk = dropped[i:i + 500]
+        enqueue_write(
+            f"DELETE FROM trending WHERE video_id IN ({','.join('?' * len(chunk))})",
+            tuple(chunk),
+        )
+    # Rows untouched for ten half-lives have decayed below 0.1% of a play
+    enqueue_write(
+        "DELETE FROM trending WHERE updated_at < ?",
+        (now - 10 * config.TRENDING_HALF_LIFE,),
+    )
+    _prune_titles()
+
+
+async def _load_trending(now: float) -> TopK:
+    rows = await execute_read(
+        "SELECT video_id, title, score, updated_at FROM trending WHERE updated_at >= ? "
+        "ORDER BY updated_at DESC LIMIT ?",
+        (now - 10 * config.TRENDING_HALF_LIFE, config.TRENDING_MAX_TRACKED),
+        fresh=True,
+    )
+    loaded = TopK(config.TOP_TRACKS_SIZE)
+    for video_id, title, score, updated_at in rows:
+        titles[video_id] = title
+        loaded.add(video_id, score * math.exp(-(now - updated_at) / _TAU))
+    return loaded
+
+
+async def init_analytics():
+    """Load the trending set; per-chat counters are loaded on demand"""
+    global trending, _landmark
+    now = time.time()
+    trending, _landmark = await _load_trending(now), now
+    _prune_trending(config.TRENDING_MAX_TRACKED, now)
+
+
+async def run_trending_refresher():
+    """Reload the trending set now and then, for processes that don't record plays.
+
+    Shard workers hand their plays to the front process, so the set they
+    loaded at startup would otherwise never change.
+    """
+    global trending, _landmark
+    while True:
+        await asyncio.sleep(config.TRENDING_REFRESH_INTERVAL)
+        now = time.time()
+        try:
+            trending, _landmark = await _load_trending(now), now
+            _prune_titles()
+        except Exception as e:
+            print(f"⚠️ Trending refresh failed: {e}")
+
+
+async def record_play(chat_id: int, user_id: int, track_info: Dict[str, Any]):
+    """Record a delivered track and update every aggregate"""
+    await add_to_history(chat_id, track_info, user_id=user_id)
+
+    video_id = track_info.get('vidid')
+    if not video_id:
+        return
+    title = track_info.get('title')
+    titles[video_id] = title
+    search_index.record_play(video_id)
+
+    top = await _chat_top(chat_id)
+    top.add(video_id)
+    if len(top.scores) > config.CHAT_TOP_MAX_TRACKED:
+        # the counts stay in chat_tracks; only the memory copy is bounded
+        top.prune(config.CHAT_TOP_MAX_TRACKED // 2)
+    enqueue_write(
+        "INSERT INTO chat_tracks (chat_id, video_id, title, plays) VALUES (?, ?, ?, 1) "
+        "ON CONFLICT(chat_id, video_id) DO UPDATE SET plays = plays + 1, title = excluded.title",
+        (chat_id, video_id, title),
+    )
+
+    now = time.time()
+    value = trending.add(video_id, _decay_weight(now))
+    enqueue_write(
+        "INSERT INTO trending (video_id, title, score, updated_at) VALUES (?, ?, ?, ?) "
+        "ON CONFLICT(video_id) DO UPDATE SET title = excluded.title, "
+        "score = excluded.score, updated_at = excluded.updated_at",
+        (video_id, title, _current_score(value, now), now),
+    )
+    if len(trending.scores) > config.TRENDING_MAX_TRACKED:
+        _prune_trending(config.TRENDING_MAX_TRACKED // 2, now)
+    elif len(titles) > 2 * config.TRENDING_MAX_TRACKED:
+        _prune_titles()
+
+
+async def get_top_tracks(chat_id: int, limit: int = None) -> List[Dict[str, Any]]:
+    """Most played tracks in a chat"""
+    top = await _chat_top(chat_id)
+    return [
+        {'vidid': video_id, 'title': titles.get(video_id), 'plays': int(plays)}
+        for video_id, plays in top.items(limit)
+    ]
+
+
+def get_trending(limit: int = None) -> List[Dict[str, Any]]:
+    """Globally trending tracks, most recent plays weighted highest"""
+    now = time.time()
+    return [
+        {'vidid': video_id, 'title': titles.get(video_id), 'score': _current_score(value, now)}
+        for video_id, value in trending.items(limit)
+    ]
+
+
+def is_trending(video_id: str) -> bool:
+    """Whether a track is in the global trending set (worth keeping on disk)"""
+    return video_id in trending.top
@@ -1,11 +1,14 @@
 import os
 import asyncio
 import aiohttp
-from flask import Flask, render_template, request, jsonify, send_file
+from flask import Flask, render_template, request, jsonify, send_file, url_for
 from werkzeug.serving import run_simple
 import json
 import re
 from youtube_api import YouTubeAPI
+from thumbnails import get_thumbnail
+from transcoder import cached_preview, make_preview
+from links import WATCH_URL, extract_video_id
 import config
 
 app = Flask(__name__)
@@ -34,6 +37,8 @@ async def search_music():
             
         # Search for videos
         results = await youtube_api.search(query, limit=10)
+        for result in results:
+            result['thumbnail_local'] = url_for('thumbnail', video_id=result['id'])
         
         return jsonify({
             'success': True,
@@ -43,6 +48,38 @@ async def search_music():
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
+@app.route('/thumb/<video_id>')
+async def thumbnail(video_id):
+    try:
+        path = await get_thumbnail(video_id, f"https://i.ytimg.com/vi/{video_id}/hqdefault.jpg")
+        
+        if not path:
+            return jsonify({'error': 'Thumbnail not available'}), 404
+            
+        return send_file(path, mimetype='image/jpeg', max_age=86400)
+        
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/preview/<video_id>')
+async def preview(video_id):
+    try:
+        path = cached_preview(video_id)
+        
+        if not path:
+            stream_url = await fetch_stream_url(WATCH_URL + video_id)
+            if not stream_url:
+                return jsonify({'error': 'Could not get stream URL'}), 404
+            path = await make_preview(video_id, stream_url)
+            
+        if not path:
+            return jsonify({'error': 'Could not create preview'}), 500
+            
+        return send_file(path, mimetype='audio/ogg', max_age=86400)
+        
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
 @app.route('/add_to_playlist', methods=['POST'])
 async def add_to_playlist():
     try:
@@ -193,12 +230,9 @@ def remove_track():
 
 async def fetch_stream_url(link: str) -> str | None:
     """Fetch stream URL from external API"""
-    try:
-        video_id = link.split("v=")[-1].split("&")[0]
-        if not video_id:
-            raise ValueError("Empty video ID extracted")
-    except Exception as e:
-        raise ValueError(f"❌ Could not extract video ID from link: {link}") from e
+    video_id = extract_video_id(link)
+    if not video_id:
+        raise ValueError(f"❌ Could not extract video ID from link: {link}")
 
     api_key = getattr(config, "API_KEY", os.getenv("API_KEY", "default_key"))
     api_url = getattr(config, "API_URL", os.getenv("API_URL", "https://deadlinetech.site"))
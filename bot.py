@@ -1,13 +1,37 @@
 import asyncio
 import os
+import sys
 import logging
 from pyrogram import filters
 from pyrogram.client import Client
-from pyrogram.types import Message, InlineKeyboardMarkup, InlineKeyboardButton
+from pyrogram.types import (
+    Message, InlineKeyboardMarkup, InlineKeyboardButton, InlineQuery,
+    InlineQueryResultCachedAudio, InlineQueryResultArticle, InputTextMessageContent
+)
 from pyrogram.enums import ChatType
 import config
-from utils.youtube import YouTubeAPI
-from utils.database import init_db, get_chat_settings, set_chat_settings
+from utils.youtube import FileTooLarge, YouTubeAPI, cookie_txt_file
+from utils.uploader import MusicClient, StreamingSource
+from utils.database import (
+    init_db, close_db, get_chat_settings, set_chat_settings, get_user_stats,
+    get_file_id, set_file_id, forget_file_id
+)
+from utils.analytics import (init_analytics, record_play, get_top_tracks, get_trending, is_trending,
+                             run_trending_refresher)
+from utils.warmer import foreground_job, forward_foreground, report_foreground, run_warmer
+from utils import search_index
+from utils.thumbnails import get_thumbnail
+from utils.status import StatusChannel
+from utils.outbound import submit, share_global_rate, PRIORITY_MEDIA, PRIORITY_STATUS
+from utils.transcoder import cached_preview, make_preview
+from utils.admission import Charge, QuotaExceeded, admit, refund, too_large
+from utils.links import WATCH_URL, canonical_url, extract_video_id
+from utils import buttons, job_queue, manifest, sharding, tracing
+from utils.negative_cache import VideoUnavailable
+from utils.quality import MAX_HEIGHT, choose_height
+from utils.ratelimit import Overloaded, hit, job_slot
+from utils.jobs import new_job, run_job, cancel_job, cancel_jobs
+from utils.player import Track, FileSink, TgCallsSink, get_player, players, set_sink_factory
 from utils.formatters import time_to_seconds, format_duration
 import json
 
@@ -18,30 +42,81 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+# Shard number when running as a download worker (see utils/sharding.py)
+WORKER_ID = sharding.worker_id()
+SESSION_SUFFIX = "" if WORKER_ID is None else f"_worker{WORKER_ID}"
+
 # Initialize bot client
 if config.STRING_SESSION:
     # Use user account session
-    app = Client(
-        "music_bot_user",
+    app = MusicClient(
+        "music_bot_user" + SESSION_SUFFIX,
         api_id=config.API_ID,
         api_hash=config.API_HASH,
-        session_string=config.STRING_SESSION
+        session_string=config.STRING_SESSION,
+        no_updates=WORKER_ID is not None,
+        upload_sessions=config.UPLOAD_SESSIONS_USER,
+        upload_workers=config.UPLOAD_WORKERS
     )
 else:
     # Use bot token
-    app = Client(
-        "music_bot",
+    app = MusicClient(
+        "music_bot" + SESSION_SUFFIX,
         api_id=config.API_ID,
         api_hash=config.API_HASH,
-        bot_token=config.BOT_TOKEN
+        bot_token=config.BOT_TOKEN,
+        no_updates=WORKER_ID is not None,
+        upload_sessions=config.UPLOAD_SESSIONS_BOT,
+        upload_workers=config.UPLOAD_WORKERS
     )
 
 youtube = YouTubeAPI()
 
+# Download workers of the front process, when sharding is enabled
+shards = None
+
+# Voice chat streaming (group calls need a user account); front process only
+calls = None
+if WORKER_ID is None and config.STREAM_SINK == "file":
+    set_sink_factory(lambda chat_id: FileSink(config.STREAM_FILE_PATH.format(chat_id=chat_id)))
+elif WORKER_ID is None and config.STRING_SESSION:
+    from pytgcalls import PyTgCalls
+    calls = PyTgCalls(app)
+    set_sink_factory(lambda chat_id: TgCallsSink(calls))
+
 # Global state for music queue and downloads
 music_queue = {}
 chat_downloads = {}
 
+# Commands and buttons that start downloads, and what each costs
+RATE_LIMITED_COMMANDS = {"play": "audio", "video": "video", "preview": "audio", "stream": "audio"}
+
+@app.on_message(filters.command(list(RATE_LIMITED_COMMANDS)), group=-1)
+async def rate_limit_commands(client: Client, message: Message):
+    """Drop download commands from users or chats over their rate limit"""
+    if not message.from_user:
+        return
+    allowed, warn = hit(message.chat.id, message.from_user.id, RATE_LIMITED_COMMANDS[message.command[0]])
+    if allowed:
+        return
+    if warn:
+        await submit(message.chat.id, message.reply_text, "🚦 **Slow down!** Too many requests, please wait a minute.")
+    message.stop_propagation()
+
+@app.on_callback_query(filters.regex(r"^((download|quick)_(audio|video)|preview|tk)_"), group=-1)
+async def rate_limit_callbacks(client: Client, callback_query):
+    """Drop download buttons from users or chats over their rate limit"""
+    button = buttons.resolve(callback_query.data)
+    if button:
+        kind = "video" if button.mode == "video" else "audio"
+    else:
+        kind = "video" if callback_query.data.startswith(("download_video_", "quick_video_")) else "audio"
+    allowed, _ = hit(callback_query.message.chat.id, callback_query.from_user.id, kind)
+    if allowed:
+        return
+    await callback_query.answer("🚦 Too many requests, please wait a minute.", show_alert=True)
+    callback_query.stop_propagation()
+
 @app.on_message(filters.command("start"))
 async def start_command(client: Client, message: Message):
     """Start command handler"""
@@ -72,9 +147,10 @@ I can download and share music from YouTube! Here are my commands:
         [InlineKeyboardButton("Support", url="https://t.me/your_support_chat")]
     ])
     
-    await message.reply_text(welcome_text, reply_markup=keyboard)
+    await submit(message.chat.id, message.reply_text, welcome_text, reply_markup=keyboard)
 
 @app.on_message(filters.command("play"))
+@tracing.traced_update("play")
 async def play_command(client: Client, message: Message):
     """Download and send music"""
     chat_id = message.chat.id
@@ -90,9 +166,9 @@ async def play_command(client: Client, message: Message):
             query = message.reply_to_message.caption
     
     if not query:
-        return await message.reply_text("❌ Please provide a song name or YouTube URL!\n\nExample: `/play Despacito`")
+        return await submit(message.chat.id, message.reply_text, "❌ Please provide a song name or YouTube URL!\n\nExample: `/play Despacito`")
     
-    status_msg = await message.reply_text("🔍 **Searching for music...**")
+    status_msg = await submit(message.chat.id, message.reply_text, "🔍 **Searching for music...**")
     
     try:
         # Check if it's a YouTube URL
@@ -104,26 +180,27 @@ async def play_command(client: Client, message: Message):
             search_results = await youtube.search(query, limit=5)
             
             if not search_results:
-                return await status_msg.edit_text("❌ No results found for your search.")
+                return await submit(status_msg.chat.id, status_msg.edit_text, "❌ No results found for your search.")
             
             # Create inline keyboard for song selection
             keyboard = InlineKeyboardMarkup([
                 [InlineKeyboardButton(
                     f"🎵 {result['title'][:50]}{'...' if len(result['title']) > 50 else ''} [{result['duration']}]",
-                    callback_data=f"download_audio_{result['id']}"
+                    callback_data=buttons.register(result['id'], "audio", buttons.track_details(result))
                 )] for result in search_results[:5]
             ])
             
-            await status_msg.edit_text(
+            await submit(status_msg.chat.id, status_msg.edit_text,
                 f"🎵 **Search Results for:** `{query}`\n\nSelect a song to download:",
                 reply_markup=keyboard
             )
     
     except Exception as e:
         logger.error(f"Play command error: {e}")
-        await status_msg.edit_text(f"❌ **Error:** {str(e)}")
+        await submit(status_msg.chat.id, status_msg.edit_text, f"❌ **Error:** {str(e)}")
 
 @app.on_message(filters.command("video"))
+@tracing.traced_update("video")
 async def video_command(client: Client, message: Message):
     """Download and send video"""
     chat_id = message.chat.id
@@ -136,22 +213,23 @@ async def video_command(client: Client, message: Message):
         query = message.reply_to_message.text
     
     if not query:
-        return await message.reply_text("❌ Please provide a YouTube URL!\n\nExample: `/video https://youtube.com/watch?v=...`")
+        return await submit(message.chat.id, message.reply_text, "❌ Please provide a YouTube URL!\n\nExample: `/video https://youtube.com/watch?v=...`")
     
     if not await youtube.exists(query):
-        return await message.reply_text("❌ Please provide a valid YouTube URL!")
+        return await submit(message.chat.id, message.reply_text, "❌ Please provide a valid YouTube URL!")
     
-    status_msg = await message.reply_text("📹 **Downloading video...**")
+    status_msg = await submit(message.chat.id, message.reply_text, "📹 **Downloading video...**")
     
     try:
         await download_and_send_video(client, message, query, status_msg)
     except Exception as e:
         logger.error(f"Video command error: {e}")
-        await status_msg.edit_text(f"❌ **Error:** {str(e)}")
+        await submit(status_msg.chat.id, status_msg.edit_text, f"❌ **Error:** {str(e)}")
 
 @app.on_callback_query(filters.regex(r"download_audio_(.+)"))
+@tracing.traced_update("download_audio")
 async def download_audio_callback(client: Client, callback_query):
-    """Handle audio download from search results"""
+    """Handle audio download from search results sent before button tokens"""
     video_id = callback_query.data.split("_", 2)[2]
     chat_id = callback_query.message.chat.id
     
@@ -159,17 +237,19 @@ async def download_audio_callback(client: Client, callback_query):
         await callback_query.answer("Downloading...")
         
         # Get video URL
-        video_url = f"https://www.youtube.com/watch?v={video_id}"
+        video_url = WATCH_URL + video_id
         
-        await download_and_send_audio(client, callback_query.message, video_url, callback_query.message)
+        await download_and_send_audio(client, callback_query.message, video_url, callback_query.message,
+                                      user_id=callback_query.from_user.id)
         
     except Exception as e:
         logger.error(f"Audio download error: {e}")
-        await callback_query.message.edit_text(f"❌ **Error:** {str(e)}")
+        await submit(callback_query.message.chat.id, callback_query.message.edit_text, f"❌ **Error:** {str(e)}")
 
 @app.on_callback_query(filters.regex(r"download_video_(.+)"))
+@tracing.traced_update("download_video")
 async def download_video_callback(client: Client, callback_query):
-    """Handle video download from search results"""
+    """Handle video download from search results sent before button tokens"""
     video_id = callback_query.data.split("_", 2)[2]
     chat_id = callback_query.message.chat.id
     
@@ -177,113 +257,531 @@ async def download_video_callback(client: Client, callback_query):
         await callback_query.answer("Downloading...")
         
         # Get video URL
-        video_url = f"https://www.youtube.com/watch?v={video_id}"
+        video_url = WATCH_URL + video_id
         
-        await download_and_send_video(client, callback_query.message, video_url, callback_query.message)
+        await download_and_send_video(client, callback_query.message, video_url, callback_query.message,
+                                      user_id=callback_query.from_user.id)
         
     except Exception as e:
         logger.error(f"Video download error: {e}")
-        await callback_query.message.edit_text(f"❌ **Error:** {str(e)}")
+        await submit(callback_query.message.chat.id, callback_query.message.edit_text, f"❌ **Error:** {str(e)}")
+
+@app.on_callback_query(filters.regex(r"^tk_[\w-]+$"))
+@tracing.traced_update("button")
+async def button_callback(client: Client, callback_query):
+    """Handle download and preview buttons carrying a button token"""
+    button = buttons.resolve(callback_query.data)
+    if button is None:
+        return await callback_query.answer("⌛ This button has expired, please search again.", show_alert=True)
+    message = callback_query.message
+    
+    if button.mode == "preview":
+        try:
+            await callback_query.answer("Preparing preview...")
+            track_info = button.track or (await youtube.track(button.video_id, videoid=True))[0]
+            if not await send_preview(client, message, button.video_id, track_info['title'], track_info['duration_min']):
+                await submit(message.chat.id, message.reply_text, "❌ **Preview failed!**")
+        except Exception as e:
+            logger.error(f"Preview error: {e}")
+            await submit(message.chat.id, message.reply_text, f"❌ **Preview failed:** {str(e)}")
+        return
+    
+    try:
+        await callback_query.answer("Downloading...")
+        send = download_and_send_video if button.mode == "video" else download_and_send_audio
+        await send(client, message, WATCH_URL + button.video_id, message,
+                   user_id=callback_query.from_user.id, track_info=button.track)
+    except Exception as e:
+        logger.error(f"Button download error: {e}")
+        await submit(message.chat.id, message.edit_text, f"❌ **Error:** {str(e)}")
 
-async def download_and_send_audio(client: Client, message: Message, url: str, status_msg: Message):
+async def _ready_thumbnail(thumb_task: asyncio.Task):
+    """Thumbnail path if it is ready in time; uploads never wait long for it"""
+    try:
+        return await asyncio.wait_for(asyncio.shield(thumb_task), timeout=config.THUMB_WAIT)
+    except asyncio.TimeoutError:
+        return None
+
+async def _download_and_upload(url: str, video: bool, name: str, status: StatusChannel, send,
+                               quality: int = MAX_HEIGHT, checkpoint=None):
+    """Download a track and upload it with `send`.
+
+    When the download knows its size up front, the upload starts at once
+    and consumes parts as they arrive; otherwise, or if that fails, the
+    finished file is uploaded afterwards. Returns (sent, file, direct);
+    file is None when nothing was downloaded, or when the download failed
+    after its pipelined upload had already been delivered.
+    """
+    label = "video" if video else "audio"
+    if checkpoint and checkpoint.reached("download") and os.path.exists(checkpoint.data["file"]):
+        # A resumed queue job: the file survived, only the upload is left
+        status.update(f"📤 **Uploading {label}...**")
+        sent = await asyncio.wait_for(send(checkpoint.data["file"]), timeout=config.UPLOAD_TIMEOUT)
+        return sent, checkpoint.data["file"], checkpoint.data["direct"]
+    # A scaled-down video is re-encoded after the download, so it can't stream
+    source = StreamingSource(name) if config.PIPELINE_UPLOAD and quality == MAX_HEIGHT else None
+    download_task = asyncio.create_task(youtube.download(
+        url, None, video=video, progress=status.progress(f"⬇️ **Downloading {label}...**"), tee=source,
+        quality=quality
+    ))
+    try:
+        return await _pipeline(download_task, source, label, status, send, checkpoint)
+    finally:
+        # Cancelled or failed: stop the transfer so it frees its bandwidth
+        if not download_task.done():
+            download_task.cancel()
+
+async def _pipeline(download_task: asyncio.Task, source, label: str, status: StatusChannel, send,
+                    checkpoint=None):
+    if source is not None:
+        await asyncio.wait([source.ready, download_task], return_when=asyncio.FIRST_COMPLETED)
+        if source.ready.done() and source.ready.result():
+            status.update(f"📤 **Uploading {label}...**")
+            try:
+                sent = await asyncio.wait_for(send(source), timeout=config.UPLOAD_TIMEOUT)
+            except Exception as e:
+                logger.warning(f"Pipelined upload failed, uploading after download: {e}")
+            else:
+                try:
+                    downloaded_file, direct = await download_task
+                except Exception as e:
+                    # The media is delivered; whatever failed is only cleanup
+                    logger.warning(f"Download failed after its pipelined upload was sent: {e}")
+                    return sent, None, False
+                return sent, downloaded_file, direct
+    
+    downloaded_file, direct = await download_task
+    if not downloaded_file:
+        return None, None, None
+    if checkpoint:
+        await checkpoint.save("download", file=downloaded_file, direct=direct)
+    
+    status.update(f"📤 **Uploading {label}...**")
+    sent = await asyncio.wait_for(send(downloaded_file), timeout=config.UPLOAD_TIMEOUT)
+    return sent, downloaded_file, direct
+
+def _cancel_markup(job_id: str) -> InlineKeyboardMarkup:
+    return InlineKeyboardMarkup([[InlineKeyboardButton("✖️ Cancel", callback_data=f"cancel_{job_id}")]])
+
+async def _queued(job, status: StatusChannel, work):
+    """Run `work()` once the job gets a slot (waiting counts towards its timeout)"""
+    def on_queued(ahead: int):
+        if ahead:
+            status.update(f"⏳ **Queued:** {ahead} download{'s' if ahead > 1 else ''} ahead of yours")
+        else:
+            status.update("⏳ **Queued:** yours is next")
+    async with job_slot(job.user_id, on_queued):
+        await work()
+
+async def _run_download_job(message: Message, status_msg: Message, user_id: int, kind: str, label: str, work,
+                            job_id: str = None) -> str:
+    """Run a cancellable, rate-limited download job with a status message; returns its final state.
+
+    A queue job (`job_id` given) that finds no free slot raises
+    job_queue.Deferred to wait in the queue, instead of being refused.
+    """
+    job = new_job(message.chat.id, user_id, kind, job_id)
+    status = StatusChannel(status_msg, reply_markup=_cancel_markup(job.id))
+    try:
+        async with foreground_job():
+            await run_job(job, _queued(job, status, lambda: work(status)))
+    except Overloaded as e:
+        if job_id is not None:
+            await submit(status_msg.chat.id, status_msg.edit_text,
+                         "⏳ **Queued:** waiting for your other downloads to finish",
+                         priority=PRIORITY_STATUS, reply_markup=_cancel_markup(job.id))
+            raise job_queue.Deferred(str(e))
+        await status.finish(f"🚦 **{e}**")
+        return "refused"
+    if job.state == "cancelled":
+        await status.finish(f"🛑 **{label} cancelled**")
+    elif job.state == "timeout":
+        await status.finish(f"⌛ **{label} timed out**")
+    # taken_over: the worker now running the job reports on it
+    return job.state
+
+async def _enqueue(message: Message, status_msg: Message, user_id: int, kind: str, url: str,
+                   track_info: dict = None):
+    """Record a durable download job for the queue consumers"""
+    job_id = await job_queue.enqueue(
+        message.chat.id, user_id, kind, message.id, status_msg.id, url, track_info, tracing.carrier()
+    )
+    await submit(status_msg.chat.id, status_msg.edit_text, "⏳ **Queued...**",
+                 priority=PRIORITY_STATUS, reply_markup=_cancel_markup(job_id))
+
+async def _dispatch(message: Message, status_msg: Message, user_id: int, kind: str, url: str,
+                    track_info: dict = None):
+    """Hand a download job to the shard worker that owns the chat"""
+    await shards.dispatch(message.chat.id, {
+        "op": "download",
+        "kind": kind,
+        "chat_id": message.chat.id,
+        "message_id": message.id,
+        "status_id": status_msg.id,
+        "user_id": user_id,
+        "url": url,
+        "track": track_info,
+        "trace": tracing.carrier(),
+    })
+
+async def _record_play(chat_id: int, user_id: int, track_info: dict):
+    """Record a delivered track; workers leave the analytics to the front process"""
+    if WORKER_ID is None or not sharding.has_front():
+        await record_play(chat_id, user_id, track_info)
+    else:
+        sharding.emit({"op": "played", "chat_id": chat_id, "user_id": user_id, "track": track_info})
+
+async def download_and_send_audio(client: Client, message: Message, url: str, status_msg: Message,
+                                  user_id: int = None, track_info: dict = None):
     """Download and send audio file"""
+    if user_id is None and message.from_user:
+        user_id = message.from_user.id
+    # One URL per video, so every cache sees the same key
+    url = canonical_url(url) or url
+    if config.JOB_QUEUE:
+        return await _enqueue(message, status_msg, user_id, "audio", url, track_info)
+    if shards:
+        return await _dispatch(message, status_msg, user_id, "audio", url, track_info)
+    await _run_download_job(
+        message, status_msg, user_id, "audio", "Download",
+        lambda status: _download_and_send_audio(client, message, url, status, user_id, track_info)
+    )
+
+async def _download_and_send_audio(client: Client, message: Message, url: str, status: StatusChannel,
+                                   user_id: int, track_info: dict = None, checkpoint=None):
+    """Resolve, download and upload; `checkpoint` is the queue job being run, if any"""
+    if checkpoint and checkpoint.reached("upload"):
+        return await status.delete()
+    # Quota charged for this download, handed back unless it is delivered
+    charge, delivered, retrying = None, False, False
     try:
         # Update status
-        await status_msg.edit_text("⬇️ **Downloading audio...**")
+        status.update("⬇️ **Downloading audio...**")
+        
+        # Get track details, unless the button already carried them
+        if track_info:
+            video_id = track_info['vidid']
+        else:
+            track_info, video_id = await asyncio.wait_for(youtube.track(url), timeout=config.RESOLVE_TIMEOUT)
+        caption = f"🎵 **{track_info['title']}**\n⏱ Duration: {track_info['duration_min']}\n👤 Requested by: {message.from_user.first_name}"
         
-        # Get track details
-        track_info, video_id = await youtube.track(url)
+        # Reuse an earlier upload of the same track when Telegram still accepts it
+        cached_file_id = await get_file_id(video_id, "audio")
+        if cached_file_id:
+            try:
+                await submit(
+                    message.chat.id,
+                    client.send_audio,
+                    message.chat.id,
+                    cached_file_id,
+                    priority=PRIORITY_MEDIA,
+                    caption=caption,
+                    reply_to_message_id=message.id
+                )
+                await status.delete()
+                await _record_play(message.chat.id, user_id, track_info)
+                return
+            except Exception as e:
+                logger.warning(f"Cached file_id rejected for {video_id}: {e}")
+                await forget_file_id(video_id, "audio")
         
-        # Download audio
-        downloaded_file, direct = await youtube.download(url, None)
+        # Size the download before spending any bandwidth on it
+        if checkpoint and checkpoint.reached("resolve"):
+            size = checkpoint.data["size"]
+            charge = Charge(rows=tuple(checkpoint.data.get("charge") or ()))
+        else:
+            size = await youtube.probe_size(url)
+            try:
+                charge = await admit(message.chat.id, user_id, size)
+            except QuotaExceeded as e:
+                return await status.finish(f"🚫 **{e}**")
+            if checkpoint:
+                await checkpoint.save("resolve", track=track_info, size=size, charge=charge and charge.rows)
         
-        if not downloaded_file:
-            return await status_msg.edit_text("❌ **Download failed!**")
+        # Fetch the thumbnail alongside the download
+        thumb_task = asyncio.create_task(get_thumbnail(video_id, track_info['thumb']))
         
-        # Update status
-        await status_msg.edit_text("📤 **Uploading audio...**")
-        
-        # Send audio file
-        await client.send_audio(
-            message.chat.id,
-            downloaded_file,
-            caption=f"🎵 **{track_info['title']}**\n⏱ Duration: {track_info['duration_min']}\n👤 Requested by: {message.from_user.first_name}",
-            title=track_info['title'],
-            duration=time_to_seconds(track_info['duration_min']),
-            thumb=track_info['thumb'],
-            reply_to_message_id=message.id
+        async def send(media):
+            return await submit(
+                message.chat.id,
+                client.send_audio,
+                message.chat.id,
+                media,
+                priority=PRIORITY_MEDIA,
+                # A stream can only be uploaded once; _pipeline falls back to the file
+                retry=not isinstance(media, StreamingSource),
+                caption=caption,
+                title=track_info['title'],
+                duration=time_to_seconds(track_info['duration_min']),
+                thumb=await _ready_thumbnail(thumb_task),
+                reply_to_message_id=message.id,
+                progress=status.progress("📤 **Uploading audio...**")
+            )
+        
+        # Download audio, uploading it while it downloads when possible
+        sent, downloaded_file, direct = await _download_and_upload(
+            url, False, f"{video_id}.m4a", status, send, checkpoint=checkpoint
         )
         
+        if not (sent or downloaded_file):
+            if checkpoint:
+                # Let the queue retry it
+                raise RuntimeError("download failed")
+            return await status.finish("❌ **Download failed!**")
+        delivered = True
+        if checkpoint:
+            await checkpoint.save("upload")
+        
+        if sent and sent.audio:
+            await set_file_id(video_id, "audio", sent.audio.file_id)
+        
         # Delete status message
-        await status_msg.delete()
+        await status.delete()
         
-        # Clean up downloaded file if it's a local file
-        if direct and os.path.exists(downloaded_file):
+        await _record_play(message.chat.id, user_id, track_info)
+        
+        # Clean up downloaded file if it's a local file, keeping trending tracks cached
+        if direct and downloaded_file and os.path.exists(downloaded_file) and not is_trending(video_id):
             try:
                 os.remove(downloaded_file)
             except:
                 pass
+            await manifest.forget(downloaded_file)
                 
+    except asyncio.TimeoutError:
+        if checkpoint:
+            retrying = True
+            raise
+        await status.finish("⌛ **Download timed out**")
+    except (VideoUnavailable, FileTooLarge) as e:
+        await status.finish(f"🚫 **{e}**")
     except Exception as e:
         logger.error(f"Audio download error: {e}")
-        await status_msg.edit_text(f"❌ **Download failed:** {str(e)}")
+        if checkpoint:
+            # Queue jobs are retried; the user hears about it if they are given up
+            retrying = True
+            raise
+        await status.finish(f"❌ **Download failed:** {str(e)}")
+    finally:
+        # Failed, timed out or cancelled; a queue job being retried keeps its charge,
+        # and one taken over by another worker leaves it to that worker
+        if not delivered and not retrying and not (checkpoint and checkpoint.taken_over):
+            await refund(charge)
 
-async def download_and_send_video(client: Client, message: Message, url: str, status_msg: Message):
+async def download_and_send_video(client: Client, message: Message, url: str, status_msg: Message,
+                                  user_id: int = None, track_info: dict = None):
     """Download and send video file"""
+    if user_id is None and message.from_user:
+        user_id = message.from_user.id
+    # One URL per video, so every cache sees the same key
+    url = canonical_url(url) or url
+    if config.JOB_QUEUE:
+        return await _enqueue(message, status_msg, user_id, "video", url, track_info)
+    if shards:
+        return await _dispatch(message, status_msg, user_id, "video", url, track_info)
+    await _run_download_job(
+        message, status_msg, user_id, "video", "Video download",
+        lambda status: _download_and_send_video(client, message, url, status, user_id, track_info)
+    )
+
+async def _download_and_send_video(client: Client, message: Message, url: str, status: StatusChannel,
+                                   user_id: int, track_info: dict = None, checkpoint=None):
+    """Resolve, download and upload; `checkpoint` is the queue job being run, if any"""
+    if checkpoint and checkpoint.data.get("as_audio"):
+        # An earlier attempt found the video too large and went for the audio
+        return await _download_and_send_audio(client, message, url, status, user_id, track_info, checkpoint)
+    if checkpoint and checkpoint.reached("upload"):
+        return await status.delete()
+    # Quota charged for this download, handed back unless it is delivered
+    charge, delivered, retrying = None, False, False
     try:
         # Update status
-        await status_msg.edit_text("⬇️ **Downloading video...**")
+        status.update("⬇️ **Downloading video...**")
+        
+        # Get track details, unless the button already carried them
+        if track_info:
+            video_id = track_info['vidid']
+        else:
+            track_info, video_id = await asyncio.wait_for(youtube.track(url), timeout=config.RESOLVE_TIMEOUT)
+        caption = f"📹 **{track_info['title']}**\n⏱ Duration: {track_info['duration_min']}\n👤 Requested by: {message.from_user.first_name}"
         
-        # Get track details
-        track_info, video_id = await youtube.track(url)
+        # Reuse an earlier upload of the same track when Telegram still accepts it
+        cached_file_id = await get_file_id(video_id, "video")
+        if cached_file_id:
+            try:
+                await submit(
+                    message.chat.id,
+                    client.send_video,
+                    message.chat.id,
+                    cached_file_id,
+                    priority=PRIORITY_MEDIA,
+                    caption=caption,
+                    reply_to_message_id=message.id
+                )
+                await status.delete()
+                await _record_play(message.chat.id, user_id, track_info)
+                return
+            except Exception as e:
+                logger.warning(f"Cached file_id rejected for {video_id}: {e}")
+                await forget_file_id(video_id, "video")
         
-        # Download video
-        downloaded_file, direct = await youtube.download(url, None, video=True)
+        # Size the download before spending any bandwidth on it
+        if checkpoint and checkpoint.reached("resolve"):
+            size, quality = checkpoint.data["size"], checkpoint.data["quality"]
+            charge = Charge(rows=tuple(checkpoint.data.get("charge") or ()))
+        else:
+            size = await youtube.probe_size(url, video=True)
+            if too_large(size):
+                audio_size = await youtube.probe_size(url)
+                if audio_size and not too_large(audio_size):
+                    status.update("📉 **Video is too large, sending audio instead...**")
+                    if checkpoint:
+                        await checkpoint.save(checkpoint.stage, as_audio=True)
+                    return await _download_and_send_audio(client, message, url, status, user_id, track_info,
+                                                          checkpoint)
+            try:
+                charge = await admit(message.chat.id, user_id, size)
+            except QuotaExceeded as e:
+                return await status.finish(f"🚫 **{e}**")
+            
+            # Pick the best quality that should arrive within the target time; without
+            # cookies a lower quality can only be scaled down from the full file
+            quality = choose_height(time_to_seconds(track_info['duration_min']), size,
+                                    transcoded=not cookie_txt_file())
+            if quality < MAX_HEIGHT:
+                status.update(f"📉 **Network is busy, sending {quality}p...**")
+            if checkpoint:
+                await checkpoint.save("resolve", track=track_info, size=size, quality=quality,
+                                      charge=charge and charge.rows)
         
-        if not downloaded_file:
-            return await status_msg.edit_text("❌ **Video download failed!**")
+        # Fetch the thumbnail alongside the download
+        thumb_task = asyncio.create_task(get_thumbnail(video_id, track_info['thumb']))
         
-        # Update status
-        await status_msg.edit_text("📤 **Uploading video...**")
-        
-        # Send video file
-        await client.send_video(
-            message.chat.id,
-            downloaded_file,
-            caption=f"📹 **{track_info['title']}**\n⏱ Duration: {track_info['duration_min']}\n👤 Requested by: {message.from_user.first_name}",
-            duration=time_to_seconds(track_info['duration_min']),
-            thumb=track_info['thumb'],
-            reply_to_message_id=message.id
+        async def send(media):
+            return await submit(
+                message.chat.id,
+                client.send_video,
+                message.chat.id,
+                media,
+                priority=PRIORITY_MEDIA,
+                # A stream can only be uploaded once; _pipeline falls back to the file
+                retry=not isinstance(media, StreamingSource),
+                caption=caption,
+                duration=time_to_seconds(track_info['duration_min']),
+                thumb=await _ready_thumbnail(thumb_task),
+                reply_to_message_id=message.id,
+                progress=status.progress("📤 **Uploading video...**")
+            )
+        
+        # Download video, uploading it while it downloads when possible
+        sent, downloaded_file, direct = await _download_and_upload(
+            url, True, f"{video_id}.mp4", status, send, quality, checkpoint
         )
         
+        if not (sent or downloaded_file):
+            if checkpoint:
+                # Let the queue retry it
+                raise RuntimeError("download failed")
+            return await status.finish("❌ **Video download failed!**")
+        delivered = True
+        if checkpoint:
+            await checkpoint.save("upload")
+        
+        # Only full quality uploads are worth reusing
+        if sent and sent.video and quality == MAX_HEIGHT:
+            await set_file_id(video_id, "video", sent.video.file_id)
+        
         # Delete status message
-        await status_msg.delete()
+        await status.delete()
+        
+        await _record_play(message.chat.id, user_id, track_info)
         
-        # Clean up downloaded file if it's a local file
-        if direct and os.path.exists(downloaded_file):
+        # Clean up downloaded file if it's a local file, keeping trending tracks cached
+        if direct and downloaded_file and os.path.exists(downloaded_file) and not is_trending(video_id):
             try:
                 os.remove(downloaded_file)
             except:
                 pass
+            await manifest.forget(downloaded_file)
                 
+    except asyncio.TimeoutError:
+        if checkpoint:
+            retrying = True
+            raise
+        await status.finish("⌛ **Video download timed out**")
+    except (VideoUnavailable, FileTooLarge) as e:
+        await status.finish(f"🚫 **{e}**")
     except Exception as e:
         logger.error(f"Video download error: {e}")
-        await status_msg.edit_text(f"❌ **Video download failed:** {str(e)}")
+        if checkpoint:
+            # Queue jobs are retried; the user hears about it if they are given up
+            retrying = True
+            raise
+        await status.finish(f"❌ **Video download failed:** {str(e)}")
+    finally:
+        # Failed, timed out or cancelled; a queue job being retried keeps its charge,
+        # and one taken over by another worker leaves it to that worker
+        if not delivered and not retrying and not (checkpoint and checkpoint.taken_over):
+            await refund(charge)
+
+async def _finish_queued_cancels(cancelled: list):
+    """Update the status of queue jobs cancelled before any worker picked them up"""
+    for chat_id, status_id, was_queued in cancelled:
+        if was_queued:
+            await submit(chat_id, app.edit_message_text, chat_id, status_id, "🛑 **Download cancelled**")
+
+@app.on_message(filters.command("cancel"))
+async def cancel_command(client: Client, message: Message):
+    """Cancel your running downloads in this chat"""
+    if not message.from_user:
+        return
+    if config.JOB_QUEUE:
+        cancelled = await job_queue.cancel(message.from_user.id, chat_id=message.chat.id)
+        await _finish_queued_cancels(cancelled)
+        count = len(cancelled)
+    elif shards:
+        count = await shards.request(message.chat.id, {
+            "op": "cancel_chat", "chat_id": message.chat.id, "user_id": message.from_user.id
+        })
+    else:
+        count = cancel_jobs(message.chat.id, message.from_user.id)
+    if not count:
+        return await submit(message.chat.id, message.reply_text, "📭 **Nothing to cancel**")
+    await submit(message.chat.id, message.reply_text, f"🛑 **Cancelled {count} download{'s' if count > 1 else ''}**")
+
+@app.on_callback_query(filters.regex(r"^cancel_(\w+)$"))
+async def cancel_callback(client: Client, callback_query):
+    """Cancel button on status messages"""
+    job_id = callback_query.data.split("_", 1)[1]
+    if config.JOB_QUEUE:
+        cancelled = await job_queue.cancel(callback_query.from_user.id, job_id=job_id)
+        await _finish_queued_cancels(cancelled)
+    elif shards:
+        cancelled = await shards.request(callback_query.message.chat.id, {
+            "op": "cancel", "job_id": job_id, "user_id": callback_query.from_user.id
+        })
+    else:
+        cancelled = cancel_job(job_id, callback_query.from_user.id)
+    if cancelled:
+        await callback_query.answer("Cancelling...")
+    else:
+        await callback_query.answer("This download has finished or was started by someone else.", show_alert=True)
 
 @app.on_message(filters.command("search"))
+@tracing.traced_update("search")
 async def search_command(client: Client, message: Message):
     """Search YouTube and show results"""
     if len(message.command) < 2:
-        return await message.reply_text("❌ Please provide a search query!\n\nExample: `/search Despacito`")
+        return await submit(message.chat.id, message.reply_text, "❌ Please provide a search query!\n\nExample: `/search Despacito`")
     
     query = " ".join(message.command[1:])
-    status_msg = await message.reply_text("🔍 **Searching YouTube...**")
+    status_msg = await submit(message.chat.id, message.reply_text, "🔍 **Searching YouTube...**")
     
     try:
         search_results = await youtube.search(query, limit=10)
         
         if not search_results:
-            return await status_msg.edit_text("❌ No results found for your search.")
+            return await submit(status_msg.chat.id, status_msg.edit_text, "❌ No results found for your search.")
         
         # Create results text
         results_text = f"🎵 **Search Results for:** `{query}`\n\n"
@@ -294,17 +792,158 @@ async def search_command(client: Client, message: Message):
             results_text += f"   ⏱ {result['duration']} | 👁 {result['views']}\n"
             results_text += f"   📺 {result['channel']}\n\n"
             
+            details = buttons.track_details(result)
             keyboard_buttons.append([
-                InlineKeyboardButton(f"🎵 Download Audio #{i}", callback_data=f"download_audio_{result['id']}"),
-                InlineKeyboardButton(f"📹 Download Video #{i}", callback_data=f"download_video_{result['id']}")
+                InlineKeyboardButton(f"🎵 Download Audio #{i}", callback_data=buttons.register(result['id'], "audio", details)),
+                InlineKeyboardButton(f"📹 Download Video #{i}", callback_data=buttons.register(result['id'], "video", details))
+            ])
+            keyboard_buttons.append([
+                InlineKeyboardButton(f"🎧 Preview #{i}", callback_data=buttons.register(result['id'], "preview", details))
             ])
         
         keyboard = InlineKeyboardMarkup(keyboard_buttons)
-        await status_msg.edit_text(results_text, reply_markup=keyboard)
+        await submit(status_msg.chat.id, status_msg.edit_text, results_text, reply_markup=keyboard)
         
     except Exception as e:
         logger.error(f"Search error: {e}")
-        await status_msg.edit_text(f"❌ **Search failed:** {str(e)}")
+        await submit(status_msg.chat.id, status_msg.edit_text, f"❌ **Search failed:** {str(e)}")
+
+@app.on_message(filters.command("preview"))
+@tracing.traced_update("preview")
+async def preview_command(client: Client, message: Message):
+    """Send a short preview clip of a track"""
+    if len(message.command) < 2:
+        return await submit(message.chat.id, message.reply_text, "❌ Please provide a song name or YouTube URL!\n\nExample: `/preview Despacito`")
+    
+    query = " ".join(message.command[1:])
+    status_msg = await submit(message.chat.id, message.reply_text, "🎧 **Preparing preview...**")
+    
+    try:
+        if await youtube.exists(query):
+            track_info, video_id = await youtube.track(query)
+            title, duration = track_info['title'], track_info['duration_min']
+        else:
+            search_results = await youtube.search(query, limit=1)
+            if not search_results:
+                return await submit(status_msg.chat.id, status_msg.edit_text, "❌ No results found for your search.")
+            video_id = search_results[0]['id']
+            title, duration = search_results[0]['title'], search_results[0]['duration']
+        
+        if not await send_preview(client, message, video_id, title, duration):
+            return await submit(status_msg.chat.id, status_msg.edit_text, "❌ **Preview failed!**")
+        await submit(status_msg.chat.id, status_msg.delete, priority=PRIORITY_STATUS)
+    
+    except Exception as e:
+        logger.error(f"Preview error: {e}")
+        await submit(status_msg.chat.id, status_msg.edit_text, f"❌ **Preview failed:** {str(e)}")
+
+@app.on_callback_query(filters.regex(r"preview_(.+)"))
+@tracing.traced_update("preview_button")
+async def preview_callback(client: Client, callback_query):
+    """Send a preview clip for a search result"""
+    video_id = callback_query.data.split("_", 1)[1]
+    
+    try:
+        await callback_query.answer("Preparing preview...")
+        
+        track = await search_index.get_track(video_id)
+        if track:
+            title, duration = track['title'], track['duration']
+        else:
+            track_info, video_id = await youtube.track(video_id, videoid=True)
+            title, duration = track_info['title'], track_info['duration_min']
+        
+        if not await send_preview(client, callback_query.message, video_id, title, duration):
+            await submit(callback_query.message.chat.id, callback_query.message.reply_text, "❌ **Preview failed!**")
+        
+    except Exception as e:
+        logger.error(f"Preview error: {e}")
+        await submit(callback_query.message.chat.id, callback_query.message.reply_text, f"❌ **Preview failed:** {str(e)}")
+
+async def send_preview(client: Client, message: Message, video_id: str, title: str, duration: str) -> bool:
+    """Cut (or reuse) a preview clip and send it as a voice note"""
+    path = cached_preview(video_id)
+    if not path:
+        stream_url = await youtube.get_stream_url(youtube.base + video_id)
+        if not stream_url:
+            return False
+        with tracing.span("preview.cut", video_id=video_id):
+            path = await make_preview(video_id, stream_url, time_to_seconds(str(duration)))
+        if not path:
+            return False
+    
+    await submit(
+        message.chat.id,
+        client.send_voice,
+        message.chat.id,
+        path,
+        priority=PRIORITY_MEDIA,
+        caption=f"🎧 **Preview:** {title}",
+        reply_to_message_id=message.id
+    )
+    return True
+
+@app.on_message(filters.command("stream"))
+@tracing.traced_update("stream")
+async def stream_command(client: Client, message: Message):
+    """Stream a track into the group voice chat"""
+    chat_id = message.chat.id
+    if len(message.command) < 2:
+        return await submit(chat_id, message.reply_text, "❌ Please provide a song name or YouTube URL!\n\nExample: `/stream Despacito`")
+    
+    async def notify(text: str):
+        await submit(chat_id, client.send_message, chat_id, text)
+    
+    player = get_player(chat_id, notify)
+    if player is None:
+        return await submit(chat_id, message.reply_text, "❌ **Voice chat streaming is not available.** It needs a user session (`STRING_SESSION`).")
+    
+    query = " ".join(message.command[1:])
+    status_msg = await submit(chat_id, message.reply_text, "🔍 **Searching for music...**")
+    
+    try:
+        if await youtube.exists(query):
+            track_info, video_id = await youtube.track(query)
+            title, duration = track_info['title'], track_info['duration_min']
+        else:
+            search_results = await youtube.search(query, limit=1)
+            if not search_results:
+                return await submit(status_msg.chat.id, status_msg.edit_text, "❌ No results found for your search.")
+            video_id = search_results[0]['id']
+            title, duration = search_results[0]['title'], search_results[0]['duration']
+        
+        user_id = message.from_user.id if message.from_user else None
+        position = player.enqueue(Track(video_id, title, duration, requested_by=user_id))
+        if position == 0:
+            await submit(status_msg.chat.id, status_msg.edit_text, f"▶️ **Starting stream:** {title}\n⏱️ **Duration:** {duration}")
+        else:
+            await submit(status_msg.chat.id, status_msg.edit_text, f"➕ **Queued at #{position}:** {title}")
+        if user_id:
+            await record_play(chat_id, user_id, {'vidid': video_id, 'title': title, 'duration_min': duration})
+    
+    except Exception as e:
+        logger.error(f"Stream command error: {e}")
+        await submit(status_msg.chat.id, status_msg.edit_text, f"❌ **Error:** {str(e)}")
+
+@app.on_message(filters.command("skip"))
+async def skip_command(client: Client, message: Message):
+    """Skip the track playing in the voice chat"""
+    player = players.get(message.chat.id)
+    if player is None or player.now_playing is None:
+        return await submit(message.chat.id, message.reply_text, "📭 **Nothing is streaming**")
+    
+    player.skip()
+    await submit(message.chat.id, message.reply_text, f"⏭️ **Skipped:** {player.now_playing.title}")
+
+@app.on_message(filters.command("stop"))
+async def stop_command(client: Client, message: Message):
+    """Stop streaming and leave the voice chat"""
+    player = players.get(message.chat.id)
+    if player is None:
+        return await submit(message.chat.id, message.reply_text, "📭 **Nothing is streaming**")
+    
+    await player.stop()
+    await submit(message.chat.id, message.reply_text, "⏹️ **Stopped streaming**")
 
 @app.on_message(filters.command("queue"))
 async def queue_command(client: Client, message: Message):
@@ -320,7 +959,42 @@ async def queue_command(client: Client, message: Message):
     else:
         queue_text += "📭 **No downloads in queue**"
     
-    await message.reply_text(queue_text)
+    await submit(message.chat.id, message.reply_text, queue_text)
+
+@app.on_message(filters.command("stats"))
+async def stats_command(client: Client, message: Message):
+    """Show listening stats for the user"""
+    if not message.from_user:
+        return
+    
+    stats = await get_user_stats(message.from_user.id)
+    await submit(message.chat.id, message.reply_text,
+        f"📊 **Stats for {message.from_user.first_name}:**\n\n"
+        f"🎵 Songs played: {stats['songs_played']}\n"
+        f"⏱ Time listened: {format_duration(stats['time_listened'])}"
+    )
+
+@app.on_message(filters.command("top"))
+async def top_command(client: Client, message: Message):
+    """Show the most played tracks in this chat, or globally trending ones"""
+    if len(message.command) > 1 and message.command[1].lower() == "global":
+        tracks = get_trending()
+        top_text = "🔥 **Trending Tracks:**\n\n"
+    else:
+        tracks = await get_top_tracks(message.chat.id)
+        top_text = "🏆 **Top Tracks in this Chat:**\n\n"
+    
+    if not tracks:
+        return await submit(message.chat.id, message.reply_text, "📭 **Nothing has been played yet**")
+    
+    for i, track in enumerate(tracks, 1):
+        title = track['title'] or track['vidid']
+        top_text += f"{i}. {title[:40]}{'...' if len(title) > 40 else ''}"
+        if 'plays' in track:
+            top_text += f" ({track['plays']} plays)"
+        top_text += "\n"
+    
+    await submit(message.chat.id, message.reply_text, top_text)
 
 @app.on_message(filters.command("help"))
 async def help_command(client: Client, message: Message):
@@ -333,41 +1007,54 @@ async def help_command(client: Client, message: Message):
 • `/play [YouTube URL]` - Download from YouTube link
 • `/video [YouTube URL]` - Download and send video
 • `/search [query]` - Search YouTube and download
+• `/preview [song name or URL]` - Hear a 30 second clip first
+• `/cancel` - Cancel your running downloads
+
+**Voice Chat:**
+• `/stream [song name or URL]` - Play in the group voice chat
+• `/skip` - Skip the current track
+• `/stop` - Stop streaming and clear the queue
 
 **Queue Management:**
 • `/queue` - Show download queue status
 • `/formats [URL]` - Show available download formats
 
+**Stats:**
+• `/stats` - Show your listening stats
+• `/top` - Most played tracks in this chat
+• `/top global` - Trending tracks everywhere
+
 **How to use:**
 1. Add me to your group
 2. Use `/play [song name]` to download music
 3. Use `/video [URL]` for video downloads
 4. Use `/search [query]` to find and download music
+5. Type `@bot song name` in any chat to share tracks inline
 
-**Note:** I download and send files directly to the chat. For voice chat streaming, you need additional setup with voice chat permissions.
+**Note:** Voice chat streaming needs the bot to run on a user session (`STRING_SESSION`) with permission to join voice chats.
 
 **Support:** Forward this message to @your_support_username
 """
-    await message.reply_text(help_text)
+    await submit(message.chat.id, message.reply_text, help_text)
 
 @app.on_message(filters.command("formats"))
 async def formats_command(client: Client, message: Message):
     """Show available download formats"""
     if len(message.command) < 2:
-        return await message.reply_text("❌ Please provide a YouTube URL!\n\nExample: `/formats https://youtube.com/watch?v=...`")
+        return await submit(message.chat.id, message.reply_text, "❌ Please provide a YouTube URL!\n\nExample: `/formats https://youtube.com/watch?v=...`")
     
     url = message.command[1]
     
     if not await youtube.exists(url):
-        return await message.reply_text("❌ Please provide a valid YouTube URL!")
+        return await submit(message.chat.id, message.reply_text, "❌ Please provide a valid YouTube URL!")
     
-    status_msg = await message.reply_text("🔍 **Getting available formats...**")
+    status_msg = await submit(message.chat.id, message.reply_text, "🔍 **Getting available formats...**")
     
     try:
         formats, link = await youtube.formats(url)
         
         if not formats:
-            return await status_msg.edit_text("❌ No formats available for this video.")
+            return await submit(status_msg.chat.id, status_msg.edit_text, "❌ No formats available for this video.")
         
         format_text = f"📋 **Available Formats:**\n\n"
         
@@ -376,59 +1063,205 @@ async def formats_command(client: Client, message: Message):
             format_text += f"{i}. **{fmt['format_note']}** ({fmt['ext']})\n"
             format_text += f"   📊 Size: {size_mb:.1f} MB\n\n"
         
-        await status_msg.edit_text(format_text)
+        await submit(status_msg.chat.id, status_msg.edit_text, format_text)
         
     except Exception as e:
         logger.error(f"Formats error: {e}")
-        await status_msg.edit_text(f"❌ **Error:** {str(e)}")
+        await submit(status_msg.chat.id, status_msg.edit_text, f"❌ **Error:** {str(e)}")
 
 @app.on_message(filters.regex(r"(https?://)?(www\.)?(youtube\.com|youtu\.be)"))
+@tracing.traced_update("youtube_link")
 async def auto_download_handler(client: Client, message: Message):
     """Auto-download when YouTube link is sent"""
-    url = message.text
+    video_id = extract_video_id(message.text or "")
     
-    if not await youtube.exists(url):
+    if not video_id:
         return
     
     keyboard = InlineKeyboardMarkup([
         [
-            InlineKeyboardButton("🎵 Download Audio", callback_data=f"quick_audio_{url}"),
-            InlineKeyboardButton("📹 Download Video", callback_data=f"quick_video_{url}")
+            InlineKeyboardButton("🎵 Download Audio", callback_data=buttons.register(video_id, "audio")),
+            InlineKeyboardButton("📹 Download Video", callback_data=buttons.register(video_id, "video"))
         ]
     ])
     
-    await message.reply_text(
+    await submit(message.chat.id, message.reply_text,
         "🎵 **YouTube link detected!**\n\nWhat would you like to download?",
         reply_markup=keyboard
     )
 
 @app.on_callback_query(filters.regex(r"quick_(audio|video)_(.+)"))
+@tracing.traced_update("quick_download")
 async def quick_download_callback(client: Client, callback_query):
     """Handle quick download buttons"""
     parts = callback_query.data.split("_", 2)
     download_type = parts[1]  # audio or video
-    url = parts[2]
+    url = canonical_url(parts[2]) or WATCH_URL + parts[2]  # older buttons carry the full link
     
     try:
         await callback_query.answer(f"Downloading {download_type}...")
         
         if download_type == "audio":
-            await download_and_send_audio(client, callback_query.message, url, callback_query.message)
+            await download_and_send_audio(client, callback_query.message, url, callback_query.message,
+                                          user_id=callback_query.from_user.id)
         else:
-            await download_and_send_video(client, callback_query.message, url, callback_query.message)
+            await download_and_send_video(client, callback_query.message, url, callback_query.message,
+                                          user_id=callback_query.from_user.id)
             
     except Exception as e:
         logger.error(f"Quick download error: {e}")
-        await callback_query.message.edit_text(f"❌ **Error:** {str(e)}")
+        await submit(callback_query.message.chat.id, callback_query.message.edit_text, f"❌ **Error:** {str(e)}")
+
+@app.on_inline_query()
+@tracing.traced_update("inline_query")
+async def inline_query_handler(client: Client, inline_query: InlineQuery):
+    """Answer inline queries from the local search index and file_id cache"""
+    query = inline_query.query.strip()
+    
+    try:
+        if query:
+            tracks = await asyncio.wait_for(
+                search_index.fuzzy_lookup(query, limit=config.INLINE_RESULTS),
+                timeout=config.INLINE_TIMEOUT
+            )
+        else:
+            tracks = [
+                {'id': track['vidid'], 'title': track['title'] or track['vidid']}
+                for track in get_trending(config.INLINE_RESULTS)
+            ]
+    except asyncio.TimeoutError:
+        logger.warning(f"Inline query timed out: {query}")
+        tracks = []
+    
+    results = []
+    for track in tracks:
+        file_id = await get_file_id(track['id'], "audio")
+        if file_id:
+            results.append(InlineQueryResultCachedAudio(
+                audio_file_id=file_id,
+                id=track['id'],
+                caption=f"🎵 **{track['title']}**"
+            ))
+        else:
+            url = WATCH_URL + track['id']
+            details = [value for value in (track.get('duration'), track.get('channel')) if value]
+            results.append(InlineQueryResultArticle(
+                title=track['title'],
+                input_message_content=InputTextMessageContent(url),
+                id=track['id'],
+                url=url,
+                description=" | ".join(details) or None,
+                thumb_url=track.get('thumbnail')
+            ))
+    
+    await inline_query.answer(results, cache_time=config.INLINE_CACHE_TIME)
+
+async def handle_shard_message(job: dict):
+    """Run a message from the front process (shard worker side)"""
+    op = job["op"]
+    if op == "cancel":
+        return cancel_job(job["job_id"], job["user_id"]) is not None
+    if op == "cancel_chat":
+        return cancel_jobs(job["chat_id"], job["user_id"])
+    if op == "download":
+        with tracing.resume(job.get("trace"), "shard_job", worker=WORKER_ID, chat_id=job["chat_id"]):
+            ids = list({job["message_id"], job["status_id"]})
+            messages = {message.id: message for message in await app.get_messages(job["chat_id"], ids)}
+            send = download_and_send_video if job["kind"] == "video" else download_and_send_audio
+            await send(app, messages[job["message_id"]], job["url"], messages[job["status_id"]],
+                       user_id=job["user_id"], track_info=job["track"])
+
+async def run_queued_job(job) -> str:
+    """Run one durable download job (queue consumer side)"""
+    with tracing.resume(job.data.get("trace"), "queued_job", job_id=job.id, attempt=job.attempts,
+                        resumed_after=job.stage, chat_id=job.chat_id):
+        ids = list({job.message_id, job.status_id})
+        messages = {message.id: message for message in await app.get_messages(job.chat_id, ids)}
+        message, status_msg = messages[job.message_id], messages[job.status_id]
+        track_info = job.data.get("track")
+        if job.kind == "video":
+            label, handler = "Video download", _download_and_send_video
+        else:
+            label, handler = "Download", _download_and_send_audio
+        return await _run_download_job(
+            message, status_msg, job.user_id, job.kind, label,
+            lambda status: handler(app, message, job.url, status, job.user_id, track_info, job),
+            job_id=job.id
+        )
+
+async def give_up_queued_job(job):
+    """Tell the user about a queue job that failed too often"""
+    await refund(Charge(rows=tuple(job.data.get("charge") or ())))
+    await submit(job.chat_id, app.edit_message_text, job.chat_id, job.status_id, "❌ **Download failed!**")
+
+async def on_shard_event(event: dict):
+    """Handle an event sent by a shard worker (front process side)"""
+    if event["op"] == "played":
+        await record_play(event["chat_id"], event["user_id"], event["track"])
+    elif event["op"] == "foreground":
+        report_foreground(event["worker"], event["jobs"])
+
+async def on_shard_lost(job: dict):
+    """A shard worker died with this job unfinished (front process side)"""
+    if job["op"] == "download":
+        await submit(job["chat_id"], app.edit_message_text, job["chat_id"], job["status_id"],
+                     "❌ **Download failed:** it was interrupted, please try again")
+
+async def run_worker():
+    """Shard worker: run the download jobs the front process hands over"""
+    # Telegram's global send limit is per bot, so every process takes a share
+    share_global_rate(config.SHARD_WORKERS + 1)
+    await app.start()
+    logger.info(f"🎵 Shard worker {WORKER_ID} started")
+    if sharding.has_front():
+        # The cache warmer runs in the front process and waits for our jobs
+        forward_foreground(lambda jobs: sharding.emit({"op": "foreground", "worker": WORKER_ID, "jobs": jobs}))
+    # Plays are recorded elsewhere, so the trending set (which decides what
+    # stays on disk) has to be reloaded now and then
+    refresher = asyncio.create_task(run_trending_refresher())
+    consumer = asyncio.create_task(job_queue.consume(run_queued_job, give_up_queued_job)) if config.JOB_QUEUE else None
+    try:
+        if sharding.has_front():
+            await sharding.serve(handle_shard_message)
+        else:
+            # Started on its own: only serves the job queue
+            await consumer
+    finally:
+        for task in (consumer, refresher):
+            if task:
+                task.cancel()
+                await asyncio.gather(task, return_exceptions=True)
 
 async def main():
     """Main function to start the bot"""
+    global shards
+    if WORKER_ID is not None and not sharding.has_front() and not config.JOB_QUEUE:
+        # Started on its own, a worker has nothing but the job queue to serve
+        raise SystemExit("❌ A standalone worker needs JOB_QUEUE=true")
+    consumer = None
+    warmer_task = None
     try:
         # Initialize database
         await init_db()
+        await init_analytics()
+        tracing.init_tracing()
+        if WORKER_ID is not None:
+            return await run_worker()
+        warmer_task = asyncio.create_task(run_warmer())
         
-        # Start the bot
-        await app.start()
+        # Start the bot (PyTgCalls starts the client itself)
+        if calls:
+            await calls.start()
+        else:
+            await app.start()
+        if config.SHARD_WORKERS > 0:
+            share_global_rate(config.SHARD_WORKERS + 1)
+            shards = sharding.ShardPool([sys.executable, *sys.argv], config.SHARD_WORKERS, on_shard_event,
+                                        on_shard_lost)
+            await shards.start()
+        elif config.JOB_QUEUE:
+            # No workers: the front process consumes the queue itself
+            consumer = asyncio.create_task(job_queue.consume(run_queued_job, give_up_queued_job))
         logger.info("🎵 Music Bot started successfully!")
         
         print("🎵 Telegram Music Bot is running!")
@@ -445,7 +1278,17 @@ async def main():
     except Exception as e:
         logger.error(f"Bot startup error: {e}")
     finally:
+        for task in (warmer_task, consumer):
+            if task:
+                task.cancel()
+                await asyncio.gather(task, return_exceptions=True)
+        if shards:
+            await shards.stop()
+        for player in list(players.values()):
+            await player.stop()
         await app.stop()
+        await tracing.close_tracing()
+        await close_db()
 
 if __name__ == "__main__":
     asyncio.run(main())
\ No newline at end of file
@@ -0,0 +1,72 @@
+import re
+import time
+from collections import OrderedDict
+from typing import Any, Dict, NamedTuple, Optional, Tuple
+
+import config
+from .links import WATCH_URL
+
+# Compact callback data for inline buttons. Telegram caps callback data at
+# 64 bytes, so a button carries only a mode letter and the video ID
+# ("tk_a<video_id>"), never a full link. The metadata already known when
+# the button was drawn (e.g. from search results) is kept here for a
+# while, so a tap can usually start the download without looking the
+# track up again; without it (say, after a restart) the button still
+# works and the track is looked up.
+
+PREFIX = "tk_"
+MODES = ("audio", "video", "preview")
+_LETTERS = {mode: mode[0] for mode in MODES}
+_MODES_BY_LETTER = {letter: mode for mode, letter in _LETTERS.items()}
+_VIDEO_ID = re.compile(r"[\w-]{11}")
+
+
+class Button(NamedTuple):
+    video_id: str
+    mode: str
+    track: Optional[Dict[str, Any]]  # youtube.track() details, if known
+
+
+# video_id -> (expires_at, details); every entry has the same TTL, so the
+# oldest one is always first
+_tracks: "OrderedDict[str, Tuple[float, Dict[str, Any]]]" = OrderedDict()
+
+
+def track_details(result: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+    """youtube.track()-style details from a search result, if complete"""
+    if not (result.get('title') and result.get('duration') and result.get('thumbnail')):
+        return None
+    return {
+        "title": result['title'],
+        "link": WATCH_URL + result['id'],
+        "vidid": result['id'],
+        "duration_min": result['duration'],
+        "thumb": result['thumbnail'],
+    }
+
+
+def register(video_id: str, mode: str, track: Optional[Dict[str, Any]] = None) -> str:
+    """Callback data for a button that acts on `video_id`"""
+    if mode not in MODES:
+        raise ValueError(f"Unknown button mode: {mode}")
+    if track:
+        now = time.monotonic()
+        while _tracks and (
+            len(_tracks) >= config.BUTTON_MAX_TOKENS or next(iter(_tracks.values()))[0] <= now
+        ):
+            _tracks.popitem(last=False)
+        _tracks.pop(video_id, None)
+        _tracks[video_id] = (now + config.BUTTON_TOKEN_TTL, track)
+    return PREFIX + _LETTERS[mode] + video_id
+
+
+def resolve(data: str) -> Optional[Button]:
+    """The button behind some callback data, or None if it isn't one of ours"""
+    body = data[len(PREFIX):] if data.startswith(PREFIX) else ""
+    mode, video_id = _MODES_BY_LETTER.get(body[:1]), body[1:]
+    if mode is None or not _VIDEO_ID.fullmatch(video_id):
+        # e.g. a random token from before buttons carried the video ID
+        return None
+    entry = _tracks.get(video_id)
+    track = entry[1] if entry and entry[0] > time.monotonic() else None
+    return Button(video_id, mode, track)
@@ -16,3 +16,139 @@ SECRET_KEY = os.getenv("SECRET_KEY", "your-secret-key-here")
 
 # YouTube API Configuration (if using official YouTube API)
 YOUTUBE_API_KEY = os.getenv("YOUTUBE_API_KEY", None)
+
+# Storage Configuration
+DB_PATH = os.getenv("DB_PATH", "musicbot.db")
+DB_FLUSH_INTERVAL = float(os.getenv("DB_FLUSH_INTERVAL", "0.5"))  # seconds
+DB_BATCH_SIZE = int(os.getenv("DB_BATCH_SIZE", "500"))
+
+# Analytics Configuration
+TOP_TRACKS_SIZE = int(os.getenv("TOP_TRACKS_SIZE", "10"))
+TRENDING_HALF_LIFE = float(os.getenv("TRENDING_HALF_LIFE", "86400"))  # seconds
+TRENDING_MAX_TRACKED = int(os.getenv("TRENDING_MAX_TRACKED", "50000"))
+TRENDING_REFRESH_INTERVAL = float(os.getenv("TRENDING_REFRESH_INTERVAL", "60"))  # seconds, shard workers
+CHAT_TOP_MAX_CHATS = int(os.getenv("CHAT_TOP_MAX_CHATS", "10000"))  # chats whose counters stay in memory
+CHAT_TOP_MAX_TRACKED = int(os.getenv("CHAT_TOP_MAX_TRACKED", "1000"))  # tracks counted in memory per chat
+
+# Cache Warming Configuration
+WARM_TOP_N = int(os.getenv("WARM_TOP_N", "10"))
+WARM_INTERVAL = float(os.getenv("WARM_INTERVAL", "600"))  # seconds between passes
+WARM_IDLE_SECONDS = float(os.getenv("WARM_IDLE_SECONDS", "30"))
+WARM_BUDGET_MB = int(os.getenv("WARM_BUDGET_MB", "500"))  # per hour
+
+# Local Search Index Configuration
+SEARCH_QUERY_TTL = float(os.getenv("SEARCH_QUERY_TTL", "604800"))  # seconds
+SEARCH_LOCAL_MIN_RESULTS = int(os.getenv("SEARCH_LOCAL_MIN_RESULTS", "3"))
+SEARCH_LOCAL_MIN_SCORE = float(os.getenv("SEARCH_LOCAL_MIN_SCORE", "1.0"))  # bm25 per query word a local result needs
+
+# Inline Mode Configuration
+INLINE_RESULTS = int(os.getenv("INLINE_RESULTS", "20"))
+INLINE_TIMEOUT = float(os.getenv("INLINE_TIMEOUT", "0.1"))  # seconds
+INLINE_CACHE_TIME = int(os.getenv("INLINE_CACHE_TIME", "300"))
+
+# Thumbnail Configuration
+THUMB_WORKERS = int(os.getenv("THUMB_WORKERS", "2"))
+THUMB_CACHE_MAX = int(os.getenv("THUMB_CACHE_MAX", "2000"))  # files
+THUMB_TIMEOUT = float(os.getenv("THUMB_TIMEOUT", "10"))  # seconds
+THUMB_WAIT = float(os.getenv("THUMB_WAIT", "0.5"))  # max extra wait before upload
+
+# Status Message Configuration
+STATUS_EDIT_INTERVAL = float(os.getenv("STATUS_EDIT_INTERVAL", "3"))  # seconds between edits per chat
+
+# Outbound Telegram Rate Limits (requests per second)
+OUTBOUND_GLOBAL_RATE = float(os.getenv("OUTBOUND_GLOBAL_RATE", "30"))
+OUTBOUND_PRIVATE_RATE = float(os.getenv("OUTBOUND_PRIVATE_RATE", "1"))
+OUTBOUND_PRIVATE_BURST = float(os.getenv("OUTBOUND_PRIVATE_BURST", "3"))
+OUTBOUND_GROUP_RATE = float(os.getenv("OUTBOUND_GROUP_RATE", str(20 / 60)))
+OUTBOUND_GROUP_BURST = float(os.getenv("OUTBOUND_GROUP_BURST", "5"))
+OUTBOUND_MAX_RETRIES = int(os.getenv("OUTBOUND_MAX_RETRIES", "3"))
+
+# Upload Configuration
+UPLOAD_SESSIONS_BOT = int(os.getenv("UPLOAD_SESSIONS_BOT", "4"))
+UPLOAD_SESSIONS_USER = int(os.getenv("UPLOAD_SESSIONS_USER", "2"))
+UPLOAD_WORKERS = int(os.getenv("UPLOAD_WORKERS", "2"))  # concurrent parts per session
+UPLOAD_PARALLEL_MIN = int(os.getenv("UPLOAD_PARALLEL_MIN", str(10 * 1024 * 1024)))  # bytes
+UPLOAD_PART_RETRIES = int(os.getenv("UPLOAD_PART_RETRIES", "3"))
+PIPELINE_UPLOAD = os.getenv("PIPELINE_UPLOAD", "true").lower() == "true"  # upload while downloading
+PIPELINE_BUFFER_PARTS = int(os.getenv("PIPELINE_BUFFER_PARTS", "16"))  # 512 KiB parts held in memory
+
+# Transcoding Configuration
+TRANSCODE_WORKERS = int(os.getenv("TRANSCODE_WORKERS", "0"))  # 0 = half the CPU cores
+TRANSCODE_TIMEOUT = float(os.getenv("TRANSCODE_TIMEOUT", "600"))  # seconds
+TRANSCODE_NICE = int(os.getenv("TRANSCODE_NICE", "10"))
+
+# Preview Configuration
+PREVIEW_LENGTH = int(os.getenv("PREVIEW_LENGTH", "30"))  # seconds
+PREVIEW_OFFSET = int(os.getenv("PREVIEW_OFFSET", "45"))  # seconds into the track
+PREVIEW_TIMEOUT = float(os.getenv("PREVIEW_TIMEOUT", "60"))  # seconds
+
+# Voice Chat Streaming Configuration
+STREAM_SINK = os.getenv("STREAM_SINK", "tgcalls")  # tgcalls (needs STRING_SESSION) or file
+STREAM_FILE_PATH = os.getenv("STREAM_FILE_PATH", "downloads/stream/{chat_id}.pcm")  # file sink target, may be a FIFO
+STREAM_BUFFER_MS = int(os.getenv("STREAM_BUFFER_MS", "3000"))  # jitter buffer size
+STREAM_PREBUFFER_MS = int(os.getenv("STREAM_PREBUFFER_MS", "500"))  # buffered before playback starts
+STREAM_QUEUE_MAX = int(os.getenv("STREAM_QUEUE_MAX", "50"))
+
+# Job Cancellation and Timeouts (seconds)
+JOB_TIMEOUT = float(os.getenv("JOB_TIMEOUT", "1800"))  # hard cap for one download + upload job
+RESOLVE_TIMEOUT = float(os.getenv("RESOLVE_TIMEOUT", "30"))  # metadata lookups, yt-dlp -g and extractions
+DOWNLOAD_STALL_TIMEOUT = float(os.getenv("DOWNLOAD_STALL_TIMEOUT", "60"))  # no bytes received
+UPLOAD_TIMEOUT = float(os.getenv("UPLOAD_TIMEOUT", "900"))
+
+# Admission Control (sizes in MB, 0 = unlimited)
+MAX_FILE_SIZE_MB = int(os.getenv("MAX_FILE_SIZE_MB", "250"))
+USER_QUOTA_MB = int(os.getenv("USER_QUOTA_MB", "2000"))  # per QUOTA_WINDOW
+CHAT_QUOTA_MB = int(os.getenv("CHAT_QUOTA_MB", "10000"))  # per QUOTA_WINDOW
+QUOTA_WINDOW = float(os.getenv("QUOTA_WINDOW", "86400"))  # seconds
+STREAM_URL_TTL = float(os.getenv("STREAM_URL_TTL", "1800"))  # seconds a resolved stream URL is reused
+
+# Rate Limiting Configuration
+RATE_WINDOW = float(os.getenv("RATE_WINDOW", "60"))  # seconds
+RATE_USER_LIMIT = float(os.getenv("RATE_USER_LIMIT", "10"))  # weight per window
+RATE_CHAT_LIMIT = float(os.getenv("RATE_CHAT_LIMIT", "30"))  # weight per window
+RATE_WEIGHT_AUDIO = float(os.getenv("RATE_WEIGHT_AUDIO", "1"))
+RATE_WEIGHT_VIDEO = float(os.getenv("RATE_WEIGHT_VIDEO", "3"))
+RATE_MAX_TRACKED = int(os.getenv("RATE_MAX_TRACKED", "10000"))  # users + chats kept in memory
+RATE_USER_CONCURRENT = int(os.getenv("RATE_USER_CONCURRENT", "2"))  # running or queued jobs per user
+RATE_MAX_ACTIVE = int(os.getenv("RATE_MAX_ACTIVE", "8"))  # running jobs overall
+RATE_MAX_QUEUED = int(os.getenv("RATE_MAX_QUEUED", "20"))  # jobs waiting for a slot
+
+# Adaptive Video Quality Configuration
+VIDEO_TARGET_SECONDS = float(os.getenv("VIDEO_TARGET_SECONDS", "120"))  # download + upload budget per video
+DOWNLOAD_RATE_PRIOR = float(os.getenv("DOWNLOAD_RATE_PRIOR", str(4 * 1024 * 1024)))  # bytes/s before any measurement
+UPLOAD_RATE_PRIOR = float(os.getenv("UPLOAD_RATE_PRIOR", str(1024 * 1024)))  # bytes/s before any measurement
+TRANSCODE_RATE_PRIOR = float(os.getenv("TRANSCODE_RATE_PRIOR", str(1024 * 1024)))  # source bytes/s scaled down
+THROUGHPUT_ALPHA = float(os.getenv("THROUGHPUT_ALPHA", "0.3"))  # weight of the newest measurement
+
+# Negative Cache TTLs (seconds)
+NEGATIVE_TTL_PERMANENT = float(os.getenv("NEGATIVE_TTL_PERMANENT", str(7 * 86400)))  # removed, private
+NEGATIVE_TTL_BLOCKED = float(os.getenv("NEGATIVE_TTL_BLOCKED", "86400"))  # region or age blocked
+NEGATIVE_TTL_MISSING = float(os.getenv("NEGATIVE_TTL_MISSING", "3600"))  # not found
+NEGATIVE_TTL_TRANSIENT = float(os.getenv("NEGATIVE_TTL_TRANSIENT", "60"))  # still processing, live
+
+# Inline Button Tokens
+BUTTON_TOKEN_TTL = float(os.getenv("BUTTON_TOKEN_TTL", "86400"))  # seconds track details behind a button are kept
+BUTTON_MAX_TOKENS = int(os.getenv("BUTTON_MAX_TOKENS", "50000"))  # track details kept in memory
+
+# Sharding (multi-process mode)
+SHARD_WORKERS = int(os.getenv("SHARD_WORKERS", "0"))  # download worker processes, 0 = single process
+
+# Durable Job Queue
+JOB_QUEUE = os.getenv("JOB_QUEUE", "false").lower() == "true"  # run downloads through the queue
+JOBQ_LEASE = float(os.getenv("JOBQ_LEASE", "60"))  # seconds a worker holds a job without renewing
+JOBQ_HEARTBEAT = float(os.getenv("JOBQ_HEARTBEAT", "2"))  # seconds between lease renewals
+JOBQ_POLL_INTERVAL = float(os.getenv("JOBQ_POLL_INTERVAL", "1"))  # seconds between polls of an empty queue
+JOBQ_MAX_ATTEMPTS = int(os.getenv("JOBQ_MAX_ATTEMPTS", "3"))
+JOBQ_RETRY_DELAY = float(os.getenv("JOBQ_RETRY_DELAY", "10"))  # seconds, doubled per attempt
+JOBQ_RETENTION = float(os.getenv("JOBQ_RETENTION", "86400"))  # seconds finished jobs are kept
+
+# Download File Writes
+WRITER_THREADS = int(os.getenv("WRITER_THREADS", "2"))  # threads doing disk writes for downloads
+DOWNLOAD_FSYNC = os.getenv("DOWNLOAD_FSYNC", "false").lower() == "true"  # fsync files before publishing them
+
+# Request Tracing
+TRACING = os.getenv("TRACING", "false").lower() == "true"
+TRACE_FILE = os.getenv("TRACE_FILE", "traces.jsonl")  # OTLP/JSON lines
+TRACE_SERVICE_NAME = os.getenv("TRACE_SERVICE_NAME", "musicbot")
+TRACE_FLUSH_INTERVAL = float(os.getenv("TRACE_FLUSH_INTERVAL", "5"))  # seconds
+TRACE_MAX_PENDING = int(os.getenv("TRACE_MAX_PENDING", "10000"))  # spans buffered between flushes
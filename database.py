@@ -1,13 +1,326 @@
 import asyncio
-from typing import Dict, Any
+import json
+import sqlite3
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, Any, List, Optional, Tuple
 
-# Simple in-memory database simulation
+import config
+from .formatters import time_to_seconds
+
+# SQLite storage with a hot in-memory read cache in front of it.
+# All database access happens on a single dedicated thread so the
+# event loop never blocks on disk, and writes are queued and flushed
+# in batched transactions (write-behind).
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS chat_settings (
+    chat_id INTEGER PRIMARY KEY,
+    settings TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS history (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    chat_id INTEGER NOT NULL,
+    user_id INTEGER,
+    video_id TEXT,
+    title TEXT,
+    duration INTEGER NOT NULL DEFAULT 0,
+    played_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_history_user ON history (user_id);
+CREATE INDEX IF NOT EXISTS idx_history_chat ON history (chat_id);
+CREATE TABLE IF NOT EXISTS user_stats (
+    user_id INTEGER PRIMARY KEY,
+    songs_played INTEGER NOT NULL DEFAULT 0,
+    time_listened INTEGER NOT NULL DEFAULT 0
+);
+CREATE TABLE IF NOT EXISTS chat_tracks (
+    chat_id INTEGER NOT NULL,
+    video_id TEXT NOT NULL,
+    title TEXT,
+    plays INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (chat_id, video_id)
+);
+CREATE TABLE IF NOT EXISTS trending (
+    video_id TEXT PRIMARY KEY,
+    title TEXT,
+    score REAL NOT NULL,
+    updated_at REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS tracks (
+    id INTEGER PRIMARY KEY,
+    video_id TEXT NOT NULL UNIQUE,
+    title TEXT NOT NULL,
+    channel TEXT,
+    duration TEXT,
+    thumbnail TEXT,
+    views TEXT,
+    plays INTEGER NOT NULL DEFAULT 0,
+    seen_at REAL NOT NULL
+);
+CREATE VIRTUAL TABLE IF NOT EXISTS tracks_fts USING fts5(
+    title, channel, content='tracks', content_rowid='id',
+    tokenize='unicode61 remove_diacritics 2'
+);
+CREATE VIRTUAL TABLE IF NOT EXISTS tracks_trigram USING fts5(
+    title, content='tracks', content_rowid='id', tokenize='trigram'
+);
+CREATE TRIGGER IF NOT EXISTS tracks_ai AFTER INSERT ON tracks BEGIN
+    INSERT INTO tracks_fts (rowid, title, channel) VALUES (new.id, new.title, new.channel);
+    INSERT INTO tracks_trigram (rowid, title) VALUES (new.id, new.title);
+END;
+CREATE TRIGGER IF NOT EXISTS tracks_au AFTER UPDATE OF title, channel ON tracks BEGIN
+    INSERT INTO tracks_fts (tracks_fts, rowid, title, channel) VALUES ('delete', old.id, old.title, old.channel);
+    INSERT INTO tracks_fts (rowid, title, channel) VALUES (new.id, new.title, new.channel);
+    INSERT INTO tracks_trigram (tracks_trigram, rowid, title) VALUES ('delete', old.id, old.title);
+    INSERT INTO tracks_trigram (rowid, title) VALUES (new.id, new.title);
+END;
+CREATE TABLE IF NOT EXISTS file_ids (
+    video_id TEXT NOT NULL,
+    kind TEXT NOT NULL,
+    file_id TEXT NOT NULL,
+    PRIMARY KEY (video_id, kind)
+);
+CREATE TABLE IF NOT EXISTS search_queries (
+    query TEXT PRIMARY KEY,
+    video_ids TEXT NOT NULL,
+    updated_at REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS queued_jobs (
+    id TEXT PRIMARY KEY,
+    chat_id INTEGER NOT NULL,
+    user_id INTEGER,
+    kind TEXT NOT NULL,
+    message_id INTEGER NOT NULL,
+    status_id INTEGER NOT NULL,
+    url TEXT NOT NULL,
+    state TEXT NOT NULL DEFAULT 'queued',
+    stage TEXT,
+    data TEXT NOT NULL DEFAULT '{}',
+    attempts INTEGER NOT NULL DEFAULT 0,
+    cancel INTEGER NOT NULL DEFAULT 0,
+    owner TEXT,
+    lease_until REAL NOT NULL DEFAULT 0,
+    available_at REAL NOT NULL,
+    created_at REAL NOT NULL,
+    updated_at REAL NOT NULL,
+    error TEXT
+);
+CREATE INDEX IF NOT EXISTS idx_queued_jobs_state ON queued_jobs (state, created_at);
+CREATE TABLE IF NOT EXISTS media_files (
+    path TEXT PRIMARY KEY,
+    size INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    sha256 TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_media_files_hash ON media_files (sha256);
+CREATE TABLE IF NOT EXISTS shared_cache (
+    namespace TEXT NOT NULL,
+    key TEXT NOT NULL,
+    value TEXT NOT NULL,
+    expires_at REAL NOT NULL,
+    PRIMARY KEY (namespace, key)
+);
+CREATE TABLE IF NOT EXISTS quota_charges (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    key TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    charged_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_quota_charges_key ON quota_charges (key, charged_at);
+CREATE TABLE IF NOT EXISTS active_jobs (
+    job_id TEXT PRIMARY KEY,
+    user_id INTEGER NOT NULL,
+    owner TEXT NOT NULL,
+    started_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_active_jobs_user ON active_jobs (user_id);
+"""
+
+# Several processes (shard workers, queue consumers) use this database at
+# once. Per-process state that has to agree between them then lives in it
+# too: resolved stream URLs, probed sizes and dead videos (shared_cache),
+# download quotas (quota_charges) and running jobs per user (active_jobs).
+SHARED = config.SHARD_WORKERS > 0 or config.JOB_QUEUE
+
+DEFAULT_CHAT_SETTINGS = {
+    'volume': 100,
+    'repeat_mode': False,
+    'shuffle_mode': False,
+    'auto_leave': True
+}
+
+# Hot read caches: chat_id -> settings dict, user_id -> stats dict,
+# (video_id, kind) -> Telegram file_id of an already uploaded copy
 chat_settings = {}
+user_stats = {}
+file_ids = {}
+
+_conn: Optional[sqlite3.Connection] = None
+_db_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="db")
+_pending_writes: List[Tuple[str, tuple]] = []
+_pending_event: Optional[asyncio.Event] = None
+_flusher_task: Optional[asyncio.Task] = None
+_shared_writes = 0
+
+
+def _connect() -> sqlite3.Connection:
+    conn = sqlite3.connect(config.DB_PATH, check_same_thread=False, isolation_level=None)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    # Shard workers write to the same file; wait for their locks
+    conn.execute("PRAGMA busy_timeout=5000")
+    conn.executescript(SCHEMA)
+    return conn
+
+
+def _write_batch(batch: List[Tuple[str, tuple]]):
+    try:
+        _conn.execute("BEGIN")
+        for sql, params in batch:
+            _conn.execute(sql, params)
+        _conn.execute("COMMIT")
+    except Exception as e:
+        print(f"⚠️ Database batch write failed ({len(batch)} statements): {e}")
+        if _conn.in_transaction:
+            _conn.execute("ROLLBACK")
+
+
+def _read(sql: str, params: tuple) -> List[tuple]:
+    return _conn.execute(sql, params).fetchall()
+
+
+def _write_now(sql: str, params: tuple) -> List[tuple]:
+    cursor = _conn.execute(sql, params)
+    return cursor.fetchall()
+
+
+def _transaction(func: Callable, args: tuple) -> Any:
+    # IMMEDIATE takes the write lock up front, so a read-then-write can't
+    # race another process
+    _conn.execute("BEGIN IMMEDIATE")
+    try:
+        result = func(_conn, *args)
+    except BaseException:
+        _conn.execute("ROLLBACK")
+        raise
+    _conn.execute("COMMIT")
+    return result
+
+
+async def _flush_pending():
+    """Write every queued statement in one transaction"""
+    if not _pending_writes:
+        return
+    batch = _pending_writes[:]
+    _pending_writes.clear()
+    loop = asyncio.get_running_loop()
+    await loop.run_in_executor(_db_executor, _write_batch, batch)
+
+
+async def _flusher():
+    while True:
+        await _pending_event.wait()
+        _pending_event.clear()
+        # Let more writes pile up so they share one transaction
+        if len(_pending_writes) < config.DB_BATCH_SIZE:
+            await asyncio.sleep(config.DB_FLUSH_INTERVAL)
+        await _flush_pending()
+
+
+def enqueue_write(sql: str, params: tuple = ()):
+    """Queue a write statement; never blocks and never awaits"""
+    _pending_writes.append((sql, params))
+    if _pending_event is not None:
+        _pending_event.set()
+
+
+async def execute_read(sql: str, params: tuple = (), fresh: bool = False) -> List[tuple]:
+    """Run a read query on the database thread (after queued writes if `fresh`)"""
+    if fresh:
+        await _flush_pending()
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_db_executor, _read, sql, params)
+
+
+async def execute_write(sql: str, params: tuple = ()) -> List[tuple]:
+    """Run a write immediately (after queued writes) and return its rows"""
+    await _flush_pending()
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_db_executor, _write_now, sql, params)
+
+
+async def execute_transaction(func: Callable, *args) -> Any:
+    """Run `func(conn, *args)` in one write transaction and return its result"""
+    await _flush_pending()
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_db_executor, _transaction, func, args)
+
+
+async def get_shared(namespace: str, key: str) -> Optional[Tuple[str, float]]:
+    """A value another process shared, with its expiry (wall clock)"""
+    rows = await execute_read(
+        "SELECT value, expires_at FROM shared_cache WHERE namespace = ? AND key = ? AND expires_at > ?",
+        (namespace, key, time.time()),
+    )
+    return tuple(rows[0]) if rows else None
+
+
+def set_shared(namespace: str, key: str, value: str, ttl: float):
+    """Share a value with the other processes for `ttl` seconds"""
+    global _shared_writes
+    now = time.time()
+    enqueue_write(
+        "INSERT INTO shared_cache (namespace, key, value, expires_at) VALUES (?, ?, ?, ?) "
+        "ON CONFLICT(namespace, key) DO UPDATE SET value = excluded.value, expires_at = excluded.expires_at",
+        (namespace, key, value, now + ttl),
+    )
+    _shared_writes += 1
+    if _shared_writes % 1000 == 0:
+        enqueue_write("DELETE FROM shared_cache WHERE expires_at <= ?", (now,))
+
+
+def forget_shared(namespace: str, key: str):
+    enqueue_write("DELETE FROM shared_cache WHERE namespace = ? AND key = ?", (namespace, key))
+
 
 async def init_db():
     """Initialize the database"""
+    global _conn, _pending_event, _flusher_task
+    if _conn is None:
+        loop = asyncio.get_running_loop()
+        _conn = await loop.run_in_executor(_db_executor, _connect)
+        rows = await execute_read("SELECT user_id, songs_played, time_listened FROM user_stats")
+        for user_id, songs_played, time_listened in rows:
+            user_stats[user_id] = {'songs_played': songs_played, 'time_listened': time_listened}
+        rows = await execute_read("SELECT video_id, kind, file_id FROM file_ids")
+        for video_id, kind, file_id in rows:
+            file_ids[(video_id, kind)] = file_id
+    if _flusher_task is None or _flusher_task.done():
+        _pending_event = asyncio.Event()
+        if _pending_writes:
+            _pending_event.set()
+        _flusher_task = asyncio.create_task(_flusher())
     print("✅ Database initialized")
 
+
+async def close_db():
+    """Flush queued writes and close the database"""
+    global _conn, _flusher_task
+    if _flusher_task is not None:
+        _flusher_task.cancel()
+        try:
+            await _flusher_task
+        except asyncio.CancelledError:
+            pass
+        _flusher_task = None
+    if _conn is not None:
+        await _flush_pending()
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(_db_executor, _conn.close)
+        _conn = None
+
+
 async def is_on_off(setting_id: int) -> bool:
     """Check if a setting is on or off"""
     # Default settings
@@ -20,27 +333,73 @@ async def is_on_off(setting_id: int) -> bool:
 
 async def get_chat_settings(chat_id: int) -> Dict[str, Any]:
     """Get settings for a specific chat"""
-    return chat_settings.get(chat_id, {
-        'volume': 100,
-        'repeat_mode': False,
-        'shuffle_mode': False,
-        'auto_leave': True
-    })
+    if chat_id in chat_settings:
+        return chat_settings[chat_id]
+    settings = dict(DEFAULT_CHAT_SETTINGS)
+    rows = await execute_read("SELECT settings FROM chat_settings WHERE chat_id = ?", (chat_id,))
+    if rows:
+        settings.update(json.loads(rows[0][0]))
+    return chat_settings.setdefault(chat_id, settings)
 
 async def set_chat_settings(chat_id: int, settings: Dict[str, Any]):
     """Set settings for a specific chat"""
-    if chat_id not in chat_settings:
-        chat_settings[chat_id] = {}
-    chat_settings[chat_id].update(settings)
+    current = await get_chat_settings(chat_id)
+    current.update(settings)
+    enqueue_write(
+        "INSERT INTO chat_settings (chat_id, settings) VALUES (?, ?) "
+        "ON CONFLICT(chat_id) DO UPDATE SET settings = excluded.settings",
+        (chat_id, json.dumps(current)),
+    )
 
-async def add_to_history(chat_id: int, track_info: Dict[str, Any]):
+async def add_to_history(chat_id: int, track_info: Dict[str, Any], user_id: int = None):
     """Add track to play history"""
-    # Simple implementation - could be expanded
-    pass
+    duration = time_to_seconds(str(track_info.get('duration_min')))
+    enqueue_write(
+        "INSERT INTO history (chat_id, user_id, video_id, title, duration, played_at) "
+        "VALUES (?, ?, ?, ?, ?, ?)",
+        (chat_id, user_id, track_info.get('vidid'), track_info.get('title'), duration, time.time()),
+    )
+    if user_id is None:
+        return
+    stats = user_stats.setdefault(user_id, {'songs_played': 0, 'time_listened': 0})
+    stats['songs_played'] += 1
+    stats['time_listened'] += duration
+    enqueue_write(
+        "INSERT INTO user_stats (user_id, songs_played, time_listened) VALUES (?, 1, ?) "
+        "ON CONFLICT(user_id) DO UPDATE SET songs_played = songs_played + 1, "
+        "time_listened = time_listened + excluded.time_listened",
+        (user_id, duration),
+    )
 
 async def get_user_stats(user_id: int) -> Dict[str, Any]:
     """Get user statistics"""
-    return {
+    return dict(user_stats.get(user_id, {
         'songs_played': 0,
         'time_listened': 0
-    }
\ No newline at end of file
+    }))
+
+async def get_file_id(video_id: str, kind: str) -> Optional[str]:
+    """Get the Telegram file_id of an uploaded track ('audio' or 'video')"""
+    file_id = file_ids.get((video_id, kind))
+    if file_id is None and SHARED:
+        # Another process may have uploaded it since we loaded the cache
+        rows = await execute_read(
+            "SELECT file_id FROM file_ids WHERE video_id = ? AND kind = ?", (video_id, kind)
+        )
+        if rows:
+            file_id = file_ids[(video_id, kind)] = rows[0][0]
+    return file_id
+
+async def set_file_id(video_id: str, kind: str, file_id: str):
+    """Remember the Telegram file_id of an uploaded track"""
+    file_ids[(video_id, kind)] = file_id
+    enqueue_write(
+        "INSERT INTO file_ids (video_id, kind, file_id) VALUES (?, ?, ?) "
+        "ON CONFLICT(video_id, kind) DO UPDATE SET file_id = excluded.file_id",
+        (video_id, kind, file_id),
+    )
+
+async def forget_file_id(video_id: str, kind: str):
+    """Drop a file_id Telegram no longer accepts"""
+    file_ids.pop((video_id, kind), None)
+    enqueue_write("DELETE FROM file_ids WHERE video_id = ? AND kind = ?", (video_id, kind))
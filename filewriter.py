@@ -0,0 +1,99 @@
+import asyncio
+import hashlib
+import os
+from concurrent.futures import Future, ThreadPoolExecutor, wait
+from pathlib import Path
+from typing import Any, Callable, Optional, Union
+
+import config
+
+# Disk writes for downloads, kept off the event loop. Each file is
+# written on a dedicated I/O thread pool with double buffering: while one
+# chunk is being written the next one is already being received, and a
+# writer never has more than one write in flight, so chunks land in order
+# and a slow disk applies backpressure instead of piling up memory. The
+# content hash is updated on the same thread, so it costs no extra pass.
+
+_io_executor = ThreadPoolExecutor(max_workers=config.WRITER_THREADS, thread_name_prefix="io")
+
+
+def _open(path: Path, size: int):
+    f = open(path, "wb")
+    if size and hasattr(os, "posix_fallocate"):
+        try:
+            # Reserve the blocks up front: less fragmentation, and a full
+            # disk fails now rather than halfway through
+            os.posix_fallocate(f.fileno(), 0, size)
+        except OSError as e:
+            print(f"⚠️ Preallocation failed for {path.name}: {e}")
+    return f
+
+
+async def run_io(func: Callable, *args) -> Any:
+    """Run blocking file work (e.g. hashing a file) on the I/O threads"""
+    return await asyncio.get_running_loop().run_in_executor(_io_executor, func, *args)
+
+
+def _write(f, digest, chunk: bytes):
+    f.write(chunk)
+    digest.update(chunk)
+
+
+def _close(f, pending: Optional[Future], written: int, size: int, fsync: bool):
+    try:
+        if pending is not None:
+            # Let the last write finish before the file goes away
+            wait([pending])
+        if size and written != size:
+            # The preallocated size was only a hint
+            f.truncate(written)
+        if fsync:
+            f.flush()
+            os.fsync(f.fileno())
+    finally:
+        f.close()
+
+
+class FileWriter:
+    """Async file writer: `async with FileWriter(path, size) as f: await f.write(chunk)`"""
+
+    def __init__(self, path: Union[str, Path], size: int = 0, fsync: bool = None):
+        self.path = Path(path)
+        self.size = size
+        self.fsync = config.DOWNLOAD_FSYNC if fsync is None else fsync
+        self.written = 0
+        self._digest = hashlib.sha256()
+        self._file = None
+        self._pending: Optional[Future] = None
+
+    async def __aenter__(self):
+        loop = asyncio.get_running_loop()
+        self._file = await loop.run_in_executor(_io_executor, _open, self.path, self.size)
+        return self
+
+    async def write(self, chunk: bytes):
+        """Queue a chunk; returns once the previous chunk is on disk"""
+        if self._pending is not None:
+            await asyncio.wrap_future(self._pending)
+        self._pending = _io_executor.submit(_write, self._file, self._digest, chunk)
+        self.written += len(chunk)
+
+    def hexdigest(self) -> str:
+        """SHA-256 of everything written (once the writer is closed)"""
+        return self._digest.hexdigest()
+
+    async def __aexit__(self, exc_type, exc, tb):
+        # A complete file gets its last write checked, its size fixed and
+        # maybe an fsync; a failed one only needs closing
+        pending, self._pending = self._pending, None
+        try:
+            if exc_type is None and pending is not None:
+                await asyncio.wrap_future(pending)
+                pending = None
+        finally:
+            complete = exc_type is None and pending is None
+            closing = _io_executor.submit(
+                _close, self._file, pending, self.written, self.size if complete else 0, self.fsync and complete
+            )
+            # Never leave the file open, even when cancelled while closing
+            await asyncio.shield(asyncio.wrap_future(closing))
@@ -0,0 +1,244 @@
+import asyncio
+import json
+import os
+import secrets
+import socket
+import time
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple
+
+import config
+from .database import execute_write
+from .jobs import cancel_job
+
+# Durable download queue. With JOB_QUEUE on, the Telegram front end only
+# records a job here; queue consumers (shard workers, standalone
+# `bot.py --worker N` processes, or the front itself when it has no
+# workers) claim jobs under a lease they keep renewing. A job whose lease
+# runs out (its worker crashed or was restarted) is claimed again and
+# resumes after the last stage it checkpointed:
+#   resolve  - track details known and the download admitted
+#   download - media file on disk (already transcoded if needed)
+#   upload   - sent to the chat
+# A job that keeps failing is given up after JOBQ_MAX_ATTEMPTS claims. A
+# job that can't run yet (its user has enough downloads going) raises
+# Deferred and goes back in the queue without using up an attempt.
+
+STAGES = ("resolve", "download", "upload")
+FINISHED = ("done", "failed", "cancelled", "timeout", "refused")
+
+_COLUMNS = "id, chat_id, user_id, kind, message_id, status_id, url, stage, data, attempts"
+
+
+class QueuedJob:
+    def __init__(self, row: tuple, owner: str):
+        (self.id, self.chat_id, self.user_id, self.kind, self.message_id, self.status_id,
+         self.url, self.stage, data, self.attempts) = row
+        self.data: Dict[str, Any] = json.loads(data)
+        self.owner = owner
+        # Set when another worker took the job over: it owns the status
+        # message and the charge from then on
+        self.taken_over = False
+
+    def reached(self, stage: str) -> bool:
+        """Whether `stage` was completed by this or an earlier attempt"""
+        return self.stage is not None and STAGES.index(self.stage) >= STAGES.index(stage)
+
+    async def save(self, stage: str, **data):
+        """Checkpoint a completed stage and what later stages need from it"""
+        self.stage = stage
+        self.data.update(data)
+        await execute_write(
+            "UPDATE queued_jobs SET stage = ?, data = ?, updated_at = ? WHERE id = ? AND owner = ?",
+            (stage, json.dumps(self.data), time.time(), self.id, self.owner),
+        )
+
+
+class Deferred(Exception):
+    """Raised by a job's runner to put it back in the queue for later"""
+
+
+def owner_name() -> str:
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+
+async def enqueue(chat_id: int, user_id: Optional[int], kind: str, message_id: int, status_id: int,
+                  url: str, track: Optional[Dict[str, Any]] = None,
+                  trace: Optional[Dict[str, str]] = None) -> str:
+    """Persist a download job; returns its id"""
+    job_id = secrets.token_hex(4)
+    now = time.time()
+    data = {"track": track} if track else {}
+    if trace:
+        # Whoever runs the job continues the trace of the request
+        data["trace"] = trace
+    await execute_write(
+        "INSERT INTO queued_jobs (id, chat_id, user_id, kind, message_id, status_id, url, data, "
+        "available_at, created_at, updated_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+        (job_id, chat_id, user_id, kind, message_id, status_id, url, json.dumps(data), now, now, now),
+    )
+    return job_id
+
+
+async def claim(owner: str) -> Optional[QueuedJob]:
+    """Take the oldest runnable job (or one whose lease ran out)"""
+    now = time.time()
+    rows = await execute_write(
+        "UPDATE queued_jobs SET state = 'running', owner = ?, lease_until = ?, "
+        "attempts = attempts + 1, updated_at = ? WHERE id = ("
+        "SELECT id FROM queued_jobs WHERE (state = 'queued' AND available_at <= ?) "
+        "OR (state = 'running' AND lease_until < ?) ORDER BY created_at LIMIT 1"
+        f") RETURNING {_COLUMNS}",
+        (owner, now + config.JOBQ_LEASE, now, now, now),
+    )
+    return QueuedJob(rows[0], owner) if rows else None
+
+
+async def renew(job: QueuedJob) -> str:
+    """Extend the job's lease; returns "ok", "cancelled" or "lost" (taken over)"""
+    rows = await execute_write(
+        "UPDATE queued_jobs SET lease_until = ? WHERE id = ? AND owner = ? AND state = 'running' "
+        "RETURNING cancel",
+        (time.time() + config.JOBQ_LEASE, job.id, job.owner),
+    )
+    if not rows:
+        return "lost"
+    return "cancelled" if rows[0][0] else "ok"
+
+
+async def finish(job: QueuedJob, state: str, error: str = None):
+    await execute_write(
+        "UPDATE queued_jobs SET state = ?, error = ?, owner = NULL, updated_at = ? WHERE id = ? AND owner = ?",
+        (state, error, time.time(), job.id, job.owner),
+    )
+
+
+async def release(job: QueuedJob, delay: float = 0, error: str = None, attempted: bool = True):
+    """Put a claimed job back in the queue, to be resumed after `delay`.
+
+    Without `attempted` the claim doesn't count towards JOBQ_MAX_ATTEMPTS.
+    """
+    now = time.time()
+    await execute_write(
+        "UPDATE queued_jobs SET state = 'queued', owner = NULL, lease_until = 0, available_at = ?, "
+        "error = ?, updated_at = ?, attempts = attempts - ? WHERE id = ? AND owner = ?",
+        (now + delay, error, now, 0 if attempted else 1, job.id, job.owner),
+    )
+
+
+async def cancel(user_id: int, job_id: str = None, chat_id: int = None) -> List[Tuple[int, int, bool]]:
+    """Cancel one job, or all of the user's jobs in a chat.
+
+    Returns (chat_id, status_id, was_queued) per job. Queued jobs are
+    cancelled on the spot; running ones by their worker on its next
+    lease renewal.
+    """
+    if job_id is not None:
+        where, params = "id = ? AND (user_id IS NULL OR user_id = ?)", (job_id, user_id)
+    else:
+        where, params = "chat_id = ? AND user_id = ?", (chat_id, user_id)
+    rows = await execute_write(
+        "UPDATE queued_jobs SET cancel = 1, "
+        "state = CASE WHEN state = 'queued' THEN 'cancelled' ELSE state END, updated_at = ? "
+        f"WHERE {where} AND state IN ('queued', 'running') RETURNING chat_id, status_id, state",
+        (time.time(), *params),
+    )
+    return [(chat, status_id, state == "cancelled") for chat, status_id, state in rows]
+
+
+async def purge():
+    """Forget finished jobs older than JOBQ_RETENTION"""
+    placeholders = ",".join("?" * len(FINISHED))
+    await execute_write(
+        f"DELETE FROM queued_jobs WHERE state IN ({placeholders}) AND updated_at < ?",
+        (*FINISHED, time.time() - config.JOBQ_RETENTION),
+    )
+
+
+async def _heartbeat(job: QueuedJob):
+    while True:
+        await asyncio.sleep(config.JOBQ_HEARTBEAT)
+        try:
+            lease = await renew(job)
+        except Exception as e:
+            print(f"⚠️ Lease renewal failed for job {job.id}: {e}")
+            continue
+        if lease == "cancelled":
+            cancel_job(job.id, job.user_id)
+            return
+        if lease == "lost":
+            # Another worker runs it now: stop quietly, without touching
+            # its status message or its charge
+            print(f"⚠️ Job {job.id} was taken over by another worker")
+            job.taken_over = True
+            cancel_job(job.id, job.user_id, "taken_over")
+            return
+
+
+async def _execute(job: QueuedJob, run: Callable[[QueuedJob], Awaitable[str]],
+                   give_up: Callable[[QueuedJob], Awaitable]):
+    if job.attempts > config.JOBQ_MAX_ATTEMPTS:
+        await finish(job, "failed", "too many attempts")
+        await give_up(job)
+        return
+    if job.stage:
+        print(f"🔁 Resuming job {job.id} after its {job.stage} stage")
+    heartbeat = asyncio.create_task(_heartbeat(job))
+    try:
+        state = await run(job)
+    except asyncio.CancelledError:
+        # Shutting down: hand the job back so it resumes right away
+        await release(job)
+        raise
+    except Deferred as e:
+        await release(job, config.JOBQ_RETRY_DELAY, str(e), attempted=False)
+    except Exception as e:
+        print(f"❌ Job {job.id} failed (attempt {job.attempts}): {e}")
+        if job.attempts >= config.JOBQ_MAX_ATTEMPTS:
+            await finish(job, "failed", str(e))
+            await give_up(job)
+        else:
+            await release(job, config.JOBQ_RETRY_DELAY * 2 ** (job.attempts - 1), str(e))
+    else:
+        if not job.taken_over:
+            await finish(job, state or "done")
+    finally:
+        heartbeat.cancel()
+
+
+async def consume(run: Callable[[QueuedJob], Awaitable[str]], give_up: Callable[[QueuedJob], Awaitable]):
+    """Claim and run queued jobs forever, at most RATE_MAX_ACTIVE at a time.
+
+    `run(job)` returns the job's final state; `give_up(job)` tells the
+    user about a job that failed too often.
+    """
+    owner = owner_name()
+    slots = asyncio.Semaphore(config.RATE_MAX_ACTIVE)
+    tasks = set()
+    last_purge = 0.0
+
+    def done(task: asyncio.Task):
+        tasks.discard(task)
+        slots.release()
+
+    try:
+        while True:
+            await slots.acquire()
+            try:
+                job = await claim(owner)
+            except Exception as e:
+                print(f"⚠️ Job claim failed: {e}")
+                job = None
+            if job is None:
+                slots.release()
+                if time.monotonic() - last_purge > 3600:
+                    last_purge = time.monotonic()
+                    await purge()
+                await asyncio.sleep(config.JOBQ_POLL_INTERVAL)
+                continue
+            task = asyncio.create_task(_execute(job, run, give_up))
+            tasks.add(task)
+            task.add_done_callback(done)
+    finally:
+        for task in list(tasks):
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
@@ -0,0 +1,85 @@
+import asyncio
+import secrets
+import time
+from typing import Coroutine, Dict, List, Optional
+
+import config
+
+# Registry of running user jobs (a download and its upload), so they can
+# be cancelled with /cancel or the status message's cancel button.
+# Cancelling a job cancels its task; each stage underneath (HTTP
+# transfers, yt-dlp/ffmpeg processes, uploads) cleans up on the way out.
+
+
+class Job:
+    def __init__(self, chat_id: int, user_id: Optional[int], label: str, job_id: str = None):
+        self.id = job_id or secrets.token_hex(4)
+        self.chat_id = chat_id
+        self.user_id = user_id
+        self.label = label
+        self.started = time.monotonic()
+        self.task: Optional[asyncio.Task] = None
+        self.state = "pending"  # running, done, cancelled, taken_over, timeout
+        self.cancel_state = "cancelled"  # what cancelling it ends in
+
+
+_jobs: Dict[str, Job] = {}
+
+
+def new_job(chat_id: int, user_id: Optional[int], label: str, job_id: str = None) -> Job:
+    """A job; queued jobs keep their queue id so cancel buttons keep working"""
+    return Job(chat_id, user_id, label, job_id)
+
+
+async def run_job(job: Job, coro: Coroutine) -> Job:
+    """Run `coro` as a cancellable job with a hard time limit.
+
+    Never raises CancelledError for a cancelled job: the caller is a
+    Pyrogram handler and must keep running. Check `job.state` instead.
+    """
+    job.task = asyncio.create_task(coro)
+    job.state = "running"
+    _jobs[job.id] = job
+    try:
+        done, _ = await asyncio.wait([job.task], timeout=config.JOB_TIMEOUT)
+        if not done:
+            job.state = "timeout"
+            job.task.cancel()
+            await asyncio.wait([job.task])
+        elif job.task.cancelled():
+            job.state = job.cancel_state
+        else:
+            job.state = "done"
+            job.task.result()
+    except asyncio.CancelledError:
+        # The handler itself is going away (shutdown)
+        job.task.cancel()
+        raise
+    finally:
+        _jobs.pop(job.id, None)
+    return job
+
+
+def get_jobs(chat_id: int, user_id: Optional[int] = None) -> List[Job]:
+    return [
+        job for job in _jobs.values()
+        if job.chat_id == chat_id and (user_id is None or job.user_id == user_id)
+    ]
+
+
+def cancel_job(job_id: str, user_id: Optional[int], state: str = "cancelled") -> Optional[Job]:
+    """Cancel a job if `user_id` started it; it ends in `state`"""
+    job = _jobs.get(job_id)
+    if job is None or job.user_id not in (None, user_id):
+        return None
+    job.cancel_state = state
+    job.task.cancel()
+    return job
+
+
+def cancel_jobs(chat_id: int, user_id: int) -> int:
+    """Cancel every job the user started in a chat; returns how many"""
+    jobs = get_jobs(chat_id, user_id)
+    for job in jobs:
+        job.task.cancel()
+    return len(jobs)
@@ -0,0 +1,37 @@
+import re
+from functools import lru_cache
+from typing import Optional
+
+# Canonical YouTube video IDs. Every cache (downloads, transcodes,
+# file_ids, negative cache, stream URLs) is keyed by the ID, so all the
+# ways of linking one video must map to the same 11 characters.
+
+WATCH_URL = "https://www.youtube.com/watch?v="
+
+_ID = r"[A-Za-z0-9_-]{11}"
+_LINK_RE = re.compile(
+    # the host must start the link, not end some other domain
+    r"(?<![\w.-])(?:https?://)?(?:[\w-]+\.)?"
+    r"(?:youtube(?:-nocookie)?\.com/(?:watch\?(?:[^#\s]*&)?v=|shorts/|embed/|live/|v/|e/)|youtu\.be/)"
+    rf"({_ID})(?![A-Za-z0-9_-])",
+    re.IGNORECASE,
+)
+
+
+@lru_cache(maxsize=4096)
+def extract_video_id(link: str) -> Optional[str]:
+    """Video ID from any YouTube link, None if there is none.
+
+    Handles watch?v= with parameters in any order, youtu.be, /shorts,
+    /embed, /live, music.youtube.com and m.youtube.com links.
+    """
+    if not link:
+        return None
+    match = _LINK_RE.search(link)
+    return match.group(1) if match else None
+
+
+def canonical_url(link: str) -> Optional[str]:
+    """The one watch URL for whatever video `link` points at"""
+    video_id = extract_video_id(link)
+    return WATCH_URL + video_id if video_id else None
@@ -0,0 +1,188 @@
+import asyncio
+import hashlib
+import os
+from pathlib import Path
+from typing import Dict, Optional, Tuple, Union
+
+import config
+from .database import execute_read, execute_write
+from .filewriter import run_io
+
+# Integrity manifest for cached downloads. Every published file is
+# recorded with its size, mtime and SHA-256 (hashed while it was being
+# written), and a cache hit is checked against that record before it is
+# served: a truncated or rewritten file is deleted and fetched again
+# instead of being sent over and over. Files with identical content are
+# hardlinked to one copy.
+#
+# Files a download wrote are recorded as they are published, yt-dlp
+# outputs as soon as yt-dlp has finished them. A file the manifest has
+# never seen (e.g. left from before it existed) is only adopted if
+# ffmpeg can decode its end, which a truncated file fails.
+
+# path -> (size, mtime_ns, sha256), a cache of media_files rows
+_entries: Dict[str, Tuple[int, int, str]] = {}
+
+PathLike = Union[str, Path]
+
+
+def _key(path: PathLike) -> str:
+    return os.path.normpath(str(path))
+
+
+def _hash_file(path: str) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+async def _lookup(key: str) -> Optional[Tuple[int, int, str]]:
+    entry = _entries.get(key)
+    if entry is None:
+        rows = await execute_read("SELECT size, mtime_ns, sha256 FROM media_files WHERE path = ?", (key,))
+        if rows:
+            entry = _entries[key] = tuple(rows[0])
+    return entry
+
+
+async def _store(key: str, st: os.stat_result, digest: str):
+    if len(_entries) > 10000:
+        _entries.pop(next(iter(_entries)))
+    _entries[key] = (st.st_size, st.st_mtime_ns, digest)
+    # Written straight away: the record has to exist before the file does
+    await execute_write(
+        "INSERT INTO media_files (path, size, mtime_ns, sha256) VALUES (?, ?, ?, ?) "
+        "ON CONFLICT(path) DO UPDATE SET size = excluded.size, mtime_ns = excluded.mtime_ns, "
+        "sha256 = excluded.sha256",
+        (key, st.st_size, st.st_mtime_ns, digest),
+    )
+
+
+async def forget(path: PathLike):
+    key = _key(path)
+    _entries.pop(key, None)
+    await execute_write("DELETE FROM media_files WHERE path = ?", (key,))
+
+
+async def _unchanged(key: str) -> bool:
+    """Whether a file still matches its record (cheap: no hashing)"""
+    entry = await _lookup(key)
+    try:
+        st = os.stat(key)
+    except FileNotFoundError:
+        return False
+    return entry is not None and (st.st_size, st.st_mtime_ns) == entry[:2]
+
+
+async def _dedupe(key: str, size: int, digest: str):
+    """Replace a file with a hardlink to an identical cached copy"""
+    rows = await execute_read(
+        "SELECT path FROM media_files WHERE sha256 = ? AND size = ? AND path != ?", (digest, size, key)
+    )
+    for (other,) in rows:
+        if not await _unchanged(other):
+            continue
+        try:
+            if os.path.samefile(other, key):
+                return
+            link = key + ".link"
+            os.link(other, link)
+            os.replace(link, key)
+        except OSError as e:
+            print(f"⚠️ Could not hardlink {key} to {other}: {e}")
+            continue
+        print(f"🔗 {key} has the same content as {other}, linked")
+        await _store(key, os.stat(key), digest)
+        return
+
+
+async def _playable(path: str) -> bool:
+    """Whether ffmpeg decodes the last seconds of a media file cleanly"""
+    try:
+        proc = await asyncio.create_subprocess_exec(
+            "ffmpeg", "-v", "error", "-sseof", "-3", "-i", path, "-f", "null", "-",
+            stdin=asyncio.subprocess.DEVNULL,
+            stdout=asyncio.subprocess.DEVNULL,
+            stderr=asyncio.subprocess.PIPE,
+        )
+    except FileNotFoundError:
+        print(f"⚠️ ffmpeg is missing, can't check {path}")
+        return True
+    try:
+        _, stderr = await asyncio.wait_for(proc.communicate(), timeout=config.RESOLVE_TIMEOUT)
+    except asyncio.TimeoutError:
+        proc.kill()
+        await proc.communicate()
+        return False
+    except BaseException:
+        proc.kill()
+        await proc.communicate()
+        raise
+    # A truncated file still exits 0 but logs "partial file" and the like
+    return proc.returncode == 0 and not stderr.strip()
+
+
+async def record(path: PathLike, since: float = None) -> bool:
+    """Record a file another tool (yt-dlp) just finished writing.
+
+    With `since`, only a file created after that time counts as new;
+    an older one is checked with verify() instead.
+    """
+    key = _key(path)
+    try:
+        st = os.stat(key)
+    except FileNotFoundError:
+        return False
+    if since is not None and st.st_ctime < since:
+        return await verify(key)
+    digest = await run_io(_hash_file, key)
+    await _store(key, st, digest)
+    await _dedupe(key, st.st_size, digest)
+    return True
+
+
+async def publish(temp_path: PathLike, path: PathLike, digest: str):
+    """Move a finished download into place and record it"""
+    key = _key(path)
+    st = os.stat(temp_path)
+    # Record first, so a crash right after the rename leaves a file that
+    # can still be checked
+    await _store(key, st, digest)
+    os.replace(temp_path, key)
+    await _dedupe(key, st.st_size, digest)
+
+
+async def verify(path: PathLike) -> bool:
+    """Check a cached file before serving it; a damaged one is deleted"""
+    key = _key(path)
+    try:
+        st = os.stat(key)
+    except FileNotFoundError:
+        return False
+    entry = await _lookup(key)
+    if entry and (st.st_size, st.st_mtime_ns) == entry[:2]:
+        return True
+
+    if st.st_size and entry is None:
+        # Not written by a download we tracked: adopt it if it is whole
+        if await _playable(key):
+            digest = await run_io(_hash_file, key)
+            await _store(key, st, digest)
+            await _dedupe(key, st.st_size, digest)
+            return True
+    elif st.st_size and st.st_size == entry[0]:
+        digest = await run_io(_hash_file, key)
+        if digest == entry[2]:
+            # Only touched; remember the new mtime
+            await _store(key, st, digest)
+            return True
+
+    print(f"❌ Cached file {key} is damaged, removing it")
+    try:
+        os.remove(key)
+    except OSError:
+        pass
+    await forget(key)
+    return False
@@ -0,0 +1,117 @@
+import re
+import time
+from typing import Dict, Optional, Tuple
+
+import config
+from .database import SHARED, forget_shared, get_shared, set_shared
+
+# Negative cache for videos that can't be fetched. A failure is classified
+# into a reason code; permanent reasons (removed, private) are remembered
+# for days, transient ones (API still processing) for seconds. Cached
+# reasons short-circuit downloads and metadata lookups, so a dead link
+# fails in microseconds instead of running the whole fallback chain again.
+#
+# "video" reasons apply to every way of fetching the video; "api" reasons
+# only skip the stream API, leaving the yt-dlp fallbacks to try.
+#
+# With several processes, marks are shared through the database and
+# load() picks up the ones other processes made.
+
+# reason -> (ttl, scope, user-facing message)
+REASONS = {
+    "removed": (config.NEGATIVE_TTL_PERMANENT, "video", "This video has been removed"),
+    "private": (config.NEGATIVE_TTL_PERMANENT, "video", "This video is private"),
+    "unavailable": (config.NEGATIVE_TTL_PERMANENT, "video", "This video is unavailable"),
+    "region_blocked": (config.NEGATIVE_TTL_BLOCKED, "video", "This video is blocked in the bot's region"),
+    "age_restricted": (config.NEGATIVE_TTL_BLOCKED, "video", "This video is age-restricted"),
+    "not_found": (config.NEGATIVE_TTL_MISSING, "video", "No video found for this link"),
+    "live": (config.NEGATIVE_TTL_TRANSIENT, "video", "Live streams and premieres can't be downloaded yet"),
+    "api_missing": (config.NEGATIVE_TTL_MISSING, "api", "The download API doesn't have this video"),
+    "api_pending": (config.NEGATIVE_TTL_TRANSIENT, "api", "The download API is still preparing this video"),
+}
+
+# Checked in order; yt-dlp and YouTube error texts
+_PATTERNS = [
+    ("private", re.compile(r"private video|video is private", re.I)),
+    ("removed", re.compile(r"has been removed|account .* terminated|no longer available", re.I)),
+    ("region_blocked", re.compile(r"not (?:made )?available in your country|blocked it in your country|geo.?restrict", re.I)),
+    ("age_restricted", re.compile(r"confirm your age|age.?restricted|inappropriate for some users", re.I)),
+    ("live", re.compile(r"live event will begin|premieres in|is a live|is live|is upcoming", re.I)),
+    # Only the video itself: "Requested format is not available" is not a dead video
+    ("unavailable", re.compile(r"\bvideo (?:is )?(?:unavailable|not available)", re.I)),
+]
+
+# video_id -> (expires_at, reason)
+_dead: Dict[str, Tuple[float, str]] = {}
+
+
+class VideoUnavailable(Exception):
+    def __init__(self, video_id: str, reason: str):
+        self.video_id = video_id
+        self.reason = reason
+        super().__init__(REASONS[reason][2])
+
+
+def classify(error_text: str) -> Optional[str]:
+    """Reason code for an error message, or None if it looks transient"""
+    for reason, pattern in _PATTERNS:
+        if pattern.search(error_text or ""):
+            return reason
+    return None
+
+
+def mark(video_id: Optional[str], reason: str):
+    if not video_id:
+        return
+    now = time.monotonic()
+    if len(_dead) > 10000:
+        for stale in [vid for vid, (expires_at, _) in _dead.items() if expires_at <= now]:
+            del _dead[stale]
+    print(f"🚫 Marking {video_id} as {reason}")
+    _dead[video_id] = (now + REASONS[reason][0], reason)
+    if SHARED:
+        set_shared("dead", video_id, reason, REASONS[reason][0])
+
+
+async def load(video_id: Optional[str]):
+    """Pick up a mark another process made for this video"""
+    if not SHARED or not video_id or video_id in _dead:
+        return
+    shared = await get_shared("dead", video_id)
+    if shared and shared[0] in REASONS:
+        reason, expires_at = shared
+        _dead[video_id] = (time.monotonic() + expires_at - time.time(), reason)
+
+
+def mark_from_error(video_id: str, error_text: str) -> Optional[str]:
+    """Classify an error and remember it if it says the video is dead"""
+    reason = classify(error_text)
+    if reason:
+        mark(video_id, reason)
+    return reason
+
+
+def check(video_id: str, scope: str = "video") -> Optional[str]:
+    """Cached reason the video can't be fetched in `scope` ("video" or "api")"""
+    entry = _dead.get(video_id)
+    if entry is None:
+        return None
+    expires_at, reason = entry
+    if expires_at <= time.monotonic():
+        del _dead[video_id]
+        return None
+    if scope == "video" and REASONS[reason][1] != "video":
+        return None
+    return reason
+
+
+def raise_if_dead(video_id: str):
+    reason = check(video_id)
+    if reason:
+        raise VideoUnavailable(video_id, reason)
+
+
+def forget(video_id: str):
+    _dead.pop(video_id, None)
+    if SHARED:
+        forget_shared("dead", video_id)
@@ -0,0 +1,200 @@
+import asyncio
+import bisect
+import contextvars
+import itertools
+import time
+from typing import Any, Callable, Dict
+
+from pyrogram.errors import FloodWait
+
+import config
+from .tracing import span
+
+# Central scheduler for outbound Telegram requests. Every send, reply and
+# edit takes a token from a global bucket and from its chat's bucket,
+# higher priority requests go first, and FloodWait puts the request back
+# in the queue instead of failing it.
+
+PRIORITY_MEDIA = 0
+PRIORITY_REPLY = 1
+PRIORITY_STATUS = 2
+
+
+class TokenBucket:
+    """Classic token bucket: `rate` tokens per second, bursts up to `capacity`"""
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+
+    def _refill(self, now: float):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, now: float) -> float:
+        """Seconds until a token is available"""
+        self._refill(now)
+        wait = 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+        return max(wait, self.blocked_until - now)
+
+    def take(self, now: float):
+        self._refill(now)
+        self.tokens -= 1
+
+    def block(self, seconds: float):
+        """Hold the bucket closed, e.g. for the duration of a FloodWait"""
+        self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+        self.tokens = 0
+
+
+class _Request:
+    __slots__ = ("priority", "seq", "chat_id", "func", "args", "kwargs", "future", "attempts", "task", "context",
+                 "retry")
+
+    def __init__(self, priority, seq, chat_id, func, args, kwargs, future, retry=True):
+        self.priority = priority
+        self.seq = seq
+        self.chat_id = chat_id
+        self.func = func
+        self.args = args
+        self.kwargs = kwargs
+        self.future = future
+        self.attempts = 0
+        self.retry = retry
+        self.task = None
+        # The caller's context, so the request shows up in its trace
+        self.context = contextvars.copy_context()
+
+    def __lt__(self, other):
+        return (self.priority, self.seq) < (other.priority, other.seq)
+
+
+class OutboundScheduler:
+    def __init__(self):
+        self.global_bucket = TokenBucket(config.OUTBOUND_GLOBAL_RATE, config.OUTBOUND_GLOBAL_RATE)
+        self.chat_buckets: Dict[int, TokenBucket] = {}
+        self.pending = []
+        self.wakeup = asyncio.Event()
+        self.counter = itertools.count()
+        self.task = None
+        self.running = set()
+
+    def _bucket(self, chat_id: int) -> TokenBucket:
+        bucket = self.chat_buckets.get(chat_id)
+        if bucket is None:
+            if len(self.chat_buckets) > 10000:
+                self._prune_buckets()
+            if chat_id < 0:
+                bucket = TokenBucket(config.OUTBOUND_GROUP_RATE, config.OUTBOUND_GROUP_BURST)
+            else:
+                bucket = TokenBucket(config.OUTBOUND_PRIVATE_RATE, config.OUTBOUND_PRIVATE_BURST)
+            self.chat_buckets[chat_id] = bucket
+        return bucket
+
+    def _prune_buckets(self):
+        """Forget idle chats whose buckets have fully refilled"""
+        now = time.monotonic()
+        busy = {request.chat_id for request in self.pending}
+        for chat_id, bucket in list(self.chat_buckets.items()):
+            if chat_id not in busy and bucket.wait_time(now) == 0 and bucket.tokens >= bucket.capacity:
+                del self.chat_buckets[chat_id]
+
+    async def submit(self, chat_id: int, func: Callable, *args, priority: int = PRIORITY_REPLY,
+                     retry: bool = True, **kwargs) -> Any:
+        """Queue a Pyrogram call for `chat_id` and wait for its result.
+
+        With `retry=False` a FloodWait is raised to the caller instead of
+        rescheduling, for calls that can't simply be made again (e.g. an
+        upload consuming a StreamingSource).
+        """
+        if self.task is None or self.task.done():
+            self.task = asyncio.create_task(self._run())
+        future = asyncio.get_running_loop().create_future()
+        request = _Request(priority, next(self.counter), chat_id, func, args, kwargs, future, retry)
+        bisect.insort(self.pending, request)
+        self.wakeup.set()
+        try:
+            return await future
+        except asyncio.CancelledError:
+            # Abort a request that is already running (e.g. an upload)
+            if request.task is not None:
+                request.task.cancel()
+            raise
+
+    async def _run(self):
+        while True:
+            now = time.monotonic()
+            sleep_for = None
+            global_wait = self.global_bucket.wait_time(now)
+            if self.pending and global_wait == 0:
+                for index, request in enumerate(self.pending):
+                    if request.future.done():
+                        # Caller gave up (cancelled) before it was sent
+                        del self.pending[index]
+                        sleep_for = 0
+                        break
+                    wait = self._bucket(request.chat_id).wait_time(now)
+                    if wait == 0:
+                        del self.pending[index]
+                        self.global_bucket.take(now)
+                        self._bucket(request.chat_id).take(now)
+                        task = asyncio.create_task(self._execute(request), context=request.context)
+                        request.task = task
+                        self.running.add(task)
+                        task.add_done_callback(self.running.discard)
+                        sleep_for = 0
+                        break
+                    sleep_for = wait if sleep_for is None else min(sleep_for, wait)
+            elif self.pending:
+                sleep_for = global_wait
+
+            if sleep_for == 0:
+                continue
+            self.wakeup.clear()
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), timeout=sleep_for)
+            except asyncio.TimeoutError:
+                pass
+
+    async def _execute(self, request: _Request):
+        if request.future.done():
+            return
+        try:
+            with span(f"telegram.{getattr(request.func, '__name__', 'request')}",
+                      chat_id=request.chat_id, attempt=request.attempts + 1):
+                result = await request.func(*request.args, **request.kwargs)
+        except FloodWait as e:
+            request.attempts += 1
+            self._bucket(request.chat_id).block(e.value)
+            if not request.retry or request.attempts > config.OUTBOUND_MAX_RETRIES:
+                print(f"⏳ FloodWait {e.value}s in chat {request.chat_id}, giving up")
+                if not request.future.done():
+                    request.future.set_exception(e)
+                return
+            print(f"⏳ FloodWait {e.value}s in chat {request.chat_id}, rescheduling")
+            bisect.insort(self.pending, request)
+            self.wakeup.set()
+        except Exception as e:
+            if not request.future.done():
+                request.future.set_exception(e)
+        else:
+            if not request.future.done():
+                request.future.set_result(result)
+
+
+scheduler = OutboundScheduler()
+
+
+async def submit(chat_id: int, func: Callable, *args, priority: int = PRIORITY_REPLY, retry: bool = True,
+                 **kwargs) -> Any:
+    """Send a Pyrogram request through the shared outbound scheduler"""
+    return await scheduler.submit(chat_id, func, *args, priority=priority, retry=retry, **kwargs)
+
+
+def share_global_rate(processes: int):
+    """Split the bot-wide send rate between `processes` sending processes"""
+    rate = config.OUTBOUND_GLOBAL_RATE / processes
+    scheduler.global_bucket = TokenBucket(rate, rate)
@@ -0,0 +1,339 @@
+import asyncio
+from collections import deque
+from pathlib import Path
+from typing import Awaitable, Callable, Dict, Optional
+
+import config
+from . import manifest
+from .links import WATCH_URL
+from .transcoder import variant_path
+from .youtube import fetch_stream_url
+
+try:
+    from pytgcalls.types import Device, ExternalMedia, MediaStream
+    from pytgcalls.types.raw import AudioParameters
+except ImportError:  # only the voice chat sink needs it
+    MediaStream = None
+
+# Real-time voice chat player. Each chat gets one ChatPlayer that decodes
+# straight from a stream URL (or a cached file) with ffmpeg into a jitter
+# buffer of raw PCM frames, and a pacer that hands one frame to the sink
+# every FRAME_MS. Nothing is downloaded or uploaded first. While a track
+# plays the next one is already resolved, and its decoder starts as soon
+# as the current one reaches EOF, so tracks play back to back.
+
+SAMPLE_RATE = 48000
+CHANNELS = 2
+FRAME_MS = 20
+FRAME_BYTES = SAMPLE_RATE * CHANNELS * 2 * FRAME_MS // 1000  # s16le
+SILENCE = bytes(FRAME_BYTES)
+
+
+async def resolve_source(video_id: str) -> Optional[str]:
+    """Local file for a track if cached, otherwise its stream URL"""
+    for path in (
+        variant_path(video_id, "opus"),
+        Path("downloads/audio") / f"{video_id}.m4a",
+        Path("downloads/video") / f"{video_id}.mp4",
+    ):
+        if path.exists() and await manifest.verify(path):
+            return str(path)
+    return await fetch_stream_url(WATCH_URL + video_id)
+
+
+class TgCallsSink:
+    """Plays PCM frames into a group voice chat through py-tgcalls"""
+
+    def __init__(self, calls):
+        self.calls = calls
+        self.chat_id = None
+
+    async def open(self, chat_id: int):
+        self.chat_id = chat_id
+        await self.calls.play(chat_id, MediaStream(
+            ExternalMedia.AUDIO,
+            audio_parameters=AudioParameters(bitrate=SAMPLE_RATE, channels=CHANNELS),
+        ))
+
+    async def write(self, frame: bytes):
+        await self.calls.send_frame(self.chat_id, Device.MICROPHONE, frame)
+
+    async def close(self):
+        try:
+            await self.calls.leave_call(self.chat_id)
+        except Exception as e:
+            print(f"⚠️ Leave call failed: {e}")
+
+
+class FileSink:
+    """Writes PCM frames to a file or named pipe (e.g. for local testing)"""
+
+    def __init__(self, path: str):
+        self.path = Path(path)
+        self.file = None
+
+    async def open(self, chat_id: int):
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        # Opening a FIFO blocks until a reader shows up
+        self.file = await asyncio.get_running_loop().run_in_executor(None, open, self.path, "wb")
+
+    async def write(self, frame: bytes):
+        await asyncio.get_running_loop().run_in_executor(None, self.file.write, frame)
+
+    async def close(self):
+        if self.file:
+            self.file.close()
+
+
+class JitterBuffer:
+    """Bounded FIFO of PCM frames between the decoder and the pacer.
+
+    Playback only starts (and resumes after an underrun) once `prebuffer`
+    frames are queued, so short network stalls are absorbed instead of
+    being heard as stutter.
+    """
+
+    def __init__(self, capacity: int, prebuffer: int):
+        self.frames = deque()
+        self.capacity = capacity
+        self.prebuffer = min(prebuffer, capacity)
+        self.buffering = True
+        self.eof = False
+        self.underruns = 0
+        self._space = asyncio.Event()
+
+    async def put(self, frame: bytes):
+        while len(self.frames) >= self.capacity:
+            self._space.clear()
+            await self._space.wait()
+        self.frames.append(frame)
+        if self.buffering and len(self.frames) >= self.prebuffer:
+            self.buffering = False
+
+    def finish(self):
+        self.eof = True
+        self.buffering = False
+
+    @property
+    def drained(self) -> bool:
+        return self.eof and not self.frames
+
+    def pop(self) -> Optional[bytes]:
+        """Next frame, or None while (re)buffering"""
+        if self.buffering:
+            return None
+        if self.frames:
+            frame = self.frames.popleft()
+            self._space.set()
+            return frame
+        if not self.eof:
+            self.underruns += 1
+            self.buffering = True
+        return None
+
+
+class Track:
+    def __init__(self, video_id: str, title: str, duration: str = None, requested_by: int = None):
+        self.video_id = video_id
+        self.title = title
+        self.duration = duration
+        self.requested_by = requested_by
+        self._source: Optional[asyncio.Future] = None
+
+    def prefetch(self):
+        """Start resolving the source in the background"""
+        if self._source is None:
+            self._source = asyncio.ensure_future(resolve_source(self.video_id))
+
+    async def source(self) -> Optional[str]:
+        self.prefetch()
+        return await asyncio.shield(self._source)
+
+
+class _Stream:
+    """One track being decoded into its own jitter buffer"""
+
+    def __init__(self, track: Track):
+        self.track = track
+        self.buffer = JitterBuffer(
+            config.STREAM_BUFFER_MS // FRAME_MS, config.STREAM_PREBUFFER_MS // FRAME_MS
+        )
+        self.decoded = 0
+        self.failed = False
+        self.task = asyncio.create_task(self._decode())
+
+    async def _decode(self):
+        proc = None
+        try:
+            source = await self.track.source()
+            if not source:
+                self.failed = True
+                return
+            args = ["ffmpeg", "-loglevel", "error"]
+            if source.startswith("http"):
+                args += ["-reconnect", "1", "-reconnect_streamed", "1", "-reconnect_delay_max", "5"]
+            args += ["-i", source, "-vn", "-f", "s16le", "-ar", str(SAMPLE_RATE), "-ac", str(CHANNELS), "pipe:1"]
+            proc = await asyncio.create_subprocess_exec(
+                *args,
+                stdin=asyncio.subprocess.DEVNULL,
+                stdout=asyncio.subprocess.PIPE,
+                stderr=asyncio.subprocess.DEVNULL,
+            )
+            while True:
+                try:
+                    frame = await proc.stdout.readexactly(FRAME_BYTES)
+                except asyncio.IncompleteReadError as e:
+                    if e.partial:
+                        await self.buffer.put(e.partial + SILENCE[len(e.partial):])
+                    break
+                await self.buffer.put(frame)
+                self.decoded += 1
+            if await proc.wait() != 0 and not self.decoded:
+                self.failed = True
+        except Exception as e:
+            print(f"❌ Stream decode failed for {self.track.video_id}: {e}")
+            self.failed = True
+        finally:
+            self.buffer.finish()
+            if proc and proc.returncode is None:
+                proc.kill()
+                # wait() would hang on a paused, unread stdout pipe
+                await proc.communicate()
+
+    async def close(self):
+        self.task.cancel()
+        try:
+            await self.task
+        except asyncio.CancelledError:
+            pass
+
+
+class ChatPlayer:
+    """Queue and real-time playback loop for one chat"""
+
+    def __init__(self, chat_id: int, sink, notify: Callable[[str], Awaitable] = None):
+        self.chat_id = chat_id
+        self.sink = sink
+        self.notify = notify
+        self.queue = deque()
+        self.current: Optional[_Stream] = None
+        self._next: Optional[_Stream] = None
+        self._skip = False
+        self._task: Optional[asyncio.Task] = None
+
+    @property
+    def now_playing(self) -> Optional[Track]:
+        return self.current.track if self.current else None
+
+    def enqueue(self, track: Track) -> int:
+        """Add a track; returns its queue position (0 = playing now)"""
+        if len(self.queue) >= config.STREAM_QUEUE_MAX:
+            raise ValueError(f"Queue is full ({config.STREAM_QUEUE_MAX} tracks)")
+        self.queue.append(track)
+        if len(self.queue) == 1:
+            track.prefetch()
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+            return 0
+        return len(self.queue) + (self._next is not None)
+
+    def skip(self):
+        self._skip = True
+
+    async def stop(self):
+        self.queue.clear()
+        if self._task and not self._task.done():
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+
+    async def _announce(self, text: str):
+        if self.notify:
+            try:
+                await self.notify(text)
+            except Exception as e:
+                print(f"⚠️ Player notify failed: {e}")
+
+    def _advance(self) -> Optional[_Stream]:
+        if self._next is not None:
+            stream, self._next = self._next, None
+            return stream
+        if self.queue:
+            return _Stream(self.queue.popleft())
+        return None
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        try:
+            await self.sink.open(self.chat_id)
+            deadline = loop.time()
+            while True:
+                if self.current is None:
+                    self.current = self._advance()
+                    if self.current is None:
+                        break
+                    if self.queue:
+                        self.queue[0].prefetch()
+                    asyncio.create_task(self._announce(f"🎶 **Now streaming:** {self.current.track.title}"))
+
+                stream = self.current
+                # Gapless: decode the next track while this one drains
+                if stream.buffer.eof and self._next is None and self.queue:
+                    self._next = _Stream(self.queue.popleft())
+
+                frame = stream.buffer.pop()
+                if self._skip or (frame is None and stream.buffer.drained):
+                    self._skip = False
+                    if stream.failed:
+                        asyncio.create_task(self._announce(f"❌ **Could not stream:** {stream.track.title}"))
+                    elif stream.buffer.underruns:
+                        print(f"⚠️ {stream.track.video_id}: {stream.buffer.underruns} buffer underruns")
+                    await stream.close()
+                    self.current = None
+                    continue
+
+                await self.sink.write(frame or SILENCE)
+                deadline += FRAME_MS / 1000
+                delay = deadline - loop.time()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+                elif delay < -0.2:
+                    # Fell far behind (e.g. a slow sink); resync instead of bursting
+                    deadline = loop.time()
+        except Exception as e:
+            print(f"❌ Player error in chat {self.chat_id}: {e}")
+            self.queue.clear()
+            asyncio.create_task(self._announce(f"❌ **Streaming stopped:** {e}"))
+        finally:
+            for stream in (self.current, self._next):
+                if stream:
+                    await stream.close()
+            self.current = self._next = None
+            await self.sink.close()
+            if self.queue:
+                # Tracks were queued while shutting down
+                self._task = asyncio.create_task(self._run())
+            elif players.get(self.chat_id) is self:
+                del players[self.chat_id]
+
+
+# chat_id -> active player
+players: Dict[int, ChatPlayer] = {}
+_sink_factory: Optional[Callable[[int], object]] = None
+
+
+def set_sink_factory(factory: Optional[Callable[[int], object]]):
+    """Choose where players send audio: factory(chat_id) -> sink"""
+    global _sink_factory
+    _sink_factory = factory
+
+
+def get_player(chat_id: int, notify: Callable[[str], Awaitable] = None) -> Optional[ChatPlayer]:
+    """The chat's player, created on first use; None if streaming is unavailable"""
+    player = players.get(chat_id)
+    if player is None and _sink_factory is not None:
+        player = ChatPlayer(chat_id, _sink_factory(chat_id), notify)
+        players[chat_id] = player
+    return player
@@ -0,0 +1,90 @@
+import time
+from typing import Optional
+
+import config
+
+# Adaptive video quality. Download and upload throughput are measured on
+# every transfer and smoothed; a video request then gets the highest rung
+# of the ladder that should be delivered within VIDEO_TARGET_SECONDS at
+# the current rates, so a busy pipeline sends 480p/360p instead of
+# queueing behind a slow 720p job. A lower rung that has to be scaled
+# down from the full quality file (the download API only has one) also
+# pays for that download and the transcode.
+
+# height -> (max width, approximate total bitrate in kbit/s)
+LADDER = {
+    720: (1280, 2500),
+    480: (854, 1200),
+    360: (640, 750),
+}
+MAX_HEIGHT = max(LADDER)
+MIN_SAMPLE_BYTES = 256 * 1024
+
+
+class Throughput:
+    """Exponentially weighted moving average of bytes per second"""
+
+    def __init__(self, prior: float):
+        self.rate = prior
+        self.samples = 0
+        self.updated = 0.0
+
+    def record(self, size: int, seconds: float):
+        if size < MIN_SAMPLE_BYTES or seconds <= 0:
+            return
+        self.rate += config.THROUGHPUT_ALPHA * (size / seconds - self.rate)
+        self.samples += 1
+        self.updated = time.monotonic()
+
+
+download_rate = Throughput(config.DOWNLOAD_RATE_PRIOR)
+upload_rate = Throughput(config.UPLOAD_RATE_PRIOR)
+transcode_rate = Throughput(config.TRANSCODE_RATE_PRIOR)  # source bytes per second
+
+
+def video_format(height: int) -> str:
+    """yt-dlp single-file format selector for a ladder rung"""
+    width = LADDER[height][0]
+    return f"best[height<=?{height}][width<=?{width}]"
+
+
+def merged_video_format(height: int) -> str:
+    """yt-dlp video+audio format selector for a ladder rung"""
+    width = LADDER[height][0]
+    return f"(bestvideo[height<=?{height}][width<=?{width}][ext=mp4])+(bestaudio[ext=m4a])"
+
+
+def delivery_time(size: float, source: Optional[float] = None) -> float:
+    """Estimated seconds to download and then upload `size` bytes.
+
+    With `source`, the file is first downloaded at `source` bytes and
+    transcoded down to `size`.
+    """
+    if source is None:
+        return size / download_rate.rate + size / upload_rate.rate
+    return source / download_rate.rate + source / transcode_rate.rate + size / upload_rate.rate
+
+
+def choose_height(duration: int, size: Optional[int] = None, transcoded: bool = True) -> int:
+    """Highest quality expected to arrive within the target time.
+
+    `size` is the probed size of the full quality file, when known; the
+    lower rungs are estimated from their bitrate and the duration.
+    `transcoded` says lower rungs are scaled from the full quality file
+    rather than fetched at their own quality.
+    """
+    if not duration and not size:
+        return MAX_HEIGHT
+    full = size or LADDER[MAX_HEIGHT][1] * 1000 / 8 * duration
+    estimates = {}
+    for height in sorted(LADDER, reverse=True):
+        if height == MAX_HEIGHT:
+            seconds = delivery_time(full)
+        else:
+            estimate = LADDER[height][1] * 1000 / 8 * duration
+            seconds = delivery_time(estimate, full if transcoded else None)
+        if seconds <= config.VIDEO_TARGET_SECONDS:
+            return height
+        estimates[height] = seconds
+    # Nothing makes it in time: send whichever arrives first
+    return min(estimates, key=estimates.get)
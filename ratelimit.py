@@ -0,0 +1,169 @@
+import asyncio
+import secrets
+import time
+from collections import deque
+from contextlib import asynccontextmanager
+from typing import Callable, Dict, List, Optional, Tuple
+
+import config
+from .database import SHARED, enqueue_write, execute_transaction
+from .job_queue import owner_name
+
+# Abuse shedding for download requests, in two layers:
+#  * sliding-window counters per user and per chat, checked by a Pyrogram
+#    middleware before any handler runs (video costs more than audio);
+#  * a bounded pool of job slots: when every slot is busy new jobs wait
+#    in a short queue, and once that is full they are refused.
+# All state is dropped again as users go quiet. With several processes a
+# user's running jobs are also counted in the database, since their chats
+# may be spread over shard workers.
+
+WEIGHTS = {
+    "audio": config.RATE_WEIGHT_AUDIO,
+    "video": config.RATE_WEIGHT_VIDEO,
+}
+
+# key -> [window start, current window weight, previous window weight, warned in window]
+_windows: Dict[Tuple[str, int], List[float]] = {}
+
+
+def _window(key: Tuple[str, int], now: float) -> List[float]:
+    start = now - now % config.RATE_WINDOW
+    state = _windows.get(key)
+    if state is None:
+        if len(_windows) > config.RATE_MAX_TRACKED:
+            _prune(now)
+        state = _windows[key] = [start, 0.0, 0.0, -1.0]
+    elif state[0] != start:
+        state[2] = state[1] if start - state[0] == config.RATE_WINDOW else 0.0
+        state[1] = 0.0
+        state[0] = start
+    return state
+
+
+def _estimate(state: List[float], now: float) -> float:
+    # Previous window's weight, scaled by how much of it still overlaps
+    overlap = 1 - (now - state[0]) / config.RATE_WINDOW
+    return state[2] * overlap + state[1]
+
+
+def _prune(now: float):
+    """Forget keys with nothing in the last two windows"""
+    for key in [k for k, state in _windows.items() if now - state[0] >= 2 * config.RATE_WINDOW]:
+        del _windows[key]
+
+
+def _limits(chat_id: int, user_id: int):
+    yield ("user", user_id), config.RATE_USER_LIMIT
+    if chat_id != user_id:
+        yield ("chat", chat_id), config.RATE_CHAT_LIMIT
+
+
+def hit(chat_id: int, user_id: int, kind: str) -> Tuple[bool, bool]:
+    """Charge one request; returns (allowed, should_warn)"""
+    now = time.time()
+    weight = WEIGHTS.get(kind, 1)
+    states = [(_window(key, now), limit) for key, limit in _limits(chat_id, user_id)]
+    for state, limit in states:
+        if _estimate(state, now) + weight > limit:
+            # Warn once per window, stay silent for the rest of the burst
+            warn = state[3] != state[0]
+            state[3] = state[0]
+            return False, warn
+    for state, _ in states:
+        state[1] += weight
+    return True, False
+
+
+class Overloaded(Exception):
+    pass
+
+
+_active = 0
+_user_active: Dict[int, int] = {}
+_waiting = deque()
+
+
+def _claim_shared(conn, user_id: int, token: str, now: float) -> bool:
+    # Rows older than JOB_TIMEOUT belong to processes that died mid-job
+    conn.execute("DELETE FROM active_jobs WHERE started_at <= ?", (now - config.JOB_TIMEOUT,))
+    running = conn.execute("SELECT COUNT(*) FROM active_jobs WHERE user_id = ?", (user_id,)).fetchone()[0]
+    if running >= config.RATE_USER_CONCURRENT:
+        return False
+    conn.execute(
+        "INSERT INTO active_jobs (job_id, user_id, owner, started_at) VALUES (?, ?, ?, ?)",
+        (token, user_id, owner_name(), now),
+    )
+    return True
+
+
+def _release():
+    global _active
+    while _waiting:
+        waiter = _waiting.popleft()
+        if not waiter.done():
+            # Hand the slot straight to the next job in line
+            waiter.set_result(None)
+            return
+    _active -= 1
+
+
+def _user_done(user_id: Optional[int]):
+    if user_id is not None:
+        _user_active[user_id] -= 1
+        if not _user_active[user_id]:
+            del _user_active[user_id]
+
+
+@asynccontextmanager
+async def job_slot(user_id: Optional[int], on_queued: Callable[[int], None] = None):
+    """Hold one of RATE_MAX_ACTIVE job slots, queueing for it if needed"""
+    global _active
+    if user_id is not None and _user_active.get(user_id, 0) >= config.RATE_USER_CONCURRENT:
+        raise Overloaded(f"You already have {config.RATE_USER_CONCURRENT} downloads in progress, please wait")
+
+    if _active < config.RATE_MAX_ACTIVE:
+        _active += 1
+    elif len(_waiting) >= config.RATE_MAX_QUEUED:
+        raise Overloaded("The bot is very busy right now, please try again in a few minutes")
+    else:
+        # A queued job already counts as one of the user's downloads
+        if user_id is not None:
+            _user_active[user_id] = _user_active.get(user_id, 0) + 1
+        ahead = sum(1 for waiter in _waiting if not waiter.done())
+        waiter = asyncio.get_running_loop().create_future()
+        _waiting.append(waiter)
+        if on_queued:
+            on_queued(ahead)
+        try:
+            await waiter
+        except asyncio.CancelledError:
+            if waiter.done() and not waiter.cancelled():
+                _release()
+            else:
+                waiter.cancel()
+            _user_done(user_id)
+            raise
+        _user_done(user_id)
+
+    token = None
+    if user_id is not None and SHARED:
+        token = secrets.token_hex(8)
+        try:
+            claimed = await execute_transaction(_claim_shared, user_id, token, time.time())
+        except BaseException:
+            _release()
+            raise
+        if not claimed:
+            _release()
+            raise Overloaded(f"You already have {config.RATE_USER_CONCURRENT} downloads running, please wait")
+
+    if user_id is not None:
+        _user_active[user_id] = _user_active.get(user_id, 0) + 1
+    try:
+        yield
+    finally:
+        _user_done(user_id)
+        if token:
+            enqueue_write("DELETE FROM active_jobs WHERE job_id = ?", (token,))
+        _release()
@@ -0,0 +1,179 @@
+import json
+import math
+import re
+import time
+from typing import Dict, Any, List, Optional
+
+import config
+from .database import enqueue_write, execute_read
+from .links import WATCH_URL
+
+# Local full-text index of every track the bot has seen. Common queries
+# are answered from here; anything it is not confident about goes to
+# YouTube and the results are indexed for next time.
+
+_TOKEN_RE = re.compile(r"\w+", re.UNICODE)
+
+_COLUMNS = "t.video_id, t.title, t.duration, t.thumbnail, t.views, t.channel, t.plays"
+
+
+def _tokens(query: str) -> List[str]:
+    return _TOKEN_RE.findall(query.lower())
+
+
+def normalize_query(query: str) -> str:
+    return " ".join(_tokens(query))
+
+
+def _to_result(row: tuple) -> Dict[str, Any]:
+    video_id, title, duration, thumbnail, views, channel, _ = row
+    return {
+        'id': video_id,
+        'title': title,
+        'duration': duration,
+        'thumbnail': thumbnail,
+        'views': views or 'Unknown',
+        'channel': channel or 'Unknown',
+        'url': WATCH_URL + video_id,
+    }
+
+
+def _rank(rows: List[tuple], limit: int, min_score: float = 0) -> List[tuple]:
+    # rows end with the bm25 score (lower is better); plays boost it. Rows
+    # scoring worse than -min_score (terms common to much of the index, a
+    # prefix hit on a long word) are dropped before ranking
+    ranked = sorted(
+        (row for row in rows if row[-1] <= -min_score),
+        key=lambda row: row[-1] * (1 + math.log1p(row[-2])),
+    )
+    return [row[:-1] for row in ranked[:limit]]
+
+
+def index_tracks(results: List[Dict[str, Any]]):
+    """Queue search/track metadata records for indexing"""
+    now = time.time()
+    for result in results:
+        enqueue_write(
+            "INSERT INTO tracks (video_id, title, channel, duration, thumbnail, views, seen_at) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?) ON CONFLICT(video_id) DO UPDATE SET "
+            "title = excluded.title, channel = COALESCE(excluded.channel, channel), "
+            "duration = COALESCE(excluded.duration, duration), "
+            "thumbnail = COALESCE(excluded.thumbnail, thumbnail), "
+            "views = COALESCE(excluded.views, views), seen_at = excluded.seen_at",
+            (
+                result['id'],
+                result['title'],
+                result.get('channel'),
+                result.get('duration'),
+                result.get('thumbnail'),
+                result.get('views'),
+                now,
+            ),
+        )
+
+
+def remember_query(query: str, results: List[Dict[str, Any]]):
+    """Remember which tracks YouTube returned for a query"""
+    key = normalize_query(query)
+    if not key or not results:
+        return
+    enqueue_write(
+        "INSERT INTO search_queries (query, video_ids, updated_at) VALUES (?, ?, ?) "
+        "ON CONFLICT(query) DO UPDATE SET video_ids = excluded.video_ids, updated_at = excluded.updated_at",
+        (key, json.dumps([result['id'] for result in results]), time.time()),
+    )
+
+
+def record_play(video_id: str):
+    """Count a play towards the track's ranking popularity"""
+    enqueue_write("UPDATE tracks SET plays = plays + 1 WHERE video_id = ?", (video_id,))
+
+
+async def get_track(video_id: str) -> Optional[Dict[str, Any]]:
+    """Indexed metadata for one video, if it has been seen"""
+    try:
+        rows = await execute_read(f"SELECT {_COLUMNS} FROM tracks t WHERE t.video_id = ?", (video_id,))
+    except Exception as e:
+        print(f"⚠️ Local search error: {e}")
+        return None
+    return _to_result(rows[0]) if rows else None
+
+
+async def _cached_query(key: str, limit: int) -> Optional[List[Dict[str, Any]]]:
+    rows = await execute_read(
+        "SELECT video_ids FROM search_queries WHERE query = ? AND updated_at > ?",
+        (key, time.time() - config.SEARCH_QUERY_TTL),
+    )
+    if not rows:
+        return None
+    video_ids = json.loads(rows[0][0])[:limit]
+    placeholders = ",".join("?" * len(video_ids))
+    rows = await execute_read(
+        f"SELECT {_COLUMNS} FROM tracks t WHERE t.video_id IN ({placeholders})",
+        tuple(video_ids),
+    )
+    by_id = {row[0]: row for row in rows}
+    if len(by_id) < len(video_ids):
+        return None
+    return [_to_result(by_id[video_id]) for video_id in video_ids]
+
+
+async def _prefix_search(tokens: List[str], limit: int, min_score: float = 0) -> List[tuple]:
+    match = " ".join('"' + token.replace('"', '""') + '"*' for token in tokens)
+    rows = await execute_read(
+        f"SELECT {_COLUMNS}, bm25(tracks_fts) FROM tracks_fts "
+        "JOIN tracks t ON t.id = tracks_fts.rowid WHERE tracks_fts MATCH ? "
+        "ORDER BY bm25(tracks_fts) LIMIT ?",
+        (match, limit * 4),
+    )
+    return _rank(rows, limit, min_score)
+
+
+async def _fuzzy_search(tokens: List[str], limit: int) -> List[tuple]:
+    # OR together every trigram of the query so near-misses still match
+    grams = {token[i:i + 3] for token in tokens for i in range(len(token) - 2)}
+    if not grams:
+        return []
+    match = " OR ".join('"' + gram.replace('"', '""') + '"' for gram in grams)
+    rows = await execute_read(
+        f"SELECT {_COLUMNS}, bm25(tracks_trigram) FROM tracks_trigram "
+        "JOIN tracks t ON t.id = tracks_trigram.rowid WHERE tracks_trigram MATCH ? "
+        "ORDER BY bm25(tracks_trigram) LIMIT ?",
+        (match, limit * 4),
+    )
+    return _rank(rows, limit)
+
+
+async def lookup(query: str, limit: int = 10) -> Optional[List[Dict[str, Any]]]:
+    """Answer a query locally, or None when the network should be asked"""
+    tokens = _tokens(query)
+    if not tokens:
+        return None
+    try:
+        cached = await _cached_query(" ".join(tokens), limit)
+        if cached:
+            return cached
+        # only rows that match well enough count towards being confident
+        rows = await _prefix_search(tokens, limit, config.SEARCH_LOCAL_MIN_SCORE * len(tokens))
+    except Exception as e:
+        print(f"⚠️ Local search error: {e}")
+        return None
+    if len(rows) < min(limit, config.SEARCH_LOCAL_MIN_RESULTS):
+        return None
+    return [_to_result(row) for row in rows]
+
+
+async def fuzzy_lookup(query: str, limit: int = 10) -> List[Dict[str, Any]]:
+    """Best-effort typo tolerant local search"""
+    tokens = _tokens(query)
+    if not tokens:
+        return []
+    try:
+        rows = await _prefix_search(tokens, limit)
+        if len(rows) < limit:
+            seen = {row[0] for row in rows}
+            rows += [row for row in await _fuzzy_search(tokens, limit) if row[0] not in seen]
+    except Exception as e:
+        print(f"⚠️ Local search error: {e}")
+        return []
+    return [_to_result(row) for row in rows[:limit]]
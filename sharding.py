@@ -0,0 +1,200 @@
+import asyncio
+import itertools
+import json
+import os
+import sys
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+
+# Multi-process mode. The front process owns the Telegram updates and
+# hands download jobs to SHARD_WORKERS worker processes, picked by
+# chat_id so a chat's jobs (and their cancel buttons) always land on the
+# same worker. A worker is bot.py started with `--worker N`: it runs its
+# own client without updates and shares the download cache directory and
+# the SQLite database (file_ids, search index, the shared caches and
+# quotas, see database.SHARED) with the other processes.
+#
+# Messages are JSON lines: front -> worker over the worker's stdin,
+# worker -> front over a dedicated pipe, since stdout carries the logs.
+# A message with an "id" expects a reply carrying the same id. Jobs sent
+# with dispatch() are replied to when they finish; the ones a worker still
+# had when it died are handed to `on_lost`, so the front can tell the user.
+
+EVENT_FD_ENV = "SHARD_EVENT_FD"
+
+
+class ShardPool:
+    """Worker processes of the front process, restarted if they die"""
+
+    def __init__(self, argv: List[str], size: int, on_event: Callable[[Dict[str, Any]], Awaitable],
+                 on_lost: Callable[[Dict[str, Any]], Awaitable] = None):
+        self.argv = argv
+        self.size = size
+        self.on_event = on_event
+        self.on_lost = on_lost
+        self.procs: List[Optional[asyncio.subprocess.Process]] = [None] * size
+        self.replies: Dict[int, asyncio.Future] = {}
+        # Per worker: message id -> dispatched job not finished yet
+        self.outstanding: List[Dict[int, Dict[str, Any]]] = [{} for _ in range(size)]
+        self.ids = itertools.count(1)
+        self.tasks: List[asyncio.Task] = []
+        self.started = [asyncio.Event() for _ in range(size)]
+
+    def shard(self, chat_id: int) -> int:
+        return chat_id % self.size
+
+    async def start(self):
+        self.tasks = [asyncio.create_task(self._supervise(n)) for n in range(self.size)]
+        await asyncio.gather(*(event.wait() for event in self.started))
+        print(f"✅ Started {self.size} shard workers")
+
+    async def stop(self):
+        for proc in self.procs:
+            if proc and proc.returncode is None:
+                # EOF on stdin tells the worker to finish up and exit
+                proc.stdin.close()
+        for task in self.tasks:
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+        for proc in self.procs:
+            if proc and proc.returncode is None:
+                try:
+                    await asyncio.wait_for(proc.wait(), timeout=10)
+                except asyncio.TimeoutError:
+                    proc.kill()
+                    await proc.wait()
+
+    async def send(self, chat_id: int, message: Dict[str, Any]):
+        """Hand a message to the worker that owns `chat_id`"""
+        n = self.shard(chat_id)
+        await self.started[n].wait()
+        proc = self.procs[n]
+        proc.stdin.write((json.dumps(message) + "\n").encode())
+        await proc.stdin.drain()
+
+    async def dispatch(self, chat_id: int, message: Dict[str, Any]):
+        """Hand over a job; `on_lost` gets it back if its worker dies first"""
+        n = self.shard(chat_id)
+        message_id = next(self.ids)
+        self.outstanding[n][message_id] = message
+        try:
+            await self.send(chat_id, dict(message, id=message_id))
+        except BaseException:
+            self.outstanding[n].pop(message_id, None)
+            raise
+
+    async def request(self, chat_id: int, message: Dict[str, Any], timeout: float = 10) -> Any:
+        """Send a message and wait for the worker's reply"""
+        request_id = next(self.ids)
+        future = asyncio.get_running_loop().create_future()
+        self.replies[request_id] = future
+        try:
+            await self.send(chat_id, dict(message, id=request_id))
+            return await asyncio.wait_for(future, timeout)
+        finally:
+            self.replies.pop(request_id, None)
+
+    async def _supervise(self, n: int):
+        while True:
+            read_fd, write_fd = os.pipe()
+            try:
+                proc = await asyncio.create_subprocess_exec(
+                    *self.argv, "--worker", str(n),
+                    stdin=asyncio.subprocess.PIPE,
+                    pass_fds=(write_fd,),
+                    env=dict(os.environ, **{EVENT_FD_ENV: str(write_fd)}),
+                )
+            finally:
+                os.close(write_fd)
+            self.procs[n] = proc
+            self.started[n].set()
+            await self._read_events(n, os.fdopen(read_fd, "rb"))
+            code = await proc.wait()
+            print(f"⚠️ Shard worker {n} exited with code {code}, restarting")
+            self.started[n].clear()
+            lost, self.outstanding[n] = self.outstanding[n], {}
+            for message in lost.values():
+                if self.on_lost is None:
+                    continue
+                try:
+                    await self.on_lost(message)
+                except Exception as e:
+                    print(f"⚠️ Lost job of shard {n} could not be reported: {e}")
+            await asyncio.sleep(1)
+
+    async def _read_events(self, n: int, pipe):
+        loop = asyncio.get_running_loop()
+        reader = asyncio.StreamReader(limit=2 ** 20)
+        transport, _ = await loop.connect_read_pipe(lambda: asyncio.StreamReaderProtocol(reader), pipe)
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    return
+                event = json.loads(line)
+                if "reply" in event:
+                    if event.get("error"):
+                        print(f"⚠️ Shard {n} could not reply: {event['error']}")
+                    self.outstanding[n].pop(event["reply"], None)
+                    future = self.replies.get(event["reply"])
+                    if future and not future.done():
+                        future.set_result(event.get("result"))
+                    continue
+                try:
+                    await self.on_event(event)
+                except Exception as e:
+                    print(f"⚠️ Shard {n} event failed: {e}")
+        finally:
+            transport.close()
+
+
+def worker_id() -> Optional[int]:
+    """This process's shard number, or None in the front process"""
+    if "--worker" not in sys.argv:
+        return None
+    return int(sys.argv[sys.argv.index("--worker") + 1])
+
+
+def emit(event: Dict[str, Any]):
+    """Send an event from a worker to the front process"""
+    # Events are small and the front reads them continuously, so a
+    # plain blocking write is fine
+    os.write(int(os.environ[EVENT_FD_ENV]), (json.dumps(event) + "\n").encode())
+
+
+async def serve(handle: Callable[[Dict[str, Any]], Awaitable[Any]]):
+    """Worker loop: run `handle` for each message until the front goes away"""
+    loop = asyncio.get_running_loop()
+    reader = asyncio.StreamReader(limit=2 ** 20)
+    await loop.connect_read_pipe(lambda: asyncio.StreamReaderProtocol(reader), sys.stdin)
+    tasks = set()
+
+    async def run(message: Dict[str, Any]):
+        try:
+            result = await handle(message)
+        except Exception as e:
+            print(f"❌ Shard job {message.get('op')} failed: {e}")
+            result = None
+        if "id" not in message:
+            return
+        try:
+            emit({"reply": message["id"], "result": result})
+        except Exception as e:
+            # Never leave the front waiting for a reply it won't get
+            print(f"❌ Shard reply to {message.get('op')} failed: {e}")
+            emit({"reply": message["id"], "result": None, "error": str(e)})
+
+    while True:
+        line = await reader.readline()
+        if not line:
+            break
+        task = asyncio.create_task(run(json.loads(line)))
+        tasks.add(task)
+        task.add_done_callback(tasks.discard)
+    for task in list(tasks):
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+
+
+def has_front() -> bool:
+    """Whether this worker was started by a front process (not on its own)"""
+    return EVENT_FD_ENV in os.environ
@@ -0,0 +1,124 @@
+import asyncio
+import time
+from typing import Callable, Dict, Optional
+
+from pyrogram.errors import MessageNotModified
+from pyrogram.types import Message
+
+import config
+from .formatters import format_file_size
+from .outbound import submit, PRIORITY_STATUS
+
+# Per-request status messages. Updates are coalesced: only the latest
+# text is ever sent, edits in one chat are spaced at least
+# STATUS_EDIT_INTERVAL apart, and states superseded while waiting for a
+# slot are dropped without an API call. Edits go through the outbound
+# scheduler at status priority, behind media sends and replies.
+
+# chat_id -> monotonic time before which no status edit may be sent
+_next_edit_at: Dict[int, float] = {}
+
+
+def _reserve_slot(chat_id: int) -> float:
+    """Claim the next edit slot for a chat; returns seconds to wait"""
+    now = time.monotonic()
+    if len(_next_edit_at) > 10000:
+        for stale in [cid for cid, at in _next_edit_at.items() if at < now]:
+            del _next_edit_at[stale]
+    at = max(now, _next_edit_at.get(chat_id, 0.0))
+    _next_edit_at[chat_id] = at + config.STATUS_EDIT_INTERVAL
+    return at - now
+
+
+def _progress_bar(current: int, total: int, width: int = 12) -> str:
+    filled = int(width * current / total) if total else 0
+    return "█" * filled + "░" * (width - filled)
+
+
+class StatusChannel:
+    """Coalescing, rate-limited status message for one request"""
+
+    def __init__(self, message: Message, reply_markup=None):
+        self.message = message
+        self.reply_markup = reply_markup
+        self.chat_id = message.chat.id
+        self._wanted: Optional[str] = None
+        self._shown: Optional[str] = message.text
+        self._task: Optional[asyncio.Task] = None
+        self._closed = False
+
+    def update(self, text: str):
+        """Set the latest state; never waits on Telegram"""
+        if self._closed:
+            return
+        self._wanted = text
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._pump())
+
+    def progress(self, label: str) -> Callable[[int, int], None]:
+        """Progress callback for downloads and Pyrogram uploads"""
+        # Pyrogram calls sync callbacks from its executor threads, where
+        # there is no event loop; hand every update back to this one
+        loop = asyncio.get_running_loop()
+
+        def callback(current: int, total: int):
+            if total:
+                percent = current * 100 // total
+                text = (
+                    f"{label}\n`{_progress_bar(current, total)}` {percent}%\n"
+                    f"{format_file_size(current)} / {format_file_size(total)}"
+                )
+            else:
+                text = f"{label}\n{format_file_size(current)}"
+            loop.call_soon_threadsafe(self.update, text)
+        return callback
+
+    async def _edit(self, text: str):
+        wait = _reserve_slot(self.chat_id)
+        if wait > 0:
+            await asyncio.sleep(wait)
+        try:
+            await submit(self.chat_id, self.message.edit_text, text, priority=PRIORITY_STATUS)
+        except MessageNotModified:
+            pass
+        self._shown = text
+
+    async def _pump(self):
+        while not self._closed and self._wanted != self._shown:
+            wait = _reserve_slot(self.chat_id)
+            if wait > 0:
+                await asyncio.sleep(wait)
+            if self._closed:
+                return
+            text = self._wanted
+            if text == self._shown:
+                return
+            try:
+                await submit(self.chat_id, self.message.edit_text, text, priority=PRIORITY_STATUS,
+                             reply_markup=self.reply_markup)
+                self._shown = text
+            except MessageNotModified:
+                self._shown = text
+            except Exception as e:
+                print(f"⚠️ Status update failed: {e}")
+                return
+
+    async def _close(self):
+        self._closed = True
+        if self._task and not self._task.done():
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+
+    async def finish(self, text: str):
+        """Show a final state (without buttons); pending updates are dropped"""
+        await self._close()
+        if text != self._shown or self.reply_markup:
+            await self._edit(text)
+
+    async def delete(self):
+        """Delete the status message; pending updates are dropped"""
+        await self._close()
+        await submit(self.chat_id, self.message.delete, priority=PRIORITY_STATUS)
@@ -0,0 +1,99 @@
+import asyncio
+import io
+import os
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Optional
+
+import aiohttp
+from PIL import Image
+
+import config
+
+# Thumbnails for uploads: fetched from YouTube, scaled down to what
+# Telegram accepts (JPEG, at most 320px per side, under 200 KB) in a
+# worker pool and cached on disk by video ID.
+
+THUMB_DIR = Path("downloads/thumbs")
+MAX_SIDE = 320
+MAX_BYTES = 200 * 1024
+
+_thumb_executor = ThreadPoolExecutor(max_workers=config.THUMB_WORKERS, thread_name_prefix="thumb")
+_inflight = {}
+_cached_count = None
+
+
+def _resize(data: bytes, target: Path):
+    image = Image.open(io.BytesIO(data))
+    image.thumbnail((MAX_SIDE, MAX_SIDE))
+    if image.mode != "RGB":
+        image = image.convert("RGB")
+    quality = 90
+    while True:
+        buffer = io.BytesIO()
+        image.save(buffer, "JPEG", quality=quality, optimize=True)
+        if buffer.tell() <= MAX_BYTES or quality <= 30:
+            break
+        quality -= 15
+    temp_path = target.with_suffix(".part")
+    temp_path.write_bytes(buffer.getvalue())
+    temp_path.rename(target)
+
+
+def _evict():
+    """Remove the least recently used thumbnails beyond the cache size"""
+    global _cached_count
+    entries = sorted(
+        (entry for entry in os.scandir(THUMB_DIR) if entry.name.endswith(".jpg")),
+        key=lambda entry: entry.stat().st_mtime,
+    )
+    excess = len(entries) - config.THUMB_CACHE_MAX
+    for entry in entries[:max(excess, 0)]:
+        try:
+            os.remove(entry.path)
+        except OSError:
+            pass
+    _cached_count = len(entries) - max(excess, 0)
+
+
+async def _fetch(video_id: str, url: str, target: Path) -> Optional[str]:
+    global _cached_count
+    timeout = aiohttp.ClientTimeout(total=config.THUMB_TIMEOUT)
+    async with aiohttp.ClientSession(timeout=timeout) as session:
+        async with session.get(url) as response:
+            if response.status != 200:
+                print(f"⚠️ Thumbnail fetch failed for {video_id}: HTTP {response.status}")
+                return None
+            data = await response.read()
+
+    loop = asyncio.get_running_loop()
+    await loop.run_in_executor(_thumb_executor, _resize, data, target)
+
+    if _cached_count is None or _cached_count >= config.THUMB_CACHE_MAX:
+        # The scan counts the new file along with the rest
+        await loop.run_in_executor(_thumb_executor, _evict)
+    else:
+        _cached_count += 1
+    return str(target)
+
+
+async def get_thumbnail(video_id: str, url: str) -> Optional[str]:
+    """Local path of a Telegram-ready thumbnail, or None if unavailable"""
+    THUMB_DIR.mkdir(parents=True, exist_ok=True)
+    target = THUMB_DIR / f"{video_id}.jpg"
+    if target.exists():
+        target.touch()
+        return str(target)
+
+    # Concurrent requests for the same video share one fetch
+    key = (video_id, asyncio.get_running_loop())
+    task = _inflight.get(key)
+    if task is None:
+        task = asyncio.ensure_future(_fetch(video_id, url, target))
+        _inflight[key] = task
+        task.add_done_callback(lambda _: _inflight.pop(key, None))
+    try:
+        return await asyncio.shield(task)
+    except Exception as e:
+        print(f"⚠️ Thumbnail error for {video_id}: {e}")
+        return None
@@ -0,0 +1,228 @@
+import asyncio
+import contextvars
+import functools
+import json
+import os
+import secrets
+import time
+from contextlib import contextmanager
+from typing import Any, Dict, List, Optional
+
+import config
+from .filewriter import run_io
+
+# Request tracing. bot.py starts a trace for every update it handles, and
+# spans opened anywhere underneath (youtube.py, the outbound scheduler,
+# uploads, status edits) nest under it through a context variable, which
+# asyncio copies into every task the request creates. Jobs handed to shard
+# workers or the job queue carry the trace along and continue it there.
+#
+# Finished spans are batched and appended to TRACE_FILE as OTLP/JSON, one
+# ExportTraceServiceRequest per line, which an OpenTelemetry collector's
+# otlpjson file receiver (or plain jq) can read. Each flush is a single
+# O_APPEND write, so several processes can share the file.
+
+SPAN_KIND_INTERNAL = 1
+SPAN_KIND_SERVER = 2
+
+
+class Span:
+    __slots__ = ("trace_id", "span_id", "parent_id", "name", "kind", "start", "end", "attributes", "error")
+
+    def __init__(self, name: str, trace_id: str, parent_id: Optional[str], attributes: Dict[str, Any],
+                 kind: int = SPAN_KIND_INTERNAL):
+        self.trace_id = trace_id
+        self.span_id = secrets.token_hex(8)
+        self.parent_id = parent_id
+        self.name = name
+        self.kind = kind
+        self.start = time.time_ns()
+        self.end = None
+        self.attributes = {key: value for key, value in attributes.items() if value is not None}
+        self.error: Optional[str] = None
+
+    def set(self, **attributes):
+        self.attributes.update((key, value) for key, value in attributes.items() if value is not None)
+
+
+_current: contextvars.ContextVar[Optional[Span]] = contextvars.ContextVar("span", default=None)
+_finished: List[Span] = []
+_flusher_task: Optional[asyncio.Task] = None
+
+
+@contextmanager
+def _activate(current: Span):
+    token = _current.set(current)
+    try:
+        yield current
+    except asyncio.CancelledError:
+        current.error = "cancelled"
+        raise
+    except Exception as e:
+        current.error = f"{type(e).__name__}: {e}"
+        raise
+    finally:
+        current.end = time.time_ns()
+        _current.reset(token)
+        if len(_finished) >= config.TRACE_MAX_PENDING:
+            del _finished[:len(_finished) // 2]
+        _finished.append(current)
+
+
+@contextmanager
+def span(name: str, **attributes):
+    """Time a block as a child of the current span; a no-op outside a trace"""
+    parent = _current.get()
+    if parent is None or not config.TRACING:
+        yield None
+        return
+    with _activate(Span(name, parent.trace_id, parent.span_id, attributes)) as current:
+        yield current
+
+
+@contextmanager
+def trace(name: str, **attributes):
+    """Start a new trace (or a child span when one is already running)"""
+    if not config.TRACING:
+        yield None
+        return
+    parent = _current.get()
+    if parent is not None:
+        with span(name, **attributes) as current:
+            yield current
+        return
+    with _activate(Span(name, secrets.token_hex(16), None, attributes, SPAN_KIND_SERVER)) as current:
+        yield current
+
+
+@contextmanager
+def resume(carrier: Optional[Dict[str, str]], name: str, **attributes):
+    """Continue a trace started in another process (see `carrier`)"""
+    if not carrier or not config.TRACING:
+        with trace(name, **attributes) as current:
+            yield current
+        return
+    with _activate(Span(name, carrier["trace_id"], carrier["span_id"], attributes)) as current:
+        yield current
+
+
+def traced(name: str):
+    """Decorate a coroutine function to run in a span of its own"""
+    def decorator(func):
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            with span(name):
+                return await func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def annotate(**attributes):
+    """Add attributes to the current span, if there is one"""
+    current = _current.get()
+    if current is not None and config.TRACING:
+        current.set(**attributes)
+
+
+def carrier() -> Optional[Dict[str, str]]:
+    """The current trace position, to pass along with a job"""
+    current = _current.get()
+    if current is None:
+        return None
+    return {"trace_id": current.trace_id, "span_id": current.span_id}
+
+
+def traced_update(name: str):
+    """Decorate a Pyrogram handler so each update gets its own trace"""
+    def decorator(func):
+        @functools.wraps(func)
+        async def wrapper(client, update, *args):
+            message = getattr(update, "message", None) or update
+            chat = getattr(message, "chat", None)
+            user = getattr(update, "from_user", None)
+            with trace(name, chat_id=chat.id if chat else None, user_id=user.id if user else None):
+                return await func(client, update, *args)
+        return wrapper
+    return decorator
+
+
+def _attribute(key: str, value: Any) -> Dict[str, Any]:
+    if isinstance(value, bool):
+        typed = {"boolValue": value}
+    elif isinstance(value, int):
+        typed = {"intValue": str(value)}
+    elif isinstance(value, float):
+        typed = {"doubleValue": value}
+    else:
+        typed = {"stringValue": str(value)}
+    return {"key": key, "value": typed}
+
+
+def _export(spans: List[Span]) -> str:
+    resource = [
+        _attribute("service.name", config.TRACE_SERVICE_NAME),
+        _attribute("process.pid", os.getpid()),
+    ]
+    return json.dumps({"resourceSpans": [{
+        "resource": {"attributes": resource},
+        "scopeSpans": [{
+            "scope": {"name": "musicbot"},
+            "spans": [{
+                "traceId": s.trace_id,
+                "spanId": s.span_id,
+                "parentSpanId": s.parent_id or "",
+                "name": s.name,
+                "kind": s.kind,
+                "startTimeUnixNano": str(s.start),
+                "endTimeUnixNano": str(s.end),
+                "attributes": [_attribute(key, value) for key, value in s.attributes.items()],
+                "status": {"code": 2, "message": s.error} if s.error else {},
+            } for s in spans],
+        }],
+    }]}, ensure_ascii=False) + "\n"
+
+
+def _append(path: str, data: bytes):
+    fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+    try:
+        os.write(fd, data)
+    finally:
+        os.close(fd)
+
+
+async def flush():
+    """Write every finished span to TRACE_FILE"""
+    if not _finished:
+        return
+    batch = _finished[:]
+    _finished.clear()
+    try:
+        await run_io(_append, config.TRACE_FILE, _export(batch).encode())
+    except Exception as e:
+        print(f"⚠️ Trace export failed ({len(batch)} spans): {e}")
+
+
+async def _flusher():
+    while True:
+        await asyncio.sleep(config.TRACE_FLUSH_INTERVAL)
+        await flush()
+
+
+def init_tracing():
+    """Start exporting spans, if TRACING is on"""
+    global _flusher_task
+    if config.TRACING and (_flusher_task is None or _flusher_task.done()):
+        _flusher_task = asyncio.create_task(_flusher())
+
+
+async def close_tracing():
+    """Stop the exporter and write out what is left"""
+    global _flusher_task
+    if _flusher_task is not None:
+        _flusher_task.cancel()
+        try:
+            await _flusher_task
+        except asyncio.CancelledError:
+            pass
+        _flusher_task = None
+    await flush()
@@ -0,0 +1,188 @@
+import asyncio
+import os
+import weakref
+from pathlib import Path
+from typing import Optional
+
+import config
+
+# ffmpeg transcoding pool. Jobs run in a bounded number of ffmpeg
+# processes at reduced CPU priority so downloads and the event loop
+# stay responsive; outputs are cached by (video_id, variant) and
+# concurrent requests for the same output share one job.
+
+TRANSCODE_DIR = Path("downloads/transcoded")
+
+VARIANTS = {
+    # Voice chat streaming
+    "opus": {
+        "ext": "ogg",
+        "format": "ogg",
+        "args": ["-vn", "-c:a", "libopus", "-b:a", "128k", "-ar", "48000"],
+    },
+    # Voice notes (previews)
+    "voice": {
+        "ext": "ogg",
+        "format": "ogg",
+        "args": ["-vn", "-c:a", "libopus", "-b:a", "64k", "-ac", "1", "-application", "voip"],
+    },
+    "mp3_192": {
+        "ext": "mp3",
+        "format": "mp3",
+        "args": ["-vn", "-c:a", "libmp3lame", "-b:a", "192k"],
+    },
+    "video_480p": {
+        "ext": "mp4",
+        "format": "mp4",
+        "args": [
+            "-vf", "scale=-2:'min(480,ih)'", "-c:v", "libx264", "-preset", "veryfast",
+            "-crf", "26", "-c:a", "aac", "-b:a", "128k", "-movflags", "+faststart",
+        ],
+    },
+    "video_360p": {
+        "ext": "mp4",
+        "format": "mp4",
+        "args": [
+            "-vf", "scale=-2:'min(360,ih)'", "-c:v", "libx264", "-preset", "veryfast",
+            "-crf", "28", "-c:a", "aac", "-b:a", "96k", "-movflags", "+faststart",
+        ],
+    },
+}
+
+_workers = config.TRANSCODE_WORKERS or max(1, (os.cpu_count() or 2) // 2)
+_threads_per_job = max(1, (os.cpu_count() or 1) // _workers)
+# Per event loop: app.py runs previews on Flask's own short-lived loops,
+# and asyncio primitives can't be shared between loops
+_slots: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, asyncio.Semaphore]" = weakref.WeakKeyDictionary()
+_inflight = {}  # (key, loop) -> [task, waiters]
+
+
+def _pool_slots() -> asyncio.Semaphore:
+    loop = asyncio.get_running_loop()
+    slots = _slots.get(loop)
+    if slots is None:
+        slots = _slots[loop] = asyncio.Semaphore(_workers)
+    return slots
+
+
+async def _join(key: tuple, start) -> Optional[str]:
+    """Share one job between concurrent callers for the same output.
+
+    The job keeps running while anyone still waits on it, and is
+    cancelled (killing its ffmpeg) when the last waiter is cancelled.
+    """
+    key = (key, asyncio.get_running_loop())
+    entry = _inflight.get(key)
+    if entry is None:
+        entry = _inflight[key] = [asyncio.ensure_future(start()), 0]
+        entry[0].add_done_callback(lambda _: _inflight.pop(key) if _inflight.get(key) is entry else None)
+    entry[1] += 1
+    try:
+        return await asyncio.shield(entry[0])
+    except asyncio.CancelledError:
+        if entry[1] == 1:
+            entry[0].cancel()
+        raise
+    finally:
+        entry[1] -= 1
+
+
+def variant_path(video_id: str, variant: str) -> Path:
+    return TRANSCODE_DIR / f"{video_id}.{variant}.{VARIANTS[variant]['ext']}"
+
+
+def _lower_priority():
+    os.nice(config.TRANSCODE_NICE)
+
+
+async def run_ffmpeg(args: list, target: Path, output_format: str, timeout: float) -> bool:
+    """Run one ffmpeg job in a pool slot, writing `target` atomically"""
+    temp_path = target.with_name(target.name + ".part")
+    async with _pool_slots():
+        proc = await asyncio.create_subprocess_exec(
+            "ffmpeg", "-y", "-loglevel", "error", "-threads", str(_threads_per_job),
+            *args, "-f", output_format, str(temp_path),
+            stdin=asyncio.subprocess.DEVNULL,
+            stdout=asyncio.subprocess.DEVNULL,
+            stderr=asyncio.subprocess.PIPE,
+            preexec_fn=_lower_priority,
+        )
+        try:
+            _, stderr = await asyncio.wait_for(proc.communicate(), timeout=timeout)
+        except BaseException:
+            # Timed out or cancelled: never leave an orphaned ffmpeg behind
+            proc.kill()
+            await proc.wait()
+            temp_path.unlink(missing_ok=True)
+            raise
+    if proc.returncode != 0:
+        print(f"❌ ffmpeg failed for {target.name}: {stderr.decode(errors='ignore')[-500:]}")
+        temp_path.unlink(missing_ok=True)
+        return False
+    temp_path.rename(target)
+    return True
+
+
+async def _transcode(source: str, target: Path, variant: str) -> Optional[str]:
+    spec = VARIANTS[variant]
+    try:
+        ok = await run_ffmpeg(["-i", source, *spec["args"]], target, spec["format"], config.TRANSCODE_TIMEOUT)
+    except asyncio.TimeoutError:
+        print(f"❌ Transcode timed out: {target.name}")
+        return None
+    except Exception as e:
+        # e.g. ffmpeg missing or the source gone; callers keep the original
+        print(f"❌ Transcode failed for {target.name}: {e}")
+        return None
+    return str(target) if ok else None
+
+
+async def transcode(source: str, video_id: str, variant: str) -> Optional[str]:
+    """Path of `source` converted to `variant`, from cache when possible"""
+    TRANSCODE_DIR.mkdir(parents=True, exist_ok=True)
+    target = variant_path(video_id, variant)
+    if target.exists():
+        return str(target)
+
+    return await _join((video_id, variant), lambda: _transcode(source, target, variant))
+
+
+def preview_path(video_id: str) -> Path:
+    return TRANSCODE_DIR / f"{video_id}.preview.ogg"
+
+
+def cached_preview(video_id: str) -> Optional[str]:
+    path = preview_path(video_id)
+    return str(path) if path.exists() else None
+
+
+async def _cut_preview(stream_url: str, target: Path, start: int) -> Optional[str]:
+    # -ss before -i seeks the input, so ffmpeg issues an HTTP Range
+    # request near the offset instead of reading the whole stream
+    args = [
+        "-reconnect", "1", "-ss", str(start), "-t", str(config.PREVIEW_LENGTH),
+        "-i", stream_url, *VARIANTS["voice"]["args"],
+    ]
+    try:
+        ok = await run_ffmpeg(args, target, "ogg", config.PREVIEW_TIMEOUT)
+    except asyncio.TimeoutError:
+        print(f"❌ Preview timed out: {target.name}")
+        return None
+    except Exception as e:
+        print(f"❌ Preview failed for {target.name}: {e}")
+        return None
+    return str(target) if ok else None
+
+
+async def make_preview(video_id: str, stream_url: str, duration: int = 0) -> Optional[str]:
+    """Cut a short voice-note clip straight from a remote stream URL"""
+    TRANSCODE_DIR.mkdir(parents=True, exist_ok=True)
+    target = preview_path(video_id)
+    if target.exists():
+        return str(target)
+
+    start = config.PREVIEW_OFFSET
+    if duration:
+        start = max(0, min(start, duration - config.PREVIEW_LENGTH, duration // 3))
+
+    return await _join((video_id, "preview"), lambda: _cut_preview(stream_url, target, start))
@@ -0,0 +1,284 @@
+import asyncio
+import inspect
+import math
+import os
+import time
+from pathlib import PurePath
+from typing import AsyncIterator, Callable, List, Optional, Tuple
+
+from pyrogram import raw
+from pyrogram.client import Client
+from pyrogram.errors import FloodWait
+from pyrogram.session import Session
+
+import config
+from .quality import upload_rate
+
+# Parallel upload engine. Pyrogram's save_file pushes every part of a
+# file through one media session; MusicClient keeps a pool of media
+# sessions and uploads parts of big files concurrently across all of
+# them, retrying individual parts instead of the whole file. Uploads can
+# also start before the download finishes (see StreamingSource).
+
+BIG_FILE_SIZE = 10 * 1024 * 1024  # Telegram's threshold for SaveBigFilePart
+MAX_PART_SIZE = 512 * 1024
+MIN_PART_SIZE = 64 * 1024
+MAX_PARTS = 4000
+
+
+def choose_part_size(file_size: int, pipes: int) -> int:
+    """Pick a part size that keeps every upload pipe busy.
+
+    Telegram requires part sizes to divide 512 KiB, so candidates are
+    powers of two; smaller parts spread short files over more pipes,
+    larger parts cut per-request overhead for long ones.
+    """
+    part_size = MAX_PART_SIZE
+    while part_size > MIN_PART_SIZE and file_size / part_size < pipes * 8:
+        part_size //= 2
+    while math.ceil(file_size / part_size) > MAX_PARTS and part_size < MAX_PART_SIZE:
+        part_size *= 2
+    return part_size
+
+
+async def _read_parts(path: str, part_size: int) -> AsyncIterator[Tuple[int, bytes]]:
+    loop = asyncio.get_running_loop()
+    with open(path, "rb") as fp:
+        index = 0
+        while True:
+            chunk = await loop.run_in_executor(None, fp.read, part_size)
+            if not chunk:
+                return
+            yield index, chunk
+            index += 1
+
+
+class StreamingSource:
+    """Media that is still downloading, uploaded part by part as it arrives.
+
+    The downloader calls start() once the Content-Length is known, then
+    feed() with every chunk. Completed parts wait in a bounded buffer, so
+    a slow upload applies backpressure to the download instead of
+    growing memory. Passing the source to send_audio/send_video routes it
+    through MusicClient.save_file.
+    """
+
+    def __init__(self, name: str, part_size: int = MAX_PART_SIZE):
+        self.name = name
+        self.part_size = part_size
+        self.size: Optional[int] = None
+        self.ready = asyncio.get_running_loop().create_future()
+        self._parts = asyncio.Queue(maxsize=config.PIPELINE_BUFFER_PARTS)
+        self._pending = bytearray()
+        self._index = 0
+        self._fed = 0
+        self._state = "new"
+        self.claimed = False  # its parts can only be read once
+
+    def start(self, size: Optional[int]) -> bool:
+        """Begin streaming if the size is known and big enough"""
+        if self._state != "new":
+            return False
+        if not size or size <= BIG_FILE_SIZE:
+            self._state = "declined"
+            self.ready.set_result(False)
+            return False
+        self.size = size
+        self._state = "streaming"
+        self.ready.set_result(True)
+        return True
+
+    async def feed(self, data: bytes):
+        if self._state != "streaming":
+            return
+        self._pending += data
+        self._fed += len(data)
+        while len(self._pending) >= self.part_size and self._state == "streaming":
+            chunk = bytes(self._pending[:self.part_size])
+            del self._pending[:self.part_size]
+            await self._parts.put((self._index, chunk))
+            self._index += 1
+
+    async def finish(self):
+        if self._state != "streaming":
+            return
+        if self._fed != self.size:
+            return await self.fail(ValueError(f"Expected {self.size} bytes, got {self._fed}"))
+        if self._pending:
+            await self._parts.put((self._index, bytes(self._pending)))
+            self._pending.clear()
+        self._state = "done"
+        await self._parts.put(None)
+
+    async def fail(self, exc: Exception):
+        if self._state != "streaming":
+            return
+        self._state = "failed"
+        await self._parts.put(exc)
+
+    def abort(self):
+        """Called by the consumer when the upload gives up"""
+        self._state = "aborted"
+        while not self._parts.empty():
+            self._parts.get_nowait()
+
+    async def parts(self) -> AsyncIterator[Tuple[int, bytes]]:
+        while True:
+            item = await self._parts.get()
+            if item is None:
+                return
+            if isinstance(item, Exception):
+                raise item
+            yield item
+
+
+class MusicClient(Client):
+    def __init__(self, *args, upload_sessions: int = 1, upload_workers: int = 2, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.upload_sessions = upload_sessions
+        self.upload_workers = upload_workers
+        self._upload_pool: List[Session] = []
+        self._upload_pool_lock = asyncio.Lock()
+
+    async def _get_upload_pool(self) -> List[Session]:
+        async with self._upload_pool_lock:
+            if not self._upload_pool:
+                dc_id = await self.storage.dc_id()
+                auth_key = await self.storage.auth_key()
+                test_mode = await self.storage.test_mode()
+                for _ in range(self.upload_sessions):
+                    session = Session(self, dc_id, auth_key, test_mode, is_media=True)
+                    await session.start()
+                    self._upload_pool.append(session)
+            return self._upload_pool
+
+    async def stop(self, block: bool = True):
+        async with self._upload_pool_lock:
+            for session in self._upload_pool:
+                await session.stop()
+            self._upload_pool.clear()
+        return await super().stop(block)
+
+    async def save_file(
+        self,
+        path,
+        file_id: int = None,
+        file_part: int = 0,
+        progress: Callable = None,
+        progress_args: tuple = ()
+    ):
+        if isinstance(path, StreamingSource):
+            if path.claimed or file_id is not None:
+                # e.g. Pyrogram resending missing parts after FilePartMissing:
+                # they are gone, so fail and let the caller upload the file
+                path.abort()
+                raise ValueError(f"Streaming upload of {path.name} can't be resumed")
+            path.claimed = True
+            try:
+                return await self.upload_parts(
+                    path.parts(), path.size, path.part_size, path.name, progress, progress_args
+                )
+            except BaseException:
+                path.abort()
+                raise
+        if not isinstance(path, (str, PurePath)) or file_id is not None:
+            return await super().save_file(path, file_id, file_part, progress, progress_args)
+
+        started = time.monotonic()
+        file_size = os.path.getsize(path)
+        if (
+            self.upload_sessions * self.upload_workers > 1
+            and file_size > max(BIG_FILE_SIZE, config.UPLOAD_PARALLEL_MIN)
+        ):
+            part_size = choose_part_size(file_size, self.upload_sessions * self.upload_workers)
+            result = await self.upload_parts(
+                _read_parts(str(path), part_size),
+                file_size,
+                part_size,
+                os.path.basename(path),
+                progress,
+                progress_args,
+            )
+        else:
+            result = await super().save_file(path, file_id, file_part, progress, progress_args)
+        upload_rate.record(file_size, time.monotonic() - started)
+        return result
+
+    async def _save_part(self, session: Session, rpc):
+        attempt = 1
+        while True:
+            try:
+                await session.invoke(rpc)
+                return
+            except FloodWait as e:
+                # Not the part's fault: wait it out without using up an attempt
+                await asyncio.sleep(e.value)
+            except Exception as e:
+                if attempt >= config.UPLOAD_PART_RETRIES:
+                    raise
+                print(f"⚠️ Upload part {rpc.file_part} attempt {attempt} failed: {e}")
+                await asyncio.sleep(0.5 * attempt)
+                attempt += 1
+
+    async def upload_parts(
+        self,
+        parts: AsyncIterator[Tuple[int, bytes]],
+        file_size: int,
+        part_size: int,
+        file_name: str,
+        progress: Callable = None,
+        progress_args: tuple = ()
+    ) -> "raw.types.InputFileBig":
+        """Upload (index, bytes) parts of a big file across the session pool"""
+        file_size_limit_mib = 4000 if self.me.is_premium else 2000
+        if file_size > file_size_limit_mib * 1024 * 1024:
+            raise ValueError(f"Can't upload files bigger than {file_size_limit_mib} MiB")
+
+        file_total_parts = math.ceil(file_size / part_size)
+        file_id = self.rnd_id()
+        pool = await self._get_upload_pool()
+        queue = asyncio.Queue(maxsize=len(pool) * self.upload_workers * 2)
+        uploaded = 0
+
+        async def produce():
+            async for index, chunk in parts:
+                await queue.put((index, chunk))
+            for _ in range(len(pool) * self.upload_workers):
+                await queue.put(None)
+
+        async def worker(session: Session):
+            nonlocal uploaded
+            while True:
+                item = await queue.get()
+                if item is None:
+                    return
+                index, chunk = item
+                await self._save_part(session, raw.functions.upload.SaveBigFilePart(
+                    file_id=file_id,
+                    file_part=index,
+                    file_total_parts=file_total_parts,
+                    bytes=chunk
+                ))
+                uploaded += len(chunk)
+                if progress:
+                    result = progress(min(uploaded, file_size), file_size, *progress_args)
+                    if inspect.isawaitable(result):
+                        await result
+
+        tasks = [asyncio.create_task(produce())]
+        tasks += [
+            asyncio.create_task(worker(session))
+            for session in pool
+            for _ in range(self.upload_workers)
+        ]
+        try:
+            await asyncio.gather(*tasks)
+        finally:
+            for task in tasks:
+                task.cancel()
+
+        return raw.types.InputFileBig(
+            id=file_id,
+            parts=file_total_parts,
+            name=file_name,
+        )
@@ -0,0 +1,127 @@
+import asyncio
+import time
+from collections import deque
+from contextlib import asynccontextmanager
+from pathlib import Path
+from typing import Callable, Dict, Optional
+
+import config
+from .analytics import get_trending
+from .links import WATCH_URL
+from .youtube import download_file
+
+# Background warming of the audio download cache. Popular tracks are
+# fetched into downloads/audio while nothing user-facing is running, so
+# their next request is served straight from disk. With shard workers the
+# jobs run there, and each worker reports its job count to the front
+# process, where the warmer runs.
+
+_foreground_jobs = 0
+# Shard worker -> user-facing jobs it is running, as last reported
+_remote_jobs: Dict[int, int] = {}
+_listener: Optional[Callable[[int], None]] = None
+_last_foreground = 0.0
+_idle = asyncio.Event()
+_idle.set()
+# (timestamp, bytes) for every warmed file in the current budget window
+_spent = deque()
+
+
+def _changed():
+    global _last_foreground
+    _last_foreground = time.monotonic()
+    if _foreground_jobs or any(_remote_jobs.values()):
+        _idle.clear()
+    else:
+        _idle.set()
+
+
+def _report():
+    if _listener is None:
+        return
+    try:
+        _listener(_foreground_jobs)
+    except Exception as e:
+        print(f"⚠️ Foreground job report failed: {e}")
+
+
+@asynccontextmanager
+async def foreground_job():
+    """Mark a user-facing job; warming pauses while any are running"""
+    global _foreground_jobs
+    _foreground_jobs += 1
+    _changed()
+    _report()
+    try:
+        yield
+    finally:
+        _foreground_jobs -= 1
+        _changed()
+        _report()
+
+
+def forward_foreground(listener: Callable[[int], None]):
+    """Shard worker side: pass this process's job count to `listener` on every change"""
+    global _listener
+    _listener = listener
+    # A restarted worker starts from zero, whatever its predecessor reported
+    _report()
+
+
+def report_foreground(worker: int, jobs: int):
+    """Front side: a shard worker's running job count, so warming waits for it too"""
+    _remote_jobs[worker] = jobs
+    _changed()
+
+
+def _budget_left() -> int:
+    now = time.monotonic()
+    while _spent and now - _spent[0][0] > 3600:
+        _spent.popleft()
+    used = sum(size for _, size in _spent)
+    return config.WARM_BUDGET_MB * 1024 * 1024 - used
+
+
+async def _wait_until_idle():
+    while True:
+        await _idle.wait()
+        quiet_for = time.monotonic() - _last_foreground
+        if quiet_for >= config.WARM_IDLE_SECONDS:
+            return
+        await asyncio.sleep(config.WARM_IDLE_SECONDS - quiet_for)
+
+
+async def warm_once() -> int:
+    """Download missing trending tracks; returns how many were warmed"""
+    warmed = 0
+    folder = Path("downloads/audio")
+    for track in get_trending(config.WARM_TOP_N):
+        video_id = track['vidid']
+        if (folder / f"{video_id}.m4a").exists():
+            continue
+        if _budget_left() <= 0:
+            print("ℹ️ Cache warming budget used up for this hour")
+            break
+        await _wait_until_idle()
+
+        try:
+            path = await download_file(WATCH_URL + video_id)
+        except Exception as e:
+            print(f"⚠️ Cache warming failed for {video_id}: {e}")
+            continue
+        if path:
+            _spent.append((time.monotonic(), Path(path).stat().st_size))
+            warmed += 1
+            print(f"🔥 Warmed cache: {track['title']} ({video_id})")
+    return warmed
+
+
+async def run_warmer():
+    """Warm the cache forever, one pass every WARM_INTERVAL seconds"""
+    while True:
+        await asyncio.sleep(config.WARM_INTERVAL)
+        await _wait_until_idle()
+        try:
+            await warm_once()
+        except Exception as e:
+            print(f"⚠️ Cache warmer error: {e}")
@@ -1,4 +1,5 @@
 import asyncio
+import copy
 import os
 import re
 import json
@@ -8,6 +9,7 @@ import logging
 import aiohttp
 import config
 import time
+import threading
 import yt_dlp
 from pathlib import Path
 from typing import Union
@@ -15,17 +17,93 @@ from pyrogram.types import Message
 from pyrogram.enums import MessageEntityType
 from youtubesearchpython.__future__ import VideosSearch
 from youtubesearchpython import VideosSearch as SyncVideosSearch
-from .database import is_on_off
+from .database import SHARED, forget_shared, get_shared, is_on_off, set_shared
+from . import search_index
+from . import negative_cache
+from .filewriter import FileWriter
+from . import manifest
+from .tracing import annotate, span, traced
+from .transcoder import transcode, variant_path
 from .formatters import time_to_seconds
+from .links import WATCH_URL, canonical_url, extract_video_id
+from .quality import MAX_HEIGHT, download_rate, merged_video_format, transcode_rate, video_format
 
 
+# (video_id, video) -> (expires_at, stream_url); resolved URLs stay valid for hours
+_stream_urls = {}
+# (video_id, video) -> (expires_at, size in bytes)
+_probed_sizes = {}
+# With several processes both are also kept in the database's shared_cache
+_NAMESPACES = {id(_stream_urls): "stream_url", id(_probed_sizes): "size"}
+# (video_id, format selector) -> (expires_at, yt-dlp info); one extraction
+# serves the size check and the download after it. Info dicts are big, so
+# only a few are kept
+_infos = {}
+_MAX_INFOS = 256
+
+
+class FileTooLarge(Exception):
+    """A download grew past MAX_FILE_SIZE_MB (its size wasn't known up front)"""
+
+
+def _size_limit() -> int:
+    return config.MAX_FILE_SIZE_MB * 1024 * 1024
+
+
+def _shared_key(key) -> str:
+    video_id, video = key
+    return f"{video_id}:{int(video)}"
+
+
+def _store(cache: dict, key, value, ttl: float):
+    now = time.monotonic()
+    if len(cache) > 10000:
+        for stale in [k for k, (expires_at, _) in cache.items() if expires_at <= now]:
+            del cache[stale]
+    cache[key] = (now + ttl, value)
+
+
+async def _cache_get(cache: dict, key):
+    entry = cache.get(key)
+    if entry and entry[0] > time.monotonic():
+        return entry[1]
+    cache.pop(key, None)
+    if SHARED:
+        # Another process may have resolved it already
+        shared = await get_shared(_NAMESPACES[id(cache)], _shared_key(key))
+        if shared:
+            value, expires_at = json.loads(shared[0]), shared[1]
+            _store(cache, key, value, expires_at - time.time())
+            return value
+    return None
+
+
+def _cache_put(cache: dict, key, value):
+    _store(cache, key, value, config.STREAM_URL_TTL)
+    if SHARED:
+        set_shared(_NAMESPACES[id(cache)], _shared_key(key), json.dumps(value), config.STREAM_URL_TTL)
+
+
+def _cache_drop(cache: dict, key):
+    cache.pop(key, None)
+    if SHARED:
+        forget_shared(_NAMESPACES[id(cache)], _shared_key(key))
+
+
+@traced("resolve")
 async def fetch_stream_url(link: str, video: bool = False) -> str | None:
-    try:
-        video_id = link.split("v=")[-1].split("&")[0]
-        if not video_id:
-            raise ValueError("Empty video ID extracted")
-    except Exception as e:
-        raise ValueError(f"❌ Could not extract video ID from link: {link}") from e
+    video_id = extract_video_id(link)
+    if not video_id:
+        raise ValueError(f"❌ Could not extract video ID from link: {link}")
+
+    annotate(video_id=video_id, video=video)
+    cached = await _cache_get(_stream_urls, (video_id, video))
+    if cached:
+        annotate(cached=True)
+        return cached
+    await negative_cache.load(video_id)
+    if negative_cache.check(video_id, "api"):
+        return None
 
     api_key = getattr(config, "API_KEY", None)
     api_url = getattr(config, "API_URL", None)
@@ -44,14 +122,19 @@ async def fetch_stream_url(link: str, video: bool = False) -> str | None:
             try:
                 print(f"🔁 {'Video' if video else 'Audio'} Attempt #{attempt}")
                 async with session.get(url, allow_redirects=True) as response:
+                    annotate(attempts=attempt, http_status=response.status)
                     if response.status == 200:
                         data = await response.json()
                         if data.get("status") == "done":
                             stream_url = data.get("stream_url")
                             if stream_url:
                                 print(f"🎬 Direct stream URL ready: {stream_url}")
+                                _cache_put(_stream_urls, (video_id, video), stream_url)
                                 return stream_url
+                        elif attempt == 2:
+                            negative_cache.mark(video_id, "api_pending")
                     elif response.status == 404:
+                        negative_cache.mark(video_id, "api_missing")
                         return None
             except Exception as e:
                 print(f"⚠️ Request error ({'Video' if video else 'Audio'}): {e}")
@@ -62,13 +145,69 @@ async def fetch_stream_url(link: str, video: bool = False) -> str | None:
     return None
 
 
-async def download_file(link: str, video: bool = False) -> str | None:
+@traced("probe")
+async def probe_size(link: str, video: bool = False) -> int | None:
+    """Size of the file a download would fetch, without fetching it.
+
+    Uses the local copy if there is one, otherwise a HEAD (or a 1 byte
+    Range GET) on the resolved stream URL, or, when the API can't serve
+    it, the size of the format the yt-dlp fallback would pick, from an
+    extraction the download then reuses. None if it can't be told.
+    """
+    video_id = extract_video_id(link)
+    if not video_id:
+        return None
+    local = Path("downloads/video" if video else "downloads/audio") / f"{video_id}{'.mp4' if video else '.m4a'}"
+    if local.exists():
+        return local.stat().st_size
+
+    cached = await _cache_get(_probed_sizes, (video_id, video))
+    if cached:
+        return cached
+
     try:
-        video_id = link.split("v=")[-1].split("&")[0]
-        if not video_id:
-            raise ValueError("Empty video ID extracted")
+        stream_url = await fetch_stream_url(link, video=video)
     except Exception as e:
-        raise ValueError(f"❌ Could not extract video ID from link: {link}") from e
+        print(f"⚠️ Size probe failed: {e}")
+        stream_url = None
+    if not stream_url:
+        size = await check_file_size(link, audio=not video)
+        if size:
+            _cache_put(_probed_sizes, (video_id, video), size)
+        annotate(video_id=video_id, bytes=size, source="yt-dlp")
+        return size
+
+    try:
+        timeout = aiohttp.ClientTimeout(total=config.RESOLVE_TIMEOUT)
+        async with aiohttp.ClientSession(timeout=timeout) as session:
+            async with session.head(stream_url, allow_redirects=True) as response:
+                size = response.content_length if response.status == 200 else None
+            if not size:
+                async with session.get(stream_url, headers={"Range": "bytes=0-0"}) as response:
+                    content_range = response.headers.get("Content-Range", "")
+                    if response.status == 206 and "/" in content_range:
+                        total = content_range.rsplit("/", 1)[1]
+                        size = int(total) if total.isdigit() else None
+    except Exception as e:
+        print(f"⚠️ Size probe failed: {e}")
+        return None
+
+    if size:
+        _cache_put(_probed_sizes, (video_id, video), size)
+    annotate(video_id=video_id, bytes=size)
+    return size or None
+
+
+@traced("download")
+async def download_file(link: str, video: bool = False, progress=None, tee=None) -> str | None:
+    """Download a track into the local cache.
+
+    `tee` is an optional StreamingSource that also receives the bytes as
+    they arrive, so an upload can run alongside the download.
+    """
+    video_id = extract_video_id(link)
+    if not video_id:
+        raise ValueError(f"❌ Could not extract video ID from link: {link}")
 
     folder = Path("downloads/video" if video else "downloads/audio")
     folder.mkdir(parents=True, exist_ok=True)
@@ -76,9 +215,11 @@ async def download_file(link: str, video: bool = False) -> str | None:
     ext = ".mp4" if video else ".m4a"
     filepath = folder / f"{video_id}{ext}"
     temp_path = filepath.with_suffix(filepath.suffix + ".part")
+    annotate(video_id=video_id, video=video, source="api", streaming=tee is not None)
 
-    if filepath.exists():
+    if filepath.exists() and await manifest.verify(filepath):
         print(f"ℹ️ File already downloaded: {filepath}")
+        annotate(cached=True)
         return str(filepath)
 
     if temp_path.exists():
@@ -92,32 +233,66 @@ async def download_file(link: str, video: bool = False) -> str | None:
         return None
 
     for attempt in range(1, 4):
+        annotate(attempts=attempt)
         try:
             stream_url = await fetch_stream_url(link, video=video)
             if not stream_url:
                 print("❌ Failed to get stream URL.")
                 return None
 
-            timeout = aiohttp.ClientTimeout(total=None)
+            timeout = aiohttp.ClientTimeout(total=None, sock_read=config.DOWNLOAD_STALL_TIMEOUT)
             async with aiohttp.ClientSession(timeout=timeout) as session:
                 async with session.get(stream_url) as response:
                     if response.status != 200:
                         print(f"❌ Failed to download: HTTP {response.status}")
                         raise Exception(f"HTTP {response.status}")
 
-                    with open(temp_path, "wb") as f:
+                    total = response.content_length or 0
+                    limit = _size_limit()
+                    if limit and total > limit:
+                        raise FileTooLarge(f"File is too large ({total // (1024 * 1024)} MB)")
+                    streaming = tee is not None and tee.start(total)
+                    received = 0
+                    started = time.monotonic()
+                    async with FileWriter(temp_path, total) as f:
                         while True:
                             chunk = await response.content.read(1024 * 1024)
                             if not chunk:
                                 break
-                            f.write(chunk)
-
-            temp_path.rename(filepath)
+                            received += len(chunk)
+                            if limit and received > limit:
+                                # No Content-Length, so admission couldn't check it
+                                raise FileTooLarge(f"File is larger than {config.MAX_FILE_SIZE_MB} MB")
+                            await f.write(chunk)
+                            if streaming:
+                                await tee.feed(chunk)
+                            if progress:
+                                progress(received, total)
+                    if streaming:
+                        await tee.finish()
+                    download_rate.record(received, time.monotonic() - started)
+                    annotate(bytes=received)
+
+            await manifest.publish(temp_path, filepath, f.hexdigest())
             print(f"✅ Download completed: {filepath}")
             return str(filepath)
 
+        except asyncio.CancelledError:
+            print(f"🛑 Download cancelled: {video_id}")
+            temp_path.unlink(missing_ok=True)
+            raise
+        except FileTooLarge as e:
+            print(f"❌ Download aborted: {e}")
+            if tee is not None:
+                await tee.fail(e)
+            temp_path.unlink(missing_ok=True)
+            raise
         except Exception as e:
             print(f"⚠️ Download attempt {attempt} failed: {e}")
+            # The stream URL may have expired; resolve a fresh one next time
+            _cache_drop(_stream_urls, (video_id, video))
+            if tee is not None:
+                await tee.fail(e)
             if temp_path.exists():
                 temp_path.unlink(missing_ok=True)
 
@@ -128,6 +303,35 @@ async def download_file(link: str, video: bool = False) -> str | None:
                 return None
 
 
+async def _check_dead(link: str):
+    """Fail fast for videos already known to be unfetchable"""
+    video_id = extract_video_id(link)
+    await negative_cache.load(video_id)
+    negative_cache.raise_if_dead(video_id)
+
+
+@traced("subprocess")
+async def exec_cmd(*args, timeout: float = None):
+    """Run a command, killing it on timeout or cancellation.
+
+    Returns (returncode, stdout, stderr); raises asyncio.TimeoutError.
+    """
+    annotate(command=args[0])
+    proc = await asyncio.create_subprocess_exec(
+        *args,
+        stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.PIPE,
+    )
+    try:
+        stdout, stderr = await asyncio.wait_for(proc.communicate(), timeout=timeout or config.RESOLVE_TIMEOUT)
+    except BaseException:
+        proc.kill()
+        await proc.communicate()
+        raise
+    annotate(returncode=proc.returncode)
+    return proc.returncode, stdout, stderr
+
+
 def cookie_txt_file():
     cookie_dir = f"{os.getcwd()}/cookies"
     if not os.path.exists(cookie_dir):
@@ -139,44 +343,73 @@ def cookie_txt_file():
     return cookie_file
 
 
-async def check_file_size(link):
-    async def get_format_info(link):
-        cookie_file = cookie_txt_file()
-        if not cookie_file:
-            print("No cookies found. Cannot check file size.")
-            return None
-            
-        proc = await asyncio.create_subprocess_exec(
-            "yt-dlp",
-            "--cookies", cookie_file,
-            "-J",
-            link,
-            stdout=asyncio.subprocess.PIPE,
-            stderr=asyncio.subprocess.PIPE
-        )
-        stdout, stderr = await proc.communicate()
-        if proc.returncode != 0:
-            print(f'Error:\n{stderr.decode()}')
-            return None
-        return json.loads(stdout.decode())
+def _cached_info(link: str, selector: str) -> dict | None:
+    """A still fresh extraction of `link` with `selector`, if there is one"""
+    entry = _infos.get((extract_video_id(link), selector))
+    if entry and entry[0] > time.monotonic():
+        # yt-dlp annotates the dict while downloading; keep ours clean
+        return copy.deepcopy(entry[1])
+    return None
 
-    def parse_size(formats):
-        total_size = 0
-        for format in formats:
-            if 'filesize' in format:
-                total_size += format['filesize']
-        return total_size
 
-    info = await get_format_info(link)
+def _extract(link: str, selector: str, cookie_file: str) -> dict:
+    ydl = yt_dlp.YoutubeDL({
+        "format": selector,
+        "geo_bypass": True,
+        "nocheckcertificate": True,
+        "quiet": True,
+        "no_warnings": True,
+        "cookiefile": cookie_file,
+    })
+    return ydl.sanitize_info(ydl.extract_info(link, download=False))
+
+
+@traced("extract")
+async def extract_info(link: str, selector: str) -> dict | None:
+    """yt-dlp's info for `link` with the formats `selector` picks, extracted once"""
+    cached = _cached_info(link, selector)
+    if cached:
+        return cached
+    cookie_file = cookie_txt_file()
+    if not cookie_file:
+        print("No cookies found. Cannot extract video info.")
+        return None
+    video_id = extract_video_id(link)
+    loop = asyncio.get_running_loop()
+    try:
+        info = await asyncio.wait_for(
+            loop.run_in_executor(None, _extract, link, selector, cookie_file), config.RESOLVE_TIMEOUT
+        )
+    except asyncio.TimeoutError:
+        print("yt-dlp timed out. Cannot extract video info.")
+        return None
+    except Exception as e:
+        print(f'Error:\n{e}')
+        negative_cache.mark_from_error(video_id, str(e))
+        return None
+    now = time.monotonic()
+    if len(_infos) >= _MAX_INFOS:
+        for stale in [key for key, (expires_at, _) in _infos.items() if expires_at <= now]:
+            del _infos[stale]
+        while len(_infos) >= _MAX_INFOS:
+            del _infos[next(iter(_infos))]
+    _infos[(video_id, selector)] = (now + config.STREAM_URL_TTL, info)
+    return copy.deepcopy(info)
+
+
+async def check_file_size(link, height: int = MAX_HEIGHT, audio: bool = False):
+    """Size of what the yt-dlp downloads (audio_dl/video_dl) would fetch"""
+    selector = "bestaudio/best" if audio else merged_video_format(height)
+    info = await extract_info(link, selector)
     if info is None:
         return None
-    
-    formats = info.get('formats', [])
-    if not formats:
-        print("No formats found.")
+
+    # Only the selected format(s) get downloaded, not every listed one
+    formats = info.get('requested_formats') or [info]
+    total_size = sum(format.get('filesize') or format.get('filesize_approx') or 0 for format in formats)
+    if not total_size:
+        print("No size information found.")
         return None
-    
-    total_size = parse_size(formats)
     return total_size
 
 async def shell_cmd(cmd):
@@ -185,7 +418,12 @@ async def shell_cmd(cmd):
         stdout=asyncio.subprocess.PIPE,
         stderr=asyncio.subprocess.PIPE,
     )
-    out, errorz = await proc.communicate()
+    try:
+        out, errorz = await asyncio.wait_for(proc.communicate(), timeout=config.RESOLVE_TIMEOUT)
+    except BaseException:
+        proc.kill()
+        await proc.communicate()
+        raise
     if errorz:
         if "unavailable videos are hidden" in (errorz.decode("utf-8")).lower():
             return out.decode("utf-8")
@@ -196,7 +434,7 @@ async def shell_cmd(cmd):
 
 class YouTubeAPI:
     def __init__(self):
-        self.base = "https://www.youtube.com/watch?v="
+        self.base = WATCH_URL
         self.regex = r"(?:youtube\.com|youtu\.be)"
         self.status = "https://www.youtube.com/oembed?url="
         self.listbase = "https://youtube.com/playlist?list="
@@ -205,10 +443,7 @@ class YouTubeAPI:
     async def exists(self, link: str, videoid: Union[bool, str] = None):
         if videoid:
             link = self.base + link
-        if re.search(self.regex, link):
-            return True
-        else:
-            return False
+        return extract_video_id(link) is not None
 
     async def url(self, message_1: Message) -> Union[str, None]:
         messages = [message_1]
@@ -237,8 +472,8 @@ class YouTubeAPI:
     async def details(self, link: str, videoid: Union[bool, str] = None):
         if videoid:
             link = self.base + link
-        if "&" in link:
-            link = link.split("&")[0]
+        link = canonical_url(link) or link
+        await _check_dead(link)
         results = VideosSearch(link, limit=1)
         for result in (await results.next())["result"]:
             title = result["title"]
@@ -254,8 +489,8 @@ class YouTubeAPI:
     async def title(self, link: str, videoid: Union[bool, str] = None):
         if videoid:
             link = self.base + link
-        if "&" in link:
-            link = link.split("&")[0]
+        link = canonical_url(link) or link
+        await _check_dead(link)
         results = VideosSearch(link, limit=1)
         for result in (await results.next())["result"]:
             title = result["title"]
@@ -264,8 +499,8 @@ class YouTubeAPI:
     async def duration(self, link: str, videoid: Union[bool, str] = None):
         if videoid:
             link = self.base + link
-        if "&" in link:
-            link = link.split("&")[0]
+        link = canonical_url(link) or link
+        await _check_dead(link)
         results = VideosSearch(link, limit=1)
         for result in (await results.next())["result"]:
             duration = result["duration"]
@@ -274,15 +509,21 @@ class YouTubeAPI:
     async def thumbnail(self, link: str, videoid: Union[bool, str] = None):
         if videoid:
             link = self.base + link
-        if "&" in link:
-            link = link.split("&")[0]
+        link = canonical_url(link) or link
+        await _check_dead(link)
         results = VideosSearch(link, limit=1)
         for result in (await results.next())["result"]:
             thumbnail = result["thumbnails"][0]["url"].split("?")[0]
         return thumbnail
 
+    @traced("search")
     async def search(self, query: str, limit: int = 10):
         """Search YouTube videos"""
+        local_results = await search_index.lookup(query, limit)
+        if local_results:
+            annotate(source="local", results=len(local_results))
+            return local_results
+        annotate(source="youtube")
         try:
             # Use sync version instead of async to avoid proxy issues
             from youtubesearchpython import VideosSearch as SyncVideosSearch
@@ -302,10 +543,14 @@ class YouTubeAPI:
                     'url': result['link']
                 })
             
+            search_index.index_tracks(search_results)
+            search_index.remember_query(query, search_results)
+            annotate(results=len(search_results))
             return search_results
         except Exception as e:
             print(f"Search error: {e}")
-            return []
+            # Best local guess beats no answer at all
+            return await search_index.fuzzy_lookup(query, limit)
 
     async def get_stream_url(self, link: str) -> str:
         """Get direct stream URL for audio playback"""
@@ -315,11 +560,11 @@ class YouTubeAPI:
             print(f"Stream URL error: {e}")
             return None
 
-    async def video(self, link: str, videoid: Union[bool, str] = None):
+    async def video(self, link: str, videoid: Union[bool, str] = None, quality: int = MAX_HEIGHT):
         if videoid:
             link = self.base + link
-        if "&" in link:
-            link = link.split("&")[0]
+        link = canonical_url(link) or link
+        await _check_dead(link)
         
         # Try video API first
         try:
@@ -334,20 +579,21 @@ class YouTubeAPI:
         if not cookie_file:
             return 0, "No cookies found. Cannot download video."
             
-        proc = await asyncio.create_subprocess_exec(
-            "yt-dlp",
-            "--cookies", cookie_file,
-            "-g",
-            "-f",
-            "best[height<=?720][width<=?1280]",
-            f"{link}",
-            stdout=asyncio.subprocess.PIPE,
-            stderr=asyncio.subprocess.PIPE,
-        )
-        stdout, stderr = await proc.communicate()
+        try:
+            _, stdout, stderr = await exec_cmd(
+                "yt-dlp",
+                "--cookies", cookie_file,
+                "-g",
+                "-f",
+                video_format(quality),
+                f"{link}",
+            )
+        except asyncio.TimeoutError:
+            return 0, "yt-dlp timed out."
         if stdout:
             return 1, stdout.decode().split("\n")[0]
         else:
+            negative_cache.mark_from_error(extract_video_id(link), stderr.decode())
             return 0, stderr.decode()
 
     async def playlist(self, link, limit, user_id, videoid: Union[bool, str] = None):
@@ -372,13 +618,18 @@ class YouTubeAPI:
             result = []
         return result
 
+    @traced("metadata")
     async def track(self, link: str, videoid: Union[bool, str] = None):
         if videoid:
             link = self.base + link
-        if "&" in link:
-            link = link.split("&")[0]
+        link = canonical_url(link) or link
+        await _check_dead(link)
         results = VideosSearch(link, limit=1)
-        for result in (await results.next())["result"]:
+        found = (await results.next())["result"]
+        if not found:
+            negative_cache.mark(extract_video_id(link), "not_found")
+            await _check_dead(link)
+        for result in found:
             title = result["title"]
             duration_min = result["duration"]
             vidid = result["id"]
@@ -391,13 +642,19 @@ class YouTubeAPI:
             "duration_min": duration_min,
             "thumb": thumbnail,
         }
+        search_index.index_tracks([{
+            "id": vidid,
+            "title": title,
+            "duration": duration_min,
+            "thumbnail": thumbnail,
+        }])
         return track_details, vidid
 
     async def formats(self, link: str, videoid: Union[bool, str] = None):
         if videoid:
             link = self.base + link
-        if "&" in link:
-            link = link.split("&")[0]
+        link = canonical_url(link) or link
+        await _check_dead(link)
         
         cookie_file = cookie_txt_file()
         if not cookie_file:
@@ -407,7 +664,11 @@ class YouTubeAPI:
         ydl = yt_dlp.YoutubeDL(ytdl_opts)
         with ydl:
             formats_available = []
-            r = ydl.extract_info(link, download=False)
+            try:
+                r = ydl.extract_info(link, download=False)
+            except Exception as e:
+                negative_cache.mark_from_error(extract_video_id(link), str(e))
+                raise
             for format in r["formats"]:
                 try:
                     str(format["format"])
@@ -442,8 +703,7 @@ class YouTubeAPI:
     ):
         if videoid:
             link = self.base + link
-        if "&" in link:
-            link = link.split("&")[0]
+        link = canonical_url(link) or link
         a = VideosSearch(link, limit=10)
         result = (await a.next()).get("result")
         title = result[query_type]["title"]
@@ -462,10 +722,84 @@ class YouTubeAPI:
         songvideo: Union[bool, str] = None,
         format_id: Union[bool, str] = None,
         title: Union[bool, str] = None,
+        progress=None,
+        tee=None,
+        quality: int = MAX_HEIGHT,
     ) -> str:
         if videoid:
             link = self.base + link
+        link = canonical_url(link) or link
+        await _check_dead(link)
         loop = asyncio.get_running_loop()
+        cancelled = threading.Event()
+        limit = _size_limit()
+        # bytes of the formats yt-dlp finished so far, whether it went over the limit
+        fetched = {"bytes": 0, "too_large": False}
+
+        def check_cancelled(d):
+            # yt-dlp runs in a thread that can't be cancelled; stop it from its progress hook
+            if cancelled.is_set():
+                raise yt_dlp.utils.DownloadCancelled()
+            # max_filesize only looks at Content-Length; this catches the rest
+            if limit and fetched["bytes"] + (d.get("downloaded_bytes") or 0) > limit:
+                fetched["too_large"] = True
+                raise yt_dlp.utils.DownloadCancelled()
+            if d.get("status") == "finished":
+                fetched["bytes"] += d.get("downloaded_bytes") or 0
+
+        def remove_partials(future=None):
+            if future is not None and not future.cancelled():
+                future.exception()
+            video_id = extract_video_id(link)
+            if not video_id:
+                return
+            for part in glob.glob(f"downloads/{glob.escape(video_id)}*.part"):
+                try:
+                    os.remove(part)
+                except OSError:
+                    pass
+
+        @traced("yt-dlp")
+        async def run_dl(func):
+            annotate(step=func.__name__)
+            for _ in range(2):
+                started = time.time()
+                fetched["bytes"] = 0
+                future = loop.run_in_executor(None, func)
+                try:
+                    path = await asyncio.shield(future)
+                except asyncio.CancelledError:
+                    cancelled.set()
+                    future.add_done_callback(remove_partials)
+                    raise
+                except Exception as e:
+                    if fetched["too_large"]:
+                        remove_partials()
+                        raise FileTooLarge(f"File is larger than {config.MAX_FILE_SIZE_MB} MB") from e
+                    negative_cache.mark_from_error(extract_video_id(link), str(e))
+                    raise
+                # A file yt-dlp just wrote is recorded; one it handed back from the
+                # cache is checked, and fetched again if it's damaged
+                if not path or await manifest.record(path, since=started):
+                    return path
+            return None
+
+        def fetch_with(x, selector: str, suffix: str):
+            # Reuse the extraction the size check made, if it is still fresh
+            info = _cached_info(link, selector) or x.extract_info(link, False)
+            xyz = os.path.join("downloads", f"{info['id']}{suffix}.{info['ext']}")
+            if os.path.exists(xyz):
+                return xyz
+            try:
+                x.process_ie_result(info, download=True)
+            except yt_dlp.utils.DownloadError:
+                if fetched["too_large"]:
+                    raise
+                # e.g. the cached format URLs expired: extract afresh
+                x.download([link])
+            # Nothing written when max_filesize turned it down
+            return xyz if os.path.exists(xyz) else None
+
         def audio_dl():
             cookie_file = cookie_txt_file()
             if not cookie_file:
@@ -479,14 +813,13 @@ class YouTubeAPI:
                 "quiet": True,
                 "cookiefile" : cookie_file,
                 "no_warnings": True,
+                "progress_hooks": [check_cancelled],
+                "max_filesize": limit or None,
             }
-            x = yt_dlp.YoutubeDL(ydl_optssx)
-            info = x.extract_info(link, False)
-            xyz = os.path.join("downloads", f"{info['id']}.{info['ext']}")
-            if os.path.exists(xyz):
-                return xyz
-            x.download([link])
-            return xyz
+            return fetch_with(yt_dlp.YoutubeDL(ydl_optssx), "bestaudio/best", "")
+
+        # Lower rungs get their own file name, so they never pass for full quality
+        rung = "" if quality == MAX_HEIGHT else f".{quality}p"
 
         def video_dl():
             cookie_file = cookie_txt_file()
@@ -494,21 +827,17 @@ class YouTubeAPI:
                 raise Exception("No cookies found. Cannot download video.")
                 
             ydl_optssx = {
-                "format": "(bestvideo[height<=?720][width<=?1280][ext=mp4])+(bestaudio[ext=m4a])",
-                "outtmpl": "downloads/%(id)s.%(ext)s",
+                "format": merged_video_format(quality),
+                "outtmpl": f"downloads/%(id)s{rung}.%(ext)s",
                 "geo_bypass": True,
                 "nocheckcertificate": True,
                 "quiet": True,
                 "cookiefile" : cookie_file,
                 "no_warnings": True,
+                "progress_hooks": [check_cancelled],
+                "max_filesize": limit or None,
             }
-            x = yt_dlp.YoutubeDL(ydl_optssx)
-            info = x.extract_info(link, False)
-            xyz = os.path.join("downloads", f"{info['id']}.{info['ext']}")
-            if os.path.exists(xyz):
-                return xyz
-            x.download([link])
-            return xyz
+            return fetch_with(yt_dlp.YoutubeDL(ydl_optssx), merged_video_format(quality), rung)
 
         def song_video_dl():
             cookie_file = cookie_txt_file()
@@ -525,6 +854,7 @@ class YouTubeAPI:
                 "quiet": True,
                 "no_warnings": True,
                 "cookiefile" : cookie_file,
+                "progress_hooks": [check_cancelled],
                 "prefer_ffmpeg": True,
                 "merge_output_format": "mp4",
             }
@@ -545,6 +875,7 @@ class YouTubeAPI:
                 "quiet": True,
                 "no_warnings": True,
                 "cookiefile" : cookie_file,
+                "progress_hooks": [check_cancelled],
                 "prefer_ffmpeg": True,
                 "postprocessors": [
                     {
@@ -558,18 +889,55 @@ class YouTubeAPI:
             x.download([link])
 
         if songvideo:
-            fpath = await download_file(link)
+            fpath = await download_file(link, progress=progress, tee=tee)
             return fpath
         elif songaudio:
-            fpath= await download_file(link)
+            fpath= await download_file(link, progress=progress, tee=tee)
+            if fpath:
+                video_id = extract_video_id(link)
+                with span("transcode", variant="mp3_192"):
+                    mp3_path = await transcode(fpath, video_id, "mp3_192")
+                if mp3_path:
+                    return mp3_path
             return fpath
         elif video:
+            if quality < MAX_HEIGHT and cookie_txt_file():
+                # Fetch the lower rung itself rather than the full file to scale down
+                try:
+                    downloaded_file = await run_dl(video_dl)
+                    if downloaded_file:
+                        return downloaded_file, True
+                except FileTooLarge:
+                    raise
+                except Exception as e:
+                    print(f"{quality}p download failed: {e}")
+                await _check_dead(link)
             # Try video API first
             try:
-                downloaded_file = await download_file(link, video=True)
+                video_id = extract_video_id(link)
+                original = Path("downloads/video") / f"{video_id}.mp4"
+                cached = original.exists()
+                downloaded_file = await download_file(link, video=True, progress=progress, tee=tee)
                 if downloaded_file:
                     direct = True
+                    if quality < MAX_HEIGHT:
+                        # The API has one quality; scale it down for a congested pipeline
+                        variant = f"video_{quality}p"
+                        fresh = not variant_path(video_id, variant).exists()
+                        started = time.monotonic()
+                        with span("transcode", variant=variant):
+                            scaled = await transcode(downloaded_file, video_id, variant)
+                        if scaled:
+                            if fresh:
+                                transcode_rate.record(os.path.getsize(downloaded_file), time.monotonic() - started)
+                            if not cached:
+                                # Only fetched to be scaled down; the caller cleans up the scaled copy
+                                os.remove(downloaded_file)
+                                await manifest.forget(downloaded_file)
+                            return scaled, direct
                     return downloaded_file, direct
+            except FileTooLarge:
+                raise
             except Exception as e:
                 print(f"Video API failed: {e}")
             
@@ -581,39 +949,44 @@ class YouTubeAPI:
                 
             if await is_on_off(1):
                 direct = True
-                downloaded_file = await download_file(link)
+                downloaded_file = await download_file(link, progress=progress, tee=tee)
             else:
-                proc = await asyncio.create_subprocess_exec(
-                    "yt-dlp",
-                    "--cookies", cookie_file,
-                    "-g",
-                    "-f",
-                    "best[height<=?720][width<=?1280]",
-                    f"{link}",
-                    stdout=asyncio.subprocess.PIPE,
-                    stderr=asyncio.subprocess.PIPE,
-                )
-                stdout, stderr = await proc.communicate()
+                try:
+                    _, stdout, stderr = await exec_cmd(
+                        "yt-dlp",
+                        "--cookies", cookie_file,
+                        "-g",
+                        "-f",
+                        video_format(quality),
+                        f"{link}",
+                    )
+                except asyncio.TimeoutError:
+                    print("yt-dlp timed out.")
+                    stdout = stderr = b""
                 if stdout:
                     downloaded_file = stdout.decode().split("\n")[0]
                     direct = False
+                elif negative_cache.mark_from_error(extract_video_id(link), stderr.decode()):
+                    await _check_dead(link)
                 else:
-                   file_size = await check_file_size(link)
+                   file_size = await check_file_size(link, quality)
                    if not file_size:
                      print("None file Size")
                      return None, None
                    total_size_mb = file_size / (1024 * 1024)
-                   if total_size_mb > 250:
-                     print(f"File size {total_size_mb:.2f} MB exceeds the 100MB limit.")
+                   if total_size_mb > config.MAX_FILE_SIZE_MB:
+                     print(f"File size {total_size_mb:.2f} MB exceeds the {config.MAX_FILE_SIZE_MB}MB limit.")
                      return None, None
                    direct = True
-                   downloaded_file = await loop.run_in_executor(None, video_dl)
+                   downloaded_file = await run_dl(video_dl)
         else:
             direct = True
             try:
-                downloaded_file = await download_file(link)
+                downloaded_file = await download_file(link, progress=progress, tee=tee)
                 if downloaded_file:
                     return downloaded_file, direct
+            except FileTooLarge:
+                raise
             except Exception as e:
                 print(e)
             # Fallback to cookies
@@ -622,6 +995,6 @@ class YouTubeAPI:
                 print("No cookies found. Cannot download video.")
                 return None, None
             
-            downloaded_file = await loop.run_in_executor(None, audio_dl)
+            downloaded_file = await run_dl(audio_dl)
             
         return downloaded_file, direct
\ No newline at end of file